@@ -0,0 +1,130 @@
+import asyncio
+import json
+import logging
+import time
+
+import aiohttp
+
+from common.Miner import Miner
+from common.http_session import http_session, endpoint_name, backoff, retry_after, IDEMPOTENT_METHODS, RETRY_STATUS
+from common.swan_client import SwanTask, get_token_manager
+
+ASYNC_CONCURRENCY = 64
+
+
+class AsyncSwanClient:
+    # asyncio version of SwanClient with the same methods. At most concurrency requests are in flight at once;
+    # tokens come from the same TokenManager as the sync client, retries and per-endpoint stats follow
+    # http_session. Use it as an async context manager so the connection pool is closed at the end.
+    def __init__(self, api_url, api_key, access_token, concurrency=ASYNC_CONCURRENCY):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.access_token = access_token
+        self.token_manager = get_token_manager(api_url, api_key, access_token)
+        self._semaphore = None
+        self._session = None
+        self._concurrency = concurrency
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        connector = aiohttp.TCPConnector(limit=self._concurrency)
+        self._session = aiohttp.ClientSession(connector=connector,
+                                              timeout=aiohttp.ClientTimeout(total=http_session.timeout))
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self._session.close()
+
+    async def get_jwt_token(self):
+        # a refresh runs the blocking request off the event loop
+        token = self.token_manager.cached()
+        if token:
+            return token
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, self.token_manager.get)
+
+    async def send_http_request(self, url, method, payload, file=None):
+        token = await self.get_jwt_token()
+        headers = {}
+        if isinstance(payload, str):
+            headers['Content-Type'] = 'application/json'
+        if token:
+            headers["Authorization"] = "Bearer %s" % token
+
+        endpoint = endpoint_name(method, url)
+        attempt = 0
+        async with self._semaphore:
+            while True:
+                data = payload
+                if isinstance(payload, dict):
+                    data = form_fields(payload)
+                if file:
+                    file.seek(0)
+                    data = aiohttp.FormData(form_fields(payload or {}))
+                    data.add_field('file', file)
+                start = time.time()
+                try:
+                    async with self._session.request(method, url, headers=headers, data=data) as r:
+                        http_session.stats.record(endpoint, time.time() - start, r.status)
+                        retryable = r.status == 429 or (r.status in RETRY_STATUS and method in IDEMPOTENT_METHODS)
+                        if not retryable or attempt >= http_session.retries:
+                            return parse_response(r.status, await r.text())
+                        delay = retry_after(r) or backoff(attempt)
+                        logging.warning('%s returned %s, retrying in %.1fs' % (endpoint, r.status, delay))
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    http_session.stats.record(endpoint, time.time() - start, None)
+                    if method not in IDEMPOTENT_METHODS or attempt >= http_session.retries:
+                        raise
+                    delay = backoff(attempt)
+                    logging.warning('%s failed: %s, retrying in %.1fs' % (endpoint, e, delay))
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def update_task_by_uuid(self, task_uuid: str, miner_fid: str, csv):
+        logging.info('Updating Swan task.')
+        update_task_url = self.api_url + '/uuid_tasks/' + task_uuid
+        await self.send_http_request(update_task_url, 'PUT', {"miner_fid": miner_fid}, file=csv)
+        logging.info('Swan task updated.')
+
+    async def post_task(self, task: SwanTask, csv):
+        logging.info('Creating new Swan task: %s' % task.task_name)
+        create_task_url = self.api_url + '/tasks'
+        await self.send_http_request(create_task_url, 'POST', task.to_request_dict(), file=csv)
+        logging.info('New Swan task Generated.')
+
+    async def update_miner(self, miner: Miner):
+        update_miner_url = self.api_url + '/miners/%s/status' % miner.miner_id
+        return await self.send_http_request(update_miner_url, 'PUT', json.dumps(miner.to_request_dict()))
+
+    async def get_offline_deals(self, miner_fid: str, status: str, limit: str):
+        url = self.api_url + "/offline_deals/" + miner_fid + "?deal_status=" + status + "&limit=" + limit + "&offset=0"
+        try:
+            response = await self.send_http_request(url, "GET", None)
+            return response["deal"]
+        except Exception as e:
+            return e
+
+    async def update_offline_deal_details(self, status: str, note: str, deal_id, file_path=None, file_size=None):
+        url = self.api_url + "/my_miner/deals/" + str(deal_id)
+        body = {"status": status, "note": note, "file_path": file_path, "file_size": file_size}
+        await self.send_http_request(url, "PUT", body)
+
+    async def update_offline_deals_details(self, updates) -> list:
+        # updates are dicts of update_offline_deal_details arguments; results come back in the same order,
+        # an exception in place of each update that failed
+        return await asyncio.gather(*(self.update_offline_deal_details(**update) for update in updates),
+                                    return_exceptions=True)
+
+
+def form_fields(payload: dict) -> dict:
+    # requests leaves None fields out of the form and sends the rest as str(), aiohttp only takes strings
+    return {key: str(value) for key, value in payload.items() if value is not None}
+
+
+def parse_response(status_code, text):
+    if status_code >= 400:
+        raise Exception("response code %s, %s" % (status_code, json.loads(text).get("message")))
+    json_body = json.loads(text)
+    if json_body['status'] != 'success' and json_body['status'] != 'Success':
+        raise Exception("response status failed.　%s." % json_body.get("message"))
+    return json_body['data']
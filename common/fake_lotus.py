@@ -0,0 +1,102 @@
+import argparse
+import base64
+import hashlib
+import itertools
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logging.basicConfig(level=logging.INFO)
+
+
+def fake_cid(data: bytes) -> str:
+    # CIDv1 dag-cbor sha2-256 of data, the same shape as real deal cids (bafyrei...)
+    cid = bytes((0x01, 0x71, 0x12, 0x20)) + hashlib.sha256(data).digest()
+    return 'b' + base64.b32encode(cid).decode('ascii').lower().rstrip('=')
+
+
+class FakeLotus:
+    # In-memory stand-in for the lotus JSON-RPC api, enough for query-ask and deal proposal.
+    # Every miner answers with the same ask, as the v0 or the v1 api returns it; deals are stored and get a
+    # made up deal cid.
+    def __init__(self, price='0', verified_price='0', min_piece_size=256, max_piece_size=34359738368, token=None,
+                 api_version='v0'):
+        self.ask = {
+            'Price': price,
+            'VerifiedPrice': verified_price,
+            'MinPieceSize': min_piece_size,
+            'MaxPieceSize': max_piece_size,
+        }
+        self.token = token
+        self.api_version = api_version
+        self.deals = []
+        self._seq = itertools.count()
+        self._lock = threading.Lock()
+
+    def StateMinerInfo(self, miner_id, tsk):
+        return {'PeerId': '12D3KooW' + miner_id}
+
+    def ClientQueryAsk(self, peer_id, miner_id):
+        ask = dict(self.ask, Miner=miner_id)
+        if self.api_version == 'v1':
+            return {'Response': ask, 'DealProtocols': ['/fil/storage/mk/1.1.0']}
+        return ask
+
+    def ClientStartDeal(self, params):
+        with self._lock:
+            self.deals.append(params)
+            seq = next(self._seq)
+        return {'/': fake_cid(json.dumps(params, sort_keys=True).encode() + str(seq).encode())}
+
+    def handle(self, body: dict) -> dict:
+        method = body.get('method', '').replace('Filecoin.', '', 1)
+        resp = {'jsonrpc': '2.0', 'id': body.get('id')}
+        handler = getattr(self, method, None) if method[:1].isupper() else None
+        if handler is None:
+            resp['error'] = {'code': -32601, 'message': 'method %s not found' % body.get('method')}
+            return resp
+        try:
+            resp['result'] = handler(*body.get('params', []))
+        except Exception as e:
+            resp['error'] = {'code': 1, 'message': str(e)}
+        return resp
+
+
+def make_server(fake: FakeLotus, host='127.0.0.1', port=0) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            if fake.token and self.headers.get('Authorization') != 'Bearer %s' % fake.token:
+                self._reply(401, b'unauthorized')
+                return
+            body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            self._reply(200, json.dumps(fake.handle(body)).encode())
+
+        def _reply(self, code, data: bytes):
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake lotus JSON-RPC server')
+    parser.add_argument('--port', type=int, default=1234)
+    parser.add_argument('--price', default='0', help="Ask price in attoFIL per GiB per epoch")
+    parser.add_argument('--verified-price', default='0', help="Verified ask price in attoFIL per GiB per epoch")
+    parser.add_argument('--token', help="Require this bearer token")
+    parser.add_argument('--api-version', default='v0', choices=['v0', 'v1'], help="Shape of the query-ask result")
+    args = parser.parse_args()
+
+    server = make_server(FakeLotus(args.price, args.verified_price, token=args.token, api_version=args.api_version),
+                         port=args.port)
+    logging.info('Fake lotus listening on http://127.0.0.1:%s/rpc/%s' % (args.port, args.api_version))
+    server.serve_forever()
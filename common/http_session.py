@@ -0,0 +1,123 @@
+import logging
+import random
+import re
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+HTTP_TIMEOUT = 60
+HTTP_RETRIES = 3
+HTTP_BACKOFF_BASE = 0.5
+HTTP_BACKOFF_MAX = 30
+HTTP_POOL_SIZE = 32
+
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'}
+RETRY_STATUS = {429, 502, 503, 504}
+
+_ID_SEGMENT = re.compile(r'^(\d+|[0-9a-fA-F-]{32,36}|[a-z]0\d+)$')
+
+
+class HttpSession:
+    # One keep-alive session shared by every Swan api call of the process. Idempotent requests are retried on
+    # connection errors and 502/503/504 with jittered exponential backoff; any request is retried on 429, which
+    # means the server did not process it. Retry-After is honoured when the server sends it.
+    def __init__(self, timeout=HTTP_TIMEOUT, retries=HTTP_RETRIES, pool_size=HTTP_POOL_SIZE):
+        self.timeout = timeout
+        self.retries = retries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.stats = HttpStats()
+
+    def request(self, method, url, files=None, timeout=None, **kwargs) -> requests.Response:
+        method = method.upper()
+        endpoint = endpoint_name(method, url)
+        attempt = 0
+        while True:
+            if attempt and files:
+                for file in files.values():
+                    if hasattr(file, 'seek'):
+                        file.seek(0)
+            start = time.time()
+            try:
+                r = self.session.request(method, url, files=files, timeout=timeout or self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.stats.record(endpoint, time.time() - start, None)
+                if method not in IDEMPOTENT_METHODS or attempt >= self.retries:
+                    raise
+                delay = backoff(attempt)
+                logging.warning('%s failed: %s, retrying in %.1fs' % (endpoint, e, delay))
+            else:
+                self.stats.record(endpoint, time.time() - start, r.status_code)
+                retryable = r.status_code == 429 or (r.status_code in RETRY_STATUS and method in IDEMPOTENT_METHODS)
+                if not retryable or attempt >= self.retries:
+                    return r
+                delay = retry_after(r) or backoff(attempt)
+                logging.warning('%s returned %s, retrying in %.1fs' % (endpoint, r.status_code, delay))
+                r.close()
+            time.sleep(delay)
+            attempt += 1
+
+
+class HttpStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._endpoints = {}
+
+    def record(self, endpoint, elapsed, status_code):
+        with self._lock:
+            stats = self._endpoints.setdefault(endpoint, {'calls': 0, 'errors': 0, 'seconds': 0.0, 'max_seconds': 0.0})
+            stats['calls'] += 1
+            stats['seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            if status_code is None or status_code >= 400:
+                stats['errors'] += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {endpoint: dict(stats) for endpoint, stats in self._endpoints.items()}
+
+    def log(self):
+        for endpoint, stats in sorted(self.snapshot().items(), key=lambda item: -item[1]['seconds']):
+            logging.info('%s: %s calls, %s errors, %.3fs avg, %.3fs max, %.1fs total' % (
+                endpoint, stats['calls'], stats['errors'], stats['seconds'] / stats['calls'], stats['max_seconds'],
+                stats['seconds']))
+
+
+def endpoint_name(method, url) -> str:
+    # ids, uuids and miner ids are folded so that every task or deal counts towards the same endpoint
+    parsed = urlparse(url)
+    path = '/'.join(':id' if _ID_SEGMENT.match(segment) else segment for segment in parsed.path.split('/'))
+    return '%s %s%s' % (method, parsed.netloc, path)
+
+
+def backoff(attempt) -> float:
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * 2 ** (attempt + 1)))
+
+
+def retry_after(r):
+    value = r.headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return min(float(value), HTTP_BACKOFF_MAX * 4)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, min(parsedate_to_datetime(value).timestamp() - time.time(), HTTP_BACKOFF_MAX * 4))
+    except (TypeError, ValueError):
+        return None
+
+
+http_session = HttpSession()
+
+
+def configure_http(config):
+    main = config.get('main', {})
+    http_session.timeout = main.get('http_timeout', HTTP_TIMEOUT)
+    http_session.retries = main.get('http_retries', HTTP_RETRIES)
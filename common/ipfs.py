@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+import uuid
+from urllib.parse import urlencode
+
+import requests
+
+from common.http_session import http_session
+
+IPFS_CHUNK_SIZE = 4 * 1024 * 1024
+IPFS_CONNECT_TIMEOUT = 10
+# longest the ipfs api may go without reading or answering before the upload is given up
+IPFS_STALL_TIMEOUT = 300
+
+
+class MultipartFileStream:
+    # multipart/form-data body with a single file part, read from disk in chunk_size pieces while it is sent.
+    # It has a length, so requests sends a Content-Length instead of chunked encoding, and no read(), so
+    # http.client writes every chunk as it is instead of re-reading it in 8 KiB blocks.
+    def __init__(self, file_path: str, field='file', chunk_size=IPFS_CHUNK_SIZE, callback=None, abspath=False):
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.callback = callback
+        self.boundary = uuid.uuid4().hex
+        self.file_size = os.path.getsize(file_path)
+        # with nocopy the node keeps a reference to Abspath instead of storing the blocks
+        abspath_header = 'Abspath: %s\r\n' % os.path.abspath(file_path) if abspath else ''
+        self._head = ('--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\n%s'
+                      'Content-Type: application/octet-stream\r\n\r\n' % (
+                          self.boundary, field, os.path.basename(file_path), abspath_header)).encode()
+        self._tail = ('\r\n--%s--\r\n' % self.boundary).encode()
+
+    @property
+    def content_type(self) -> str:
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def __len__(self):
+        return len(self._head) + self.file_size + len(self._tail)
+
+    def __iter__(self):
+        yield self._head
+        sent = 0
+        with open(self.file_path, 'rb') as f:
+            while True:
+                chunk = f.read(self.chunk_size)
+                if not chunk:
+                    break
+                yield chunk
+                sent += len(chunk)
+                if self.callback:
+                    self.callback(sent, self.file_size)
+        yield self._tail
+
+
+def ipfs_add(api_address: str, file_path: str, add_params: dict = None, callback=None, chunk_size=IPFS_CHUNK_SIZE,
+             stall_timeout=IPFS_STALL_TIMEOUT, nocopy=False) -> str:
+    # nocopy needs Experimental.FilestoreEnabled on the node and file_path readable by the node at the same path
+    params = {'stream-channels': 'true', 'pin': 'true'}
+    if nocopy:
+        params['nocopy'] = 'true'
+    for key, value in (add_params or {}).items():
+        params[key] = str(value).lower() if isinstance(value, bool) else str(value)
+    url = api_address + "/api/v0/add?" + urlencode(params)
+
+    body = MultipartFileStream(file_path, chunk_size=chunk_size, callback=callback, abspath=nocopy)
+    try:
+        response = http_session.session.post(url, data=body, headers={'Content-Type': body.content_type},
+                                             timeout=(IPFS_CONNECT_TIMEOUT, stall_timeout))
+    except requests.RequestException as e:
+        logging.error("Upload file to ipfs server failed: %s" % e)
+        return None
+    if not response:
+        logging.error("Upload file to ipfs server failed: %s %s" % (response.status_code, response.text.strip()))
+        return None
+    # the api answers one json line per added object, the file itself is the last one
+    return json.loads(response.text.strip().split('\n')[-1])['Hash']
+
+
+def ipfs_verify(api_address: str, ipfs_hash: str, timeout=IPFS_STALL_TIMEOUT) -> bool:
+    # dag/stat walks every block of the dag from the local node only, so it fails if the filestore cannot
+    # serve any of them, e.g. because the car file moved or the node cannot read it
+    url = api_address + "/api/v0/dag/stat?" + urlencode({'arg': ipfs_hash, 'progress': 'false', 'offline': 'true'})
+    try:
+        response = http_session.session.post(url, timeout=(IPFS_CONNECT_TIMEOUT, timeout))
+    except requests.RequestException as e:
+        logging.error("Verifying %s on ipfs server failed: %s" % (ipfs_hash, e))
+        return False
+    if not response:
+        logging.error("Ipfs server cannot serve %s: %s" % (ipfs_hash, response.text.strip()))
+        return False
+    return True
+
+
+def ipfs_has(api_address: str, ipfs_hash: str) -> bool:
+    # the root must still be pinned, a block that is only cached may be garbage collected at any time
+    url = api_address + "/api/v0/pin/ls?" + urlencode({'arg': ipfs_hash, 'type': 'recursive'})
+    try:
+        response = http_session.session.post(url, timeout=(IPFS_CONNECT_TIMEOUT, IPFS_STALL_TIMEOUT))
+    except requests.RequestException as e:
+        logging.warning("Checking %s on ipfs server failed: %s" % (ipfs_hash, e))
+        return False
+    return bool(response)
+
+
+def progress_logger(name: str, step=10):
+    # callback for ipfs_add that logs every step percent of the file
+    state = {'next': step}
+
+    def log(sent, total):
+        percent = sent * 100 // total if total else 100
+        if percent >= state['next']:
+            logging.info("Uploading %s: %s%%" % (name, percent))
+            state['next'] = percent - percent % step + step
+
+    return log
@@ -0,0 +1,171 @@
+import itertools
+import json
+import logging
+import re
+import subprocess
+import threading
+from decimal import Decimal
+
+import requests
+from requests.adapters import HTTPAdapter
+
+ATTO_FIL_PER_FIL = Decimal(10) ** 18
+
+
+class LotusError(Exception):
+    pass
+
+
+def size_str(size: int) -> str:
+    # same format as lotus types.SizeStr, e.g. 15.88 GiB
+    units = ['B', 'KiB', 'MiB', 'GiB', 'TiB', 'PiB']
+    value = float(size)
+    i = 0
+    while value >= 1024 and i < len(units) - 1:
+        value /= 1024
+        i += 1
+    return '%.4g %s' % (value, units[i])
+
+
+def fil_to_atto(fil) -> str:
+    return str(int(Decimal(fil) * ATTO_FIL_PER_FIL))
+
+
+def atto_to_fil(atto) -> str:
+    fil = Decimal(atto) / ATTO_FIL_PER_FIL
+    return format(fil.normalize(), 'f') if fil else '0'
+
+
+class LotusCli:
+    # forks the lotus binary for every call and parses what it prints
+
+    def query_ask(self, miner_id: str):
+        try:
+            proc = subprocess.check_output(['lotus', 'client', 'query-ask', miner_id], timeout=60,
+                                           stderr=subprocess.PIPE)
+        except subprocess.TimeoutExpired:
+            logging.info('miner %s timeout' % miner_id)
+            return None
+        except subprocess.CalledProcessError as e:
+            logging.warning('lotus query-ask process not success, cause %s.' % e.stderr.rstrip().decode('utf-8'))
+            return None
+        except Exception as e:
+            logging.error(e)
+            logging.warning('lotus query-ask process not success.')
+            return None
+
+        ask = {'price': None, 'verified_price': None, 'min_piece_size': None, 'max_piece_size': None}
+        patterns = {
+            'price': r'''^Price per GiB: ([0-9]*\.?[0-9]+) FIL''',
+            'verified_price': r'''^Verified Price per GiB: ([0-9]*\.?[0-9]+) FIL''',
+            'min_piece_size': r'''^Min Piece size: ([0-9]*\.?[0-9]+ [B|KiB|MiB|GiB]+)''',
+            'max_piece_size': r'''^Max Piece size: ([0-9]*\.?[0-9]+ [B|KiB|MiB|GiB]+)''',
+        }
+        for line in proc.rstrip().decode('utf-8').split('\n'):
+            for key, pattern in patterns.items():
+                match = re.findall(pattern, line)
+                if len(match) != 0:
+                    ask[key] = match[0]
+        return ask
+
+    def start_deal(self, wallet, miner_id, data_cid, piece_cid, piece_size, cost, duration, start_epoch,
+                   fast_retrieval, verified_deal) -> str:
+        command = ['lotus', 'client', 'deal', '--from', wallet, '--start-epoch', str(start_epoch),
+                   '--fast-retrieval=' + str(fast_retrieval).lower(), '--verified-deal=' + str(verified_deal).lower(),
+                   '--manual-piece-cid', piece_cid, '--manual-piece-size', str(piece_size), data_cid, miner_id,
+                   str(cost), str(duration)]
+        logging.info(command)
+        proc = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        deal_cid = proc.stdout.decode('utf-8').strip().split('\n')[0]
+        if proc.returncode != 0 or not deal_cid:
+            raise LotusError(proc.stderr.decode('utf-8').strip() or 'lotus client deal exited with %s' % proc.returncode)
+        return deal_cid
+
+
+class LotusRpc:
+    # talks JSON-RPC to the lotus daemon over one pooled HTTP session, no process per call
+
+    def __init__(self, api_url: str, api_token: str = None, timeout=60, pool_size=16):
+        self.api_url = api_url
+        self.timeout = timeout
+        self._ids = itertools.count(1)
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        self._session.headers['Content-Type'] = 'application/json'
+        if api_token:
+            self._session.headers['Authorization'] = 'Bearer %s' % api_token
+
+    def call(self, method: str, *params):
+        body = {'jsonrpc': '2.0', 'method': 'Filecoin.' + method, 'params': list(params), 'id': next(self._ids)}
+        try:
+            r = self._session.post(self.api_url, data=json.dumps(body), timeout=self.timeout)
+        except requests.RequestException as e:
+            raise LotusError('%s: %s' % (method, e))
+        if r.status_code >= 400:
+            raise LotusError('%s: response code %s, %s' % (method, r.status_code, r.text.strip()))
+        resp = r.json()
+        if resp.get('error'):
+            raise LotusError('%s: %s' % (method, resp['error'].get('message')))
+        return resp.get('result')
+
+    def query_ask(self, miner_id: str):
+        try:
+            miner_info = self.call('StateMinerInfo', miner_id, None)
+            ask = self.call('ClientQueryAsk', miner_info['PeerId'], miner_id)
+            # v0 returns the StorageAsk itself, v1 under Response next to the deal protocols
+            ask = ask.get('Response', ask)
+            return {
+                'price': atto_to_fil(ask['Price']),
+                'verified_price': atto_to_fil(ask['VerifiedPrice']),
+                'min_piece_size': size_str(ask['MinPieceSize']),
+                'max_piece_size': size_str(ask['MaxPieceSize']),
+            }
+        except LotusError as e:
+            logging.warning('lotus query-ask not success, cause %s.' % e)
+            return None
+        except (AttributeError, KeyError, TypeError, ValueError, ArithmeticError) as e:
+            logging.warning('lotus query-ask of %s returned no usable ask: %r' % (miner_id, e))
+            return None
+
+    def start_deal(self, wallet, miner_id, data_cid, piece_cid, piece_size, cost, duration, start_epoch,
+                   fast_retrieval, verified_deal) -> str:
+        params = {
+            'Data': {
+                'TransferType': 'manual',
+                'Root': {'/': data_cid},
+                'PieceCid': {'/': piece_cid},
+                'PieceSize': int(piece_size),
+            },
+            'Wallet': wallet,
+            'Miner': miner_id,
+            'EpochPrice': fil_to_atto(cost),
+            'MinBlocksDuration': int(duration),
+            'DealStartEpoch': int(start_epoch),
+            'FastRetrieval': str(fast_retrieval).lower() == 'true',
+            'VerifiedDeal': str(verified_deal).lower() == 'true',
+        }
+        logging.info('ClientStartDeal %s' % json.dumps(params))
+        return self.call('ClientStartDeal', params)['/']
+
+
+_lotus = LotusCli()
+_lotus_lock = threading.Lock()
+
+
+def configure_lotus(config):
+    global _lotus
+    lotus_conf = config.get('lotus', {})
+    api_url = lotus_conf.get('api_url')
+    with _lotus_lock:
+        if not api_url:
+            if not isinstance(_lotus, LotusCli):
+                _lotus = LotusCli()
+        elif not isinstance(_lotus, LotusRpc) or _lotus.api_url != api_url:
+            _lotus = LotusRpc(api_url, lotus_conf.get('api_token'))
+    return _lotus
+
+
+def get_lotus():
+    return _lotus
@@ -1,18 +1,39 @@
+import hashlib
 import json
 import logging
+import os
+import threading
 import time
+from contextlib import contextmanager
 
 import jwt
 import requests
 import subprocess
 
 from common.Miner import Miner
+from common.http_session import http_session, configure_http
+from common.ipfs import ipfs_add, ipfs_verify, IPFS_CHUNK_SIZE, IPFS_STALL_TIMEOUT
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # task type
 task_type_verified = "verified"
 task_type_regular = "regular"
 
 
+TASK_PAGE_SIZE = 100
+
+
+def task_updated_on(task: dict):
+    try:
+        return int(task.get("updated_on"))
+    except (TypeError, ValueError):
+        return None
+
+
 class SwanTask:
     miner_id = None
 
@@ -42,6 +63,124 @@ class SwanTask:
         }
 
 
+# refresh token 1 minute before expiration
+TOKEN_REFRESH_MARGIN = 60
+
+
+class TokenManager:
+    # One JWT per api key, shared by every SwanClient and request of the process. The token is refreshed only
+    # when its exp claim is close. With a path, tokens are also kept in a file guarded by a lock file, so
+    # concurrent swan_cli.py runs and the autobid module reuse one valid token instead of each logging in.
+    def __init__(self, api_url, api_key, access_token, path=None):
+        self.api_url = api_url
+        self.api_key = api_key
+        self.access_token = access_token
+        self.path = os.path.expanduser(path) if path else None
+        self.key = hashlib.sha256((api_url + "\n" + str(api_key)).encode()).hexdigest()
+        self.jwt_token = None
+        self.jwt_token_expiration = None
+        self._lock = threading.Lock()
+
+    def _valid(self, token, expiration) -> bool:
+        return bool(token) and bool(expiration) and time.time() <= expiration - TOKEN_REFRESH_MARGIN
+
+    def cached(self):
+        # the current token if it is still good, without any i/o
+        token, expiration = self.jwt_token, self.jwt_token_expiration
+        return token if self._valid(token, expiration) else None
+
+    def get(self, force=False):
+        with self._lock:
+            if force or not self._valid(self.jwt_token, self.jwt_token_expiration):
+                if self.path:
+                    with _file_lock(self.path + ".lock"):
+                        self._refresh_from_file(force)
+                else:
+                    self._refresh()
+            return self.jwt_token
+
+    def _refresh_from_file(self, force):
+        tokens = _read_tokens(self.path)
+        cached = tokens.get(self.key)
+        if not force and cached and self._valid(cached.get('jwt'), cached.get('exp')):
+            self.jwt_token, self.jwt_token_expiration = cached['jwt'], cached['exp']
+            return
+        self._refresh()
+        if self.jwt_token:
+            tokens[self.key] = {'jwt': self.jwt_token, 'exp': self.jwt_token_expiration}
+            _write_tokens(self.path, tokens)
+
+    def _refresh(self):
+        logging.info('Refreshing token')
+        refresh_api_token_suffix = "/user/api_keys/jwt"
+        refresh_api_token_method = 'POST'
+
+        refresh_token_url = self.api_url + refresh_api_token_suffix
+        data = {
+            "apikey": self.api_key,
+            "access_token": self.access_token
+        }
+        try:
+            resp_data = send_http_request(refresh_token_url, refresh_api_token_method, None, json.dumps(data))
+            self.jwt_token = resp_data['jwt']
+            payload = jwt.decode(jwt=self.jwt_token, verify=False, algorithm='HS256')
+            self.jwt_token_expiration = payload['exp']
+        except Exception as e:
+            logging.info(str(e))
+
+
+@contextmanager
+def _file_lock(lock_path):
+    if fcntl is None:
+        yield
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(lock_path)), exist_ok=True)
+    with open(lock_path, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def _read_tokens(path) -> dict:
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _write_tokens(path, tokens: dict):
+    try:
+        fd = os.open(path + ".tmp", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, "w") as f:
+            json.dump(tokens, f)
+        os.replace(path + ".tmp", path)
+    except OSError as e:
+        logging.warning('Failed to write token cache %s: %s' % (path, e))
+
+
+_token_managers = {}
+_token_managers_lock = threading.Lock()
+_token_cache_path = None
+
+
+def configure_swan_api(config):
+    global _token_cache_path
+    _token_cache_path = config['main'].get('jwt_cache_path') or None
+    configure_http(config)
+
+
+def get_token_manager(api_url, api_key, access_token) -> TokenManager:
+    with _token_managers_lock:
+        key = (api_url, api_key, access_token)
+        manager = _token_managers.get(key)
+        if manager is None or manager.path != (os.path.expanduser(_token_cache_path) if _token_cache_path else None):
+            manager = _token_managers[key] = TokenManager(api_url, api_key, access_token, _token_cache_path)
+        return manager
+
+
 class SwanClient:
     jwt_token = None
     jwt_token_expiration = None
@@ -50,6 +189,7 @@ class SwanClient:
         self.api_url = api_url
         self.api_key = api_key
         self.access_token = access_token
+        self.token_manager = get_token_manager(api_url, api_key, access_token)
         self.get_jwt_token()
 
     class SwanTool:
@@ -58,32 +198,14 @@ class SwanClient:
             # the function that is used to check
             # the JWT and refresh if necessary
             def wrapper(cli, *args, **kwargs):
-                # refresh token 1 minute before expiration
-                if not cli.jwt_token \
-                        or not cli.jwt_token_expiration \
-                        or time.time() > cli.jwt_token_expiration - 60:
-                    cli.get_jwt_token()
+                cli.get_jwt_token()
                 return decorated(cli, *args, **kwargs)
 
             return wrapper
 
     def get_jwt_token(self):
-        logging.info('Refreshing token')
-        refresh_api_token_suffix = "/user/api_keys/jwt"
-        refresh_api_token_method = 'POST'
-
-        refresh_token_url = self.api_url + refresh_api_token_suffix
-        data = {
-            "apikey": self.api_key,
-            "access_token": self.access_token
-        }
-        try:
-            resp_data = send_http_request(refresh_token_url, refresh_api_token_method, None, json.dumps(data))
-            self.jwt_token = resp_data['jwt']
-            payload = jwt.decode(jwt=self.jwt_token, verify=False, algorithm='HS256')
-            self.jwt_token_expiration = payload['exp']
-        except Exception as e:
-            logging.info(str(e))
+        self.jwt_token = self.token_manager.get()
+        self.jwt_token_expiration = self.token_manager.jwt_token_expiration
 
     @SwanTool.refresh_token
     def update_task_by_uuid(self, task_uuid: str, miner_fid: str, csv):
@@ -130,6 +252,42 @@ class SwanClient:
         except Exception as e:
             return e
 
+    def iter_tasks(self, status: str = None, page_size=TASK_PAGE_SIZE, updated_after=None, scan: dict = None):
+        # Yields tasks one page at a time. status and updated_after are sent to the api and checked again here,
+        # since not every api version filters on them; tasks without a readable updated_on are always yielded.
+        # Pages are fetched by offset, so a task leaving or joining the list between two pages shifts the ones
+        # after it and one may be skipped. When that happens, i.e. the total count changed during the scan, scan
+        # (if given) gets complete = False and the caller must not take the scan as having seen every task.
+        offset = 0
+        total = None
+        if scan is not None:
+            scan['complete'] = True
+        while True:
+            self.get_jwt_token()
+            url = self.api_url + "/tasks?limit=%s&offset=%s" % (page_size, offset)
+            if status:
+                url = url + "&status=" + status
+            if updated_after is not None:
+                url = url + "&updated_after=%s" % updated_after
+            response = send_http_request(url, "GET", self.jwt_token, "")
+            tasks = response.get('task') or []
+            task_count = int(response.get('total_task_count') or 0)
+            if total is None:
+                total = task_count
+            elif task_count != total and scan is not None:
+                scan['complete'] = False
+            for task in tasks:
+                if status and task.get("status") != status:
+                    continue
+                if updated_after is not None:
+                    updated_on = task_updated_on(task)
+                    if updated_on is not None and updated_on <= updated_after:
+                        continue
+                yield task
+            offset += len(tasks)
+            if len(tasks) < page_size or offset >= task_count:
+                return
+
     @SwanTool.refresh_token
     def update_offline_deal_details(self, status: str, note: str, deal_id, file_path=None, file_size=None):
         url = self.api_url + "/my_miner/deals/" + str(deal_id)
@@ -138,18 +296,14 @@ class SwanClient:
 
         send_http_request(url, update_offline_deal_details_method, self.jwt_token, body)
 
-    def upload_car_to_ipfs(car_file_path: str,api_ip_address:str):
+    def upload_car_to_ipfs(car_file_path: str,api_ip_address:str, add_params=None, callback=None,
+                           chunk_size=IPFS_CHUNK_SIZE, stall_timeout=IPFS_STALL_TIMEOUT, nocopy=False):
         try:
-            gateway_address = api_ip_address + "/api/v0/add?stream-channels=true&pin=true"
-            with open(car_file_path, "rb") as a_file:
-                file_dict = {"file": a_file}
-                response = requests.post(gateway_address, files=file_dict)
-                if not response:
-                    logging.error("Upload file to ipfs server failed.")
-                    return None
-                car_file_hash = response.json()['Hash']
+            car_file_hash = ipfs_add(api_ip_address, car_file_path, add_params, callback, chunk_size, stall_timeout,
+                                     nocopy)
+            if car_file_hash and nocopy and not ipfs_verify(api_ip_address, car_file_hash, stall_timeout):
+                return None
             return car_file_hash
-
         except Exception as error:
             logging.error(str(error))
             return None
@@ -174,7 +328,7 @@ def send_http_request(url, method, token, payload, file=None):
     if file:
         payload_file = {"file": file}
 
-    with requests.request(url=url, method=method, headers=headers, data=payload, files=payload_file) as r:
+    with http_session.request(method, url, headers=headers, data=payload, files=payload_file) as r:
 
         if r.status_code >= 400:
             raise Exception("response code %s, %s" % (r.status_code, json.loads(r.text).get("message")))
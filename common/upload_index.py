@@ -0,0 +1,39 @@
+import os
+import sqlite3
+import threading
+import time
+
+
+class UploadIndex:
+    # Local record of car files already on the ipfs server, keyed by piece cid and car file size, so the same car
+    # in another task directory or a rerun of upload is found without sending its bytes again. The data cid is
+    # kept for reference only, the same dag in a car written by another tool has other bytes and another address.
+    def __init__(self, path: str):
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS uploads (piece_cid TEXT, data_cid TEXT, ipfs_hash TEXT NOT NULL, '
+                           'car_file_size INTEGER, api_address TEXT NOT NULL, uploaded_at INTEGER NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS uploads_piece_cid ON uploads (api_address, piece_cid)')
+
+    def find(self, api_address: str, piece_cid: str, car_file_size: int):
+        if not piece_cid:
+            return None
+        with self._lock:
+            row = self._conn.execute('SELECT ipfs_hash FROM uploads WHERE api_address = ? AND piece_cid = ? '
+                                     'AND car_file_size = ? ORDER BY uploaded_at DESC LIMIT 1',
+                                     (api_address, piece_cid, int(car_file_size))).fetchone()
+        return row[0] if row else None
+
+    def record(self, api_address: str, piece_cid: str, data_cid: str, ipfs_hash: str, car_file_size=None):
+        with self._lock:
+            self._conn.execute('INSERT INTO uploads (piece_cid, data_cid, ipfs_hash, car_file_size, api_address, '
+                               'uploaded_at) VALUES (?, ?, ?, ?, ?, ?)',
+                               (piece_cid or None, data_cid or None, ipfs_hash, car_file_size, api_address,
+                                int(time.time())))
+
+    def forget(self, api_address: str, ipfs_hash: str):
+        with self._lock:
+            self._conn.execute('DELETE FROM uploads WHERE api_address = ? AND ipfs_hash = ?', (api_address, ipfs_hash))
@@ -8,7 +8,9 @@ import time
 import logging
 from miner_updater.swan_miner_updater import update_miner_info
 from task_sender.deal_sender import send_deals
-from task_sender.swan_task_sender import create_new_task, update_task_by_uuid, generate_car_files, go_generate_car_files,upload_car_files
+from task_sender.swan_task_sender import create_new_task, update_task_by_uuid, generate_car_files, go_generate_car_files,upload_car_files, plan_car_files
+from task_sender.pipeline import run_pipeline
+from task_sender.watcher import watch_input_dir
 
 
 def random_hash(length=6):
@@ -20,7 +22,7 @@ def random_hash(length=6):
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Swan client')
 
-    parser.add_argument('function', metavar='task/deal', choices=['task', 'deal', 'miner', 'car', 'upload','gocar','keygen','encrypt','decrypt','status', 'assign','auto'], type=str, nargs="?",
+    parser.add_argument('function', metavar='task/deal', choices=['task', 'deal', 'miner', 'car', 'upload','gocar','keygen','encrypt','decrypt','status', 'assign','auto','watch','plan','pipeline'], type=str, nargs="?",
                         help='Create new Swan task/Send deal/Update miner info/Generate car file/Get task status')
 
     parser.add_argument('--config', dest='config_path', default="./config.toml",
@@ -46,6 +48,14 @@ if __name__ == '__main__':
     parser.add_argument('--out-decrypted-file', dest='out_decrypted_file', help="Output decrypted file")
     parser.add_argument('--key_file', dest='key_file', help="Input file with .key extention where encrypted password is restored for encryption and decryption")
 
+    parser.add_argument('--jobs', dest='jobs', type=int, help="Number of files processed in parallel (default: car_jobs or upload_jobs in config)")
+
+    parser.add_argument('--plan', dest='plan_path', help="Car/Gocar: plan.json written by the plan function, one car file per bundle")
+    parser.add_argument('--batch', dest='batch', action='store_true',
+                        help="Gocar: run graphsplit once on the whole input dir instead of once per file")
+    parser.add_argument('--upload', dest='upload', action='store_true', default=None,
+                        help="Watch mode: upload new car files as they are generated (default: watch_upload in config)")
+
     parser.add_argument('--task', dest='task_uuid', help="Get task status by uuid.")
     parser.add_argument('--bid', dest='bid_id', help="Bid id")
 
@@ -84,24 +94,48 @@ if __name__ == '__main__':
         subprocess.run((command_line), shell=True)
           
 
-    if args.__getattribute__('function') == 'car':
+    if args.__getattribute__('function') == 'plan':
         input_dir = args.__getattribute__('input_dir')
         if not input_dir:
             print('Please provide --input-dir')
             exit(1)
         out_dir = args.__getattribute__('out_dir')
 
-        generate_car_files(input_dir, config_path, out_dir)
+        plan_car_files(input_dir, config_path, out_dir)
+
+    if args.__getattribute__('function') == 'car':
+        input_dir = args.__getattribute__('input_dir')
+        plan_path = args.__getattribute__('plan_path')
+        if not input_dir and not plan_path:
+            print('Please provide --input-dir or --plan')
+            exit(1)
+        out_dir = args.__getattribute__('out_dir')
+        jobs = args.__getattribute__('jobs')
+
+        generate_car_files(input_dir, config_path, out_dir, jobs, plan_path)
      
     if args.__getattribute__('function') == 'gocar':
+        input_dir = args.__getattribute__('input_dir')
+        plan_path = args.__getattribute__('plan_path')
+        if not input_dir and not plan_path:
+            print('Please provide --input-dir or --plan')
+            exit(1)
+        out_dir = args.__getattribute__('out_dir')
+        batch = args.__getattribute__('batch')
+
+        go_generate_car_files(input_dir, config_path, out_dir, batch, plan_path)
+     
+
+    if args.__getattribute__('function') == 'watch':
         input_dir = args.__getattribute__('input_dir')
         if not input_dir:
             print('Please provide --input-dir')
             exit(1)
         out_dir = args.__getattribute__('out_dir')
+        jobs = args.__getattribute__('jobs')
+        upload = args.__getattribute__('upload')
 
-        go_generate_car_files(input_dir, config_path, out_dir)    
-     
+        watch_input_dir(input_dir, config_path, out_dir, jobs, upload)
 
     if args.__getattribute__('function') == 'upload':
         input_dir = args.__getattribute__('input_dir')
@@ -109,7 +143,24 @@ if __name__ == '__main__':
             print('Please provide --input-dir')
             exit(1)
 
-        upload_car_files(input_dir, config_path)
+        jobs = args.__getattribute__('jobs')
+
+        upload_car_files(input_dir, config_path, jobs)
+
+    if args.__getattribute__('function') == 'pipeline':
+        input_dir = args.__getattribute__('input_dir')
+        if not input_dir:
+            print('Please provide --input-dir')
+            exit(1)
+        input_dir = os.path.abspath(input_dir)
+        task_name = args.__getattribute__('task_name')
+        miner_id = args.__getattribute__('miner_id')
+        out_dir = args.__getattribute__('out_dir')
+        curated_dataset = args.__getattribute__('dataset')
+        description = args.__getattribute__('description')
+
+        if not run_pipeline(input_dir, out_dir, config_path, task_name, curated_dataset, description, miner_id):
+            exit(1)
 
     if args.__getattribute__('function') == 'task':
         input_dir = args.__getattribute__('input_dir')
@@ -1,9 +1,7 @@
 import argparse
 import os
-import time
-import logging
 
-from task_sender.swan_task_sender import get_task_info,get_assigned_tasks,send_autobid_deal,update_assigned_task
+from task_sender.autobid import run_autobid
 
 
 
@@ -25,28 +23,7 @@ if __name__ == '__main__':
 
     if args.__getattribute__('function') == "auto":
         out_dir = args.__getattribute__('out_dir')
-        while True:
-            try:
-                logging.info('Autobid scan start at %s'% int(time.time()))
-                tasks_dict = get_assigned_tasks(config_path)
-                for task in tasks_dict["Assigned tasks"]:
-                    assigned_task = get_task_info(task["uuid"],config_path)
-                    assigned_task_info = assigned_task["task"]
-                    if assigned_task_info:
-                        assigned_miner_id = assigned_task_info['miner_id']
-                        deals = assigned_task['deals']
-                        info_output_csv_path = send_autobid_deal(deals,assigned_miner_id,assigned_task_info,config_path,out_dir)
-                        if info_output_csv_path:
-                            update_assigned_task(config_path, assigned_task_info['uuid'], info_output_csv_path)
-                        else:
-                            continue
-                    time.sleep(30)
-                logging.info('Autobid scan done at %s'% int(time.time()))
-                time.sleep(30)
-            except Exception as e:
-                logging.info('Autobid scan failed at %s'% int(time.time()))
-                logging.error(e)
-                time.sleep(30)
+        run_autobid(config_path, out_dir)
 
 
 
@@ -0,0 +1,185 @@
+import logging
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from common.config import read_config
+from common.http_session import http_session
+from common.swan_client import task_updated_on
+from task_sender.service.ledger import TaskLedger, TASK_PROPOSED, TASK_UPDATED
+from task_sender.swan_task_sender import get_task_info, get_assigned_tasks, send_autobid_deal, update_assigned_task
+
+AUTOBID_POLL_MIN = 10
+AUTOBID_POLL_MAX = 300
+
+
+def process_assigned_task(task_uuid, config_path, out_dir, ledger: TaskLedger = None) -> bool:
+    # True once the deals are out and Swan is updated, False if the task could not be handled yet
+    proposed = ledger.task(task_uuid) if ledger else None
+    if proposed and proposed['status'] == TASK_PROPOSED and os.path.isfile(proposed['info_csv_path'] or ''):
+        # deals went out before but Swan was not told, only retry the status update
+        logging.info('Deals of task %s already sent, updating Swan task only' % task_uuid)
+        info_output_csv_path = proposed['info_csv_path']
+    else:
+        assigned_task = get_task_info(task_uuid, config_path)
+        assigned_task_info = assigned_task["task"]
+        if not assigned_task_info:
+            logging.warning('No task info for %s yet' % task_uuid)
+            return False
+        assigned_miner_id = assigned_task_info['miner_id']
+        deals = assigned_task['deals']
+        info_output_csv_path = send_autobid_deal(deals, assigned_miner_id, assigned_task_info, config_path, out_dir,
+                                                 ledger)
+        if not info_output_csv_path:
+            logging.warning('No deals sent for task %s' % task_uuid)
+            return False
+        if ledger:
+            ledger.record_task(task_uuid, TASK_PROPOSED, info_output_csv_path)
+    update_assigned_task(config_path, task_uuid, info_output_csv_path)
+    if ledger:
+        ledger.record_task(task_uuid, TASK_UPDATED)
+    return True
+
+
+class AutobidScheduler:
+    # Assigned tasks are queued by each scan and run on a thread pool, at most jobs at a time and at most
+    # miner_jobs per miner. A task stays known from the scan that finds it until its worker is done, so later
+    # scans never start it twice. A task that fails is tried again after a delay of its own, from poll_min
+    # doubling up to poll_max with every failure. The poll interval halves down to poll_min while new tasks come
+    # in or tasks get done and doubles up to poll_max otherwise. Scans only ask for tasks updated after
+    # high_water_mark, which never passes a task that was seen but not handled yet, and only moves on after a
+    # scan that saw every task.
+    def __init__(self, config_path, out_dir, jobs=4, miner_jobs=1, poll_min=AUTOBID_POLL_MIN,
+                 poll_max=AUTOBID_POLL_MAX, ledger: TaskLedger = None):
+        self.config_path = config_path
+        self.out_dir = out_dir
+        self.ledger = ledger
+        self.jobs = max(1, int(jobs))
+        self.miner_jobs = max(1, int(miner_jobs))
+        self.poll_min = poll_min
+        self.poll_max = max(poll_min, poll_max)
+        self.interval = poll_min
+        self._executor = ThreadPoolExecutor(max_workers=self.jobs)
+        self._lock = threading.Lock()
+        self._pending = deque()
+        self._known = set()
+        self._running = {}
+        # uuid -> (task, time of the next try, failures so far)
+        self._failed = {}
+        self._done = 0
+        # newest updated_on of complete scans, and updated_on of the tasks found but not handled yet
+        self._scanned_mark = None
+        self._outstanding = {}
+        self._wakeup = threading.Event()
+
+    @property
+    def high_water_mark(self):
+        with self._lock:
+            mark = self._scanned_mark
+            waiting = [updated_on for updated_on in self._outstanding.values() if updated_on is not None]
+            if mark is not None and waiting:
+                mark = min(mark, min(waiting) - 1)
+            return mark
+
+    def scan(self) -> int:
+        # Only tasks changed since the last scan come back, failed ones are queued again from _failed once their
+        # delay is over. Returns the number of new tasks queued.
+        tasks_dict = get_assigned_tasks(self.config_path, self.high_water_mark)
+        # Swan may list a task as Assigned for a while after it was updated
+        updated = self.ledger.tasks_with_status(TASK_UPDATED) if self.ledger else set()
+        queued = 0
+        now = time.time()
+        with self._lock:
+            for task_uuid, (task, retry_at, _) in list(self._failed.items()):
+                # a task tried again stays in _failed until it is done, with its failure count
+                if retry_at <= now and task_uuid not in self._known:
+                    self._known.add(task_uuid)
+                    self._pending.append(task)
+            for task in tasks_dict["Assigned tasks"]:
+                if task["uuid"] in self._known or task["uuid"] in self._failed or task["uuid"] in updated:
+                    continue
+                self._known.add(task["uuid"])
+                self._outstanding[task["uuid"]] = task_updated_on(task)
+                self._pending.append(task)
+                queued += 1
+            if tasks_dict.get('complete', True) and tasks_dict['high_water_mark'] is not None:
+                self._scanned_mark = max(self._scanned_mark or 0, tasks_dict['high_water_mark'])
+        self._dispatch()
+        return queued
+
+    def _dispatch(self):
+        with self._lock:
+            waiting = deque()
+            while self._pending and sum(self._running.values()) < self.jobs:
+                task = self._pending.popleft()
+                miner_id = task["miner_id"]
+                if self._running.get(miner_id, 0) >= self.miner_jobs:
+                    waiting.append(task)
+                    continue
+                self._running[miner_id] = self._running.get(miner_id, 0) + 1
+                self._executor.submit(self._run, task)
+            self._pending.extendleft(reversed(waiting))
+
+    def _run(self, task):
+        try:
+            logging.info('Autobid task %s for miner %s start' % (task["uuid"], task["miner_id"]))
+            handled = process_assigned_task(task["uuid"], self.config_path, self.out_dir, self.ledger)
+        except Exception as e:
+            logging.error('Autobid task %s failed: %s' % (task["uuid"], e))
+            handled = False
+        with self._lock:
+            failures = self._failed.pop(task["uuid"], (None, None, 0))[2]
+            if handled:
+                logging.info('Autobid task %s done' % task["uuid"])
+                self._outstanding.pop(task["uuid"], None)
+                self._done += 1
+            else:
+                # tried again by a scan after the delay, the mark stays below it meanwhile
+                delay = min(self.poll_max, self.poll_min * 2 ** failures)
+                logging.info('Autobid task %s tried again in %ss' % (task["uuid"], delay))
+                self._failed[task["uuid"]] = (task, time.time() + delay, failures + 1)
+            self._running[task["miner_id"]] -= 1
+            self._known.discard(task["uuid"])
+        self._dispatch()
+        self._wakeup.set()
+
+    def run_forever(self):
+        while True:
+            try:
+                logging.info('Autobid scan start at %s' % int(time.time()))
+                queued = self.scan()
+                logging.info('Autobid scan done at %s, %s new task(s), %s running, %s queued' % (
+                    int(time.time()), queued, sum(self._running.values()), len(self._pending)))
+                http_session.stats.log()
+            except Exception as e:
+                logging.info('Autobid scan failed at %s' % int(time.time()))
+                logging.error(e)
+                queued = 0
+            self.wait(queued)
+
+    def wait(self, queued: int):
+        with self._lock:
+            done, self._done = self._done, 0
+        if queued or done:
+            self.interval = max(self.poll_min, self.interval / 2)
+        else:
+            self.interval = min(self.poll_max, self.interval * 2)
+        # a finished task frees a slot, so the next scan may start early, but never before poll_min
+        self._wakeup.clear()
+        time.sleep(self.poll_min)
+        if self.interval > self.poll_min:
+            self._wakeup.wait(self.interval - self.poll_min)
+
+
+def run_autobid(config_path, out_dir):
+    sender = read_config(config_path)['sender']
+    ledger_path = sender.get('autobid_ledger') or os.path.join(out_dir or sender['output_dir'], 'autobid-ledger.db')
+    scheduler = AutobidScheduler(config_path, out_dir,
+                                 jobs=sender.get('autobid_jobs', 4),
+                                 miner_jobs=sender.get('autobid_miner_jobs', 1),
+                                 poll_min=sender.get('autobid_poll_min', AUTOBID_POLL_MIN),
+                                 poll_max=sender.get('autobid_poll_max', AUTOBID_POLL_MAX),
+                                 ledger=TaskLedger(ledger_path))
+    scheduler.run_forever()
@@ -1,30 +1,38 @@
 import logging.config
 
+from task_sender.service.ask_cache import configure_ask_cache
 from task_sender.service.deal import DealConfig, send_deals_to_miner
+from task_sender.service.job_store import load_job_store
 from common.config import read_config
+from common.lotus import configure_lotus
 
 logging.basicConfig(level=logging.INFO)
 
 
+def load_deal_config(config, miner_id) -> DealConfig:
+    sender = config['sender']
+    return DealConfig(miner_id, sender['wallet'], sender['max_price'], sender['verified_deal'], sender['fast_retrieval'],
+                      sender['start_epoch_hours'], None)
+
+
 def send_deals(config_path, miner_id, task_name=None, metadata_csv_path=None, deal_list=None, task_uuid=None, out_dir=None):
     config = read_config(config_path)
-    from_wallet = config['sender']['wallet']
-    max_price = config['sender']['max_price']
-    verified_deal = config['sender']['verified_deal']
-    fast_retrieval = config['sender']['fast_retrieval']
-    epoch_interval_hours = config['sender']['start_epoch_hours']
+    configure_lotus(config)
+    configure_ask_cache(config)
     skip_confirmation = config['sender']['skip_confirmation']
+    jobs = config['sender'].get('deal_jobs', 1)
 
     output_dir = out_dir
     if not out_dir:
         output_dir = config['sender']['output_dir']
 
-    deal_config = DealConfig(miner_id, from_wallet, max_price, verified_deal, fast_retrieval, epoch_interval_hours,None)
+    deal_config = load_deal_config(config, miner_id)
+    store = load_job_store(config)
 
     if deal_list:
-        return send_deals_to_miner(deal_config, output_dir, skip_confirmation, task_name=task_name, deal_list=deal_list, task_uuid=task_uuid)
+        return send_deals_to_miner(deal_config, output_dir, skip_confirmation, task_name=task_name, deal_list=deal_list, task_uuid=task_uuid, jobs=jobs, store=store)
     elif metadata_csv_path:
-        return send_deals_to_miner(deal_config, output_dir, skip_confirmation, csv_file_path=metadata_csv_path, task_uuid=task_uuid)
+        return send_deals_to_miner(deal_config, output_dir, skip_confirmation, csv_file_path=metadata_csv_path, task_uuid=task_uuid, jobs=jobs, store=store)
     else:
         logging.error("no valid deal list or metadata_csv provided")
 
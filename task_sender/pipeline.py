@@ -0,0 +1,265 @@
+import csv
+import logging
+import os
+import queue
+import shutil
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import List
+
+from common.OfflineDeal import OfflineDeal
+from common.config import read_config
+from common.lotus import configure_lotus, size_str
+from task_sender.deal_sender import load_deal_config
+from task_sender.service.ask_cache import configure_ask_cache
+from task_sender.service.car_cache import load_car_cache
+from task_sender.service.deal import EPOCH_PER_HOUR, get_current_epoch_by_current_time, make_proposer, propose_deals, \
+    recording_proposer, skip_proposed, write_deals_csv
+from task_sender.service.job_store import load_job_store
+from task_sender.service.planner import estimate_car_size
+from task_sender.service.uploader import IpfsUploader
+from task_sender.swan_task_sender import CAR_CSV_FIELDNAMES, cached_car_row, read_file_path_in_dir, submit_task, \
+    web_server_url_prefix
+
+PIPELINE_QUEUE_SIZE = 4
+PIPELINE_MIN_FREE = 10 * 1024 ** 3
+DISK_WAIT = 30
+# longest wait for free space while no other car is being written, nothing in the pipeline frees it then
+DISK_WAIT_MAX = 3600
+
+STAGE_CAR = 'car'
+STAGE_UPLOAD = 'upload'
+
+_DONE = object()
+
+
+class Pipeline:
+    # Streams every source file through car generation and upload as soon as the stage before is done with it,
+    # instead of each stage waiting for the whole directory. The stages are thread pools joined by a queue of at
+    # most queue_size files, so a slow upload holds back car generation rather than letting car files pile up,
+    # and car generation also waits while the out dir would have less than min_free bytes left. Deals are only
+    # proposed once every file is uploaded, so a file that fails never leaves deals behind that no task holds;
+    # the task is then created on Swan with all of them, as the task command does.
+    def __init__(self, config, input_dir, out_dir, task_name, curated_dataset=None, description=None, miner_id=None,
+                 queue_size=PIPELINE_QUEUE_SIZE, min_free=PIPELINE_MIN_FREE):
+        self.config = config
+        self.input_dir = input_dir
+        self.out_dir = out_dir
+        self.task_name = task_name
+        self.curated_dataset = curated_dataset
+        self.description = description
+        self.miner_id = miner_id
+        self.min_free = min_free
+        self.task_uuid = str(uuid.uuid4())
+
+        sender = config['sender']
+        self.car_jobs = max(1, int(sender.get('car_jobs', 1)))
+        self.upload_jobs = max(1, int(sender.get('upload_jobs', 1)))
+        # the confirmation prompt needs the terminal, so deals wait for each other when it is on
+        self.deal_jobs = max(1, int(sender.get('deal_jobs', 1))) if sender['skip_confirmation'] else 1
+        self.generate_md5 = sender['generate_md5']
+        self.start_epoch_hours = sender['start_epoch_hours']
+        self.public_deal = sender['public_deal']
+        self.cache = load_car_cache(config)
+        self.store = load_job_store(config)
+        if self.store and miner_id and not self.public_deal:
+            # deals of an earlier run into the same out dir that never made it into a task keep their uuid
+            self.task_uuid = self.store.pending_task_uuid(out_dir, miner_id) or self.task_uuid
+        self.web_server = config['main']['storage_server_type'] == "web server"
+        self.uploader = None if self.web_server else IpfsUploader(config)
+        self.download_url_prefix = web_server_url_prefix(config) if self.web_server else None
+
+        self._upload_queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._files = None
+        self._deals: List[OfflineDeal] = []
+        self._rows = {}
+        self._uploaded = set()
+        self._failed = {}
+        # bytes of car files being written that the free space does not show yet
+        self._reserved = 0
+
+    def _fail(self, stage: str, index: int, message):
+        logging.error("%s of %s failed: %s" % (stage, self._deals[index].source_file_path, message))
+        with self._lock:
+            self._failed.setdefault(stage, []).append(self._deals[index].source_file_name)
+
+    def _reserve_disk(self, needed: int):
+        # Every car worker books the estimated size of its car before writing it, so workers starting together
+        # cannot all take the same free space. Raises if the car can never fit, or if the space is still missing
+        # after DISK_WAIT_MAX seconds in which no other car was written.
+        total = shutil.disk_usage(self.out_dir).total
+        if needed + self.min_free > total:
+            raise Exception("a car of about %s with %s kept free does not fit in %s of %s" % (
+                size_str(needed), size_str(self.min_free), size_str(total), self.out_dir))
+        waiting = False
+        alone_since = None
+        while True:
+            with self._lock:
+                free = shutil.disk_usage(self.out_dir).free - self._reserved
+                if free - needed >= self.min_free:
+                    self._reserved += needed
+                    break
+                alone = self._reserved == 0
+            if not alone:
+                alone_since = None
+            elif alone_since is None:
+                alone_since = time.time()
+            elif time.time() - alone_since >= DISK_WAIT_MAX:
+                raise Exception("only %s free in %s after waiting %ss, %s needed" % (
+                    size_str(free), self.out_dir, DISK_WAIT_MAX, size_str(self.min_free + needed)))
+            if not waiting:
+                logging.warning("Only %s free in %s, car generation waits until %s are free" % (
+                    size_str(free), self.out_dir, size_str(self.min_free + needed)))
+                waiting = True
+            time.sleep(DISK_WAIT)
+        if waiting:
+            logging.info("%s free in %s, generating car files again" % (size_str(free), self.out_dir))
+
+    def _release_disk(self, reserved: int):
+        with self._lock:
+            self._reserved -= reserved
+
+    def _car_worker(self):
+        while True:
+            with self._lock:
+                index = next(self._files, None)
+            if index is None:
+                return
+            _deal = self._deals[index]
+            needed = estimate_car_size(int(_deal.source_file_size))
+            try:
+                self._reserve_disk(needed)
+            except Exception as e:
+                self._fail(STAGE_CAR, index, e)
+                continue
+            try:
+                row = cached_car_row(_deal, self.out_dir, self.cache)
+                for attr in ('car_file_name', 'car_file_path', 'piece_cid', 'data_cid', 'car_file_size',
+                             'car_file_md5', 'source_file_md5'):
+                    _deal.__setattr__(attr, row[attr])
+                self._rows[index] = row
+                if self.store:
+                    self.store.prepare(row, index)
+            except Exception as e:
+                self._fail(STAGE_CAR, index, e)
+                continue
+            finally:
+                # the written car now shows in the free space
+                self._release_disk(needed)
+            # blocks while the uploads are queue_size files behind
+            self._upload_queue.put(index)
+
+    def _upload(self, index: int):
+        _deal = self._deals[index]
+        # a car file uploaded by an earlier run with the same cids keeps its address
+        known = self.store.file(_deal.car_file_path) if self.store else None
+        if known and known['car_file_url']:
+            _deal.car_file_url = known['car_file_url']
+        elif self.web_server:
+            _deal.car_file_url = os.path.join(self.download_url_prefix, _deal.car_file_name)
+        else:
+            car_file_address, _ = self.uploader.upload(_deal.car_file_name, _deal.car_file_path,
+                                                       _deal.piece_cid, _deal.data_cid)
+            if not car_file_address:
+                raise Exception("no address from the ipfs server")
+            _deal.car_file_url = car_file_address
+            if self.store:
+                self.store.uploaded(_deal.car_file_path, car_file_address)
+        self._rows[index]['car_file_url'] = _deal.car_file_url
+        _deal.start_epoch = get_current_epoch_by_current_time() + (self.start_epoch_hours + 1) * EPOCH_PER_HOUR
+
+    def _upload_worker(self):
+        # a failing file never ends the worker, the car workers would wait on a full queue forever
+        while True:
+            index = self._upload_queue.get()
+            if index is _DONE:
+                return
+            try:
+                self._upload(index)
+            except Exception as e:
+                self._fail(STAGE_UPLOAD, index, e)
+                continue
+            with self._lock:
+                self._uploaded.add(index)
+
+    def _start(self, target, count: int) -> list:
+        threads = [threading.Thread(target=target, daemon=True) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def run(self) -> bool:
+        for file_path in read_file_path_in_dir(self.input_dir):
+            offline_deal = OfflineDeal()
+            offline_deal.source_file_name = os.path.basename(file_path)
+            offline_deal.source_file_path = file_path
+            offline_deal.source_file_size = os.path.getsize(file_path)
+            if self.generate_md5:
+                offline_deal.car_file_md5 = True
+            self._deals.append(offline_deal)
+        self._files = iter(range(len(self._deals)))
+
+        logging.info("Pipeline for %s files: %s car, %s upload worker(s)" % (
+            len(self._deals), self.car_jobs, self.upload_jobs))
+        start_time = time.time()
+        car_threads = self._start(self._car_worker, self.car_jobs)
+        upload_threads = self._start(self._upload_worker, self.upload_jobs)
+        for thread in car_threads:
+            thread.join()
+        for _ in upload_threads:
+            self._upload_queue.put(_DONE)
+        for thread in upload_threads:
+            thread.join()
+        logging.info("Generated and uploaded %s/%s files in %.1fs" % (
+            len(self._uploaded), len(self._deals), time.time() - start_time))
+
+        self.write_car_csv()
+        if self._failed:
+            for stage, names in self._failed.items():
+                logging.error("%s failed for %s file(s): %s" % (stage, len(names), ", ".join(names)))
+            logging.error("No deals sent and no task created, car.csv in %s holds the files that got through"
+                          % self.out_dir)
+            return False
+
+        deal_list = self._deals
+        if not self.public_deal:
+            configure_lotus(self.config)
+            configure_ask_cache(self.config)
+            propose = make_proposer(load_deal_config(self.config, self.miner_id),
+                                    self.config['sender']['skip_confirmation'])
+            pending = deal_list
+            if self.store:
+                pending = skip_proposed(deal_list, self.store, self.miner_id, self.task_uuid)
+                propose = recording_proposer(propose, self.store, self.miner_id, self.task_uuid)
+            # a deal that fails is logged and the task still goes out with the others, as with the task command
+            propose_deals(propose, pending, self.deal_jobs)
+            write_deals_csv(deal_list, os.path.join(self.out_dir, self.task_name + "-deals.csv"), self.miner_id,
+                            self.task_uuid)
+        submit_task(self.config, self.task_name, self.curated_dataset, self.description, self.miner_id, deal_list,
+                    self.out_dir, self.task_uuid, self.store)
+        return True
+
+    def write_car_csv(self):
+        # same car.csv as car and upload write, in the order of the input files
+        with open(os.path.join(self.out_dir, "car.csv"), "w") as csv_file:
+            csv_writer = csv.DictWriter(csv_file, delimiter=',', fieldnames=CAR_CSV_FIELDNAMES)
+            csv_writer.writeheader()
+            for index in sorted(self._rows):
+                csv_writer.writerow(self._rows[index])
+
+
+def run_pipeline(input_dir, out_dir, config_path, task_name, curated_dataset, description, miner_id=None):
+    config = read_config(config_path)
+    sender = config['sender']
+    if not sender['public_deal'] and not miner_id:
+        print('Please provide --miner for non public deal.')
+        exit(1)
+    output_dir = out_dir or sender['output_dir'] + '/' + str(uuid.uuid4())
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+    pipeline = Pipeline(config, input_dir, output_dir, task_name, curated_dataset, description, miner_id,
+                        queue_size=sender.get('pipeline_queue', PIPELINE_QUEUE_SIZE),
+                        min_free=sender.get('pipeline_min_free', PIPELINE_MIN_FREE))
+    return pipeline.run()
@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+DEFAULT_ASK_TTL = 600
+
+
+class AskCache:
+    # Storage asks keyed by miner id. Concurrent lookups of the same miner share one query, and only
+    # successful asks are cached, so a miner that timed out is queried again on the next call.
+    def __init__(self, ttl=DEFAULT_ASK_TTL, path=None):
+        self.ttl = ttl
+        self.path = path
+        self._asks = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def configure(self, ttl=None, path=None):
+        with self._lock:
+            if ttl is not None:
+                self.ttl = ttl
+            if path is not None:
+                self.path = os.path.expanduser(path) if path else None
+
+    def get(self, miner_id: str, query):
+        while True:
+            with self._lock:
+                ask = self._fresh(miner_id)
+                if ask is not None:
+                    return ask
+                pending = self._pending.get(miner_id)
+                if pending is None:
+                    pending = self._pending[miner_id] = threading.Event()
+                    break
+            # another thread is querying this miner, use its result once it is done
+            pending.wait()
+
+        try:
+            ask = self._load(miner_id)
+            if ask is None:
+                ask = query(miner_id)
+                if ask is not None:
+                    self._save(miner_id, ask)
+            with self._lock:
+                if ask is not None:
+                    self._asks[miner_id] = (time.time(), ask)
+            return ask
+        finally:
+            with self._lock:
+                del self._pending[miner_id]
+            pending.set()
+
+    def invalidate(self, miner_id: str):
+        with self._lock:
+            self._asks.pop(miner_id, None)
+
+    def _fresh(self, miner_id: str):
+        cached = self._asks.get(miner_id)
+        if cached and time.time() - cached[0] < self.ttl:
+            return cached[1]
+        return None
+
+    def _read_file(self) -> dict:
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring unreadable ask cache %s: %s' % (self.path, e))
+            return {}
+
+    def _load(self, miner_id: str):
+        if not self.path:
+            return None
+        entry = self._read_file().get(miner_id)
+        if entry and time.time() - entry['time'] < self.ttl:
+            with self._lock:
+                self._asks[miner_id] = (entry['time'], entry['ask'])
+            logging.info('Using cached ask of miner %s' % miner_id)
+            return entry['ask']
+        return None
+
+    def _save(self, miner_id: str, ask):
+        if not self.path:
+            return
+        # read-modify-replace, the rename keeps the file valid for other processes reading it
+        try:
+            asks = self._read_file()
+            asks[miner_id] = {'time': time.time(), 'ask': ask}
+            now = time.time()
+            asks = {k: v for k, v in asks.items() if now - v.get('time', 0) < self.ttl}
+            cache_dir = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(cache_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix='.ask-cache-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(asks, f)
+            os.replace(tmp_path, self.path)
+        except OSError as e:
+            logging.warning('Failed to write ask cache %s: %s' % (self.path, e))
+
+
+ask_cache = AskCache()
+
+
+def configure_ask_cache(config):
+    sender = config.get('sender', {})
+    ask_cache.configure(sender.get('ask_cache_ttl', DEFAULT_ASK_TTL), sender.get('ask_cache_path', ''))
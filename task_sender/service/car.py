@@ -0,0 +1,195 @@
+import hashlib
+import logging
+import os
+
+from task_sender.service.cid import CODEC_RAW, CODEC_DAG_PB, MULTIHASH_SHA2_256, encode_varint, make_cid, cid_to_str
+from task_sender.service.digest import read_once
+
+# same dag layout parameters as lotus import and go-graphsplit
+UNIXFS_CHUNK_SIZE = 1 << 20
+UNIXFS_LINKS_PER_LEVEL = 1 << 10
+
+UNIXFS_TYPE_DIRECTORY = 1
+UNIXFS_TYPE_FILE = 2
+
+WRITE_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+def _pb_bytes(field: int, value: bytes) -> bytes:
+    return encode_varint(field << 3 | 2) + encode_varint(len(value)) + value
+
+
+def _pb_varint(field: int, value: int) -> bytes:
+    return encode_varint(field << 3) + encode_varint(value)
+
+
+def _cbor_head(major: int, value: int) -> bytes:
+    if value < 24:
+        return bytes((major << 5 | value,))
+    for info, length in ((24, 1), (25, 2), (26, 4), (27, 8)):
+        if value < 1 << (8 * length):
+            return bytes((major << 5 | info,)) + value.to_bytes(length, 'big')
+
+
+def encode_car_header(root: bytes) -> bytes:
+    # dag-cbor {"roots": [root], "version": 1}, keys in canonical (length first) order
+    cid_tag = b'\xd8\x2a' + _cbor_head(2, len(root) + 1) + b'\x00' + root
+    header = _cbor_head(5, 2) + _cbor_head(3, 5) + b'roots' + _cbor_head(4, 1) + cid_tag + \
+        _cbor_head(3, 7) + b'version' + _cbor_head(0, 1)
+    return encode_varint(len(header)) + header
+
+
+def encode_unixfs(node_type: int, data: bytes = None, file_size: int = None, block_sizes=()) -> bytes:
+    out = _pb_varint(1, node_type)
+    if data:
+        out += _pb_bytes(2, data)
+    if file_size is not None:
+        out += _pb_varint(3, file_size)
+    for block_size in block_sizes:
+        out += _pb_varint(4, block_size)
+    return out
+
+
+def encode_dag_pb(links, data: bytes) -> bytes:
+    # links are (cid, name, tsize); dag-pb puts Links (field 2) before Data (field 1)
+    out = b''
+    for cid, name, tsize in links:
+        link = _pb_bytes(1, cid)
+        if name is not None:
+            link += _pb_bytes(2, name.encode('utf-8'))
+        link += _pb_varint(3, tsize)
+        out += _pb_bytes(2, link)
+    return out + _pb_bytes(1, data)
+
+
+class DagLink:
+    def __init__(self, cid: bytes, tsize: int, file_size: int):
+        self.cid = cid
+        self.tsize = tsize
+        self.file_size = file_size
+
+
+class CarWriter:
+    """Streaming UnixFS/CARv1 writer.
+
+    File content fed through update() is cut into 1 MiB raw leaves and linked
+    into a balanced tree of at most 1024 links per node, written to the CAR
+    as it is built. Only the pending links of each tree level stay in memory.
+    The header holding the root CID has a fixed length, so it is written as a
+    placeholder first and rewritten by close().
+    """
+
+    def __init__(self, car_file_path: str, chunk_size=UNIXFS_CHUNK_SIZE, links_per_level=UNIXFS_LINKS_PER_LEVEL):
+        self.car_file_path = car_file_path
+        self.chunk_size = chunk_size
+        self.links_per_level = links_per_level
+        self.car_file = open(car_file_path, 'wb', buffering=WRITE_BUFFER_SIZE)
+        self.car_file.write(encode_car_header(make_cid(CODEC_DAG_PB, MULTIHASH_SHA2_256, bytes(32))))
+        self._chunk = bytearray()
+        self._levels = [[]]
+
+    def write_block(self, codec: int, data: bytes) -> bytes:
+        cid = make_cid(codec, MULTIHASH_SHA2_256, hashlib.sha256(data).digest())
+        self.car_file.write(encode_varint(len(cid) + len(data)))
+        self.car_file.write(cid)
+        self.car_file.write(data)
+        return cid
+
+    def update(self, data):
+        self._chunk += data
+        while len(self._chunk) >= self.chunk_size:
+            leaf = bytes(self._chunk[:self.chunk_size])
+            del self._chunk[:self.chunk_size]
+            self._add_leaf(leaf)
+
+    def _add_leaf(self, leaf: bytes):
+        cid = self.write_block(CODEC_RAW, leaf)
+        self._push(0, DagLink(cid, len(leaf), len(leaf)))
+
+    def _push(self, level: int, link: DagLink):
+        if level == len(self._levels):
+            self._levels.append([])
+        if len(self._levels[level]) == self.links_per_level:
+            # only flush a full level once more data arrives, so an exactly full level can become the root
+            self._push(level + 1, self._write_file_node(self._levels[level]))
+            self._levels[level] = []
+        self._levels[level].append(link)
+
+    def _write_file_node(self, links) -> DagLink:
+        file_size = sum(link.file_size for link in links)
+        data = encode_unixfs(UNIXFS_TYPE_FILE, file_size=file_size, block_sizes=[link.file_size for link in links])
+        node = encode_dag_pb([(link.cid, '', link.tsize) for link in links], data)
+        cid = self.write_block(CODEC_DAG_PB, node)
+        return DagLink(cid, len(node) + sum(link.tsize for link in links), file_size)
+
+    def finish_file(self) -> DagLink:
+        if self._chunk or not any(self._levels):
+            self._add_leaf(bytes(self._chunk))
+            self._chunk = bytearray()
+        root = None
+        level = 0
+        while level < len(self._levels):
+            links = self._levels[level]
+            if root:
+                if len(links) == self.links_per_level:
+                    self._push(level + 1, self._write_file_node(links))
+                    links = self._levels[level] = []
+                links.append(root)
+            if level == len(self._levels) - 1 and len(links) == 1:
+                root = links[0]
+            elif links:
+                root = self._write_file_node(links)
+            else:
+                root = None
+            level += 1
+        self._levels = [[]]
+        return root
+
+    def write_directory(self, entries) -> DagLink:
+        # entries are (name, DagLink) of finished files; a flat unixfs directory with links sorted by name,
+        # as ipfs builds it
+        entries = sorted(entries, key=lambda entry: entry[0].encode('utf-8'))
+        node = encode_dag_pb([(link.cid, name, link.tsize) for name, link in entries],
+                             encode_unixfs(UNIXFS_TYPE_DIRECTORY))
+        cid = self.write_block(CODEC_DAG_PB, node)
+        return DagLink(cid, len(node) + sum(link.tsize for _, link in entries),
+                       sum(link.file_size for _, link in entries))
+
+    def close(self, root: DagLink) -> str:
+        self.car_file.seek(0)
+        self.car_file.write(encode_car_header(root.cid))
+        self.car_file.close()
+        return cid_to_str(root.cid)
+
+    def abort(self):
+        self.car_file.close()
+
+
+def write_car(input_path: str, car_file_path: str, consumers=()) -> str:
+    logging.info('Generating car file from: %s' % input_path)
+    writer = CarWriter(car_file_path)
+    try:
+        read_once(input_path, [writer] + list(consumers))
+        data_cid = writer.close(writer.finish_file())
+    except Exception:
+        writer.abort()
+        raise
+    logging.info('Data CID: %s' % data_cid)
+    return data_cid
+
+
+def write_bundle_car(input_paths, car_file_path: str) -> str:
+    # several files in one car under a directory root, each file keeps the dag it would have on its own
+    logging.info('Generating car file from %s files: %s' % (len(input_paths), car_file_path))
+    writer = CarWriter(car_file_path)
+    try:
+        entries = []
+        for input_path in input_paths:
+            read_once(input_path, [writer])
+            entries.append((os.path.basename(input_path), writer.finish_file()))
+        data_cid = writer.close(writer.write_directory(entries))
+    except Exception:
+        writer.abort()
+        raise
+    logging.info('Data CID: %s' % data_cid)
+    return data_cid
@@ -0,0 +1,84 @@
+import logging
+import os
+import shutil
+import threading
+
+from fileson.logdict import LogDict
+
+# the log is rewritten once it holds this many times more entries than live keys
+COMPACT_RATIO = 4
+
+
+class CarCache:
+    # Car rows already computed for a source file, keyed by generator and absolute path. An entry is only used
+    # while the source keeps its size, mtime and inode and its car files still exist with the recorded size,
+    # so a changed file is always converted again. Stored as a fileson LogDict, one json line per change.
+    def __init__(self, path: str):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        self._lock = threading.Lock()
+        entries = LogDict.load(self.path)
+        if len(entries.log) > COMPACT_RATIO * max(len(entries), 1):
+            self._compact(entries)
+        self._entries = LogDict.load(self.path, logging=True)
+
+    def _compact(self, entries: LogDict):
+        tmp_path = self.path + '.tmp'
+        LogDict(entries).save(tmp_path)
+        os.replace(tmp_path, self.path)
+
+    @staticmethod
+    def _key(mode: str, source_file_path: str) -> str:
+        return '%s:%s' % (mode, os.path.abspath(source_file_path))
+
+    @staticmethod
+    def _identity(source_file_path: str) -> list:
+        st = os.stat(source_file_path)
+        return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+    def get(self, mode: str, source_file_path: str, target_dir: str, md5=False):
+        # cached rows with car files placed in target_dir, or None if the source must be converted again
+        with self._lock:
+            entry = self._entries.get(self._key(mode, source_file_path))
+        if not entry or entry['identity'] != self._identity(source_file_path):
+            return None
+        rows = entry['rows']
+        if md5 and not all(row['car_file_md5'] for row in rows):
+            return None
+        for row in rows:
+            if not os.path.isfile(row['car_file_path']) or os.path.getsize(row['car_file_path']) != row['car_file_size']:
+                return None
+
+        placed = []
+        for row in rows:
+            row = dict(row)
+            car_file_path = os.path.join(target_dir, row['car_file_name'])
+            if not os.path.exists(car_file_path) or not os.path.samefile(car_file_path, row['car_file_path']):
+                place_file(row['car_file_path'], car_file_path)
+            row['car_file_path'] = car_file_path
+            if not md5:
+                row['car_file_md5'] = ''
+                row['source_file_md5'] = ''
+            placed.append(row)
+        return placed
+
+    def put(self, mode: str, source_file_path: str, rows: list):
+        entry = {'identity': self._identity(source_file_path), 'rows': rows}
+        with self._lock:
+            self._entries[self._key(mode, source_file_path)] = entry
+
+
+def place_file(src: str, dst: str):
+    # a hard link costs nothing, a copy is still cheaper than computing the cids again
+    try:
+        if os.path.exists(dst):
+            os.remove(dst)
+        os.link(src, dst)
+    except OSError:
+        logging.info('Cannot link %s, copying it to %s' % (src, dst))
+        shutil.copyfile(src, dst)
+
+
+def load_car_cache(config):
+    path = config['sender'].get('car_cache')
+    return CarCache(path) if path else None
@@ -0,0 +1,32 @@
+import base64
+
+CODEC_RAW = 0x55
+CODEC_DAG_PB = 0x70
+CODEC_DAG_CBOR = 0x71
+CODEC_FIL_COMMITMENT_UNSEALED = 0xf101
+
+MULTIHASH_SHA2_256 = 0x12
+MULTIHASH_SHA2_256_TRUNC254_PADDED = 0x1012
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def make_cid(codec: int, multihash_code: int, digest: bytes) -> bytes:
+    # binary CIDv1: <version><codec><multihash code><digest length><digest>
+    return encode_varint(1) + encode_varint(codec) + encode_varint(multihash_code) + encode_varint(
+        len(digest)) + digest
+
+
+def cid_to_str(cid: bytes) -> str:
+    # multibase 'b' prefix: lowercase RFC 4648 base32 without padding
+    return 'b' + base64.b32encode(cid).decode('ascii').lower().rstrip('=')
@@ -0,0 +1,170 @@
+import hashlib
+import multiprocessing
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from task_sender.service.cid import CODEC_FIL_COMMITMENT_UNSEALED, MULTIHASH_SHA2_256_TRUNC254_PADDED, make_cid, \
+    cid_to_str
+from task_sender.service.digest import read_once
+
+NODE_SIZE = 32
+# every 127 bytes of data become 4 field elements (4 * 254 bits) of 32 bytes after Fr32 padding
+FR32_UNPADDED_CHUNK = 127
+FR32_PADDED_CHUNK = 128
+FR32_MASK = (1 << 254) - 1
+
+# data is hashed in independent subtrees of 4 MiB padded (2^17 leaves) so they can run in parallel
+SEGMENT_PADDED_SIZE = 4 * 1024 * 1024
+SEGMENT_UNPADDED_SIZE = SEGMENT_PADDED_SIZE // FR32_PADDED_CHUNK * FR32_UNPADDED_CHUNK
+SEGMENT_LEVEL = (SEGMENT_PADDED_SIZE // NODE_SIZE).bit_length() - 1
+
+
+def _hash_node(left: bytes, right: bytes) -> bytes:
+    # sha256-trunc254-padded: the two most significant bits of the last byte are cleared
+    digest = hashlib.sha256(left + right).digest()
+    return digest[:31] + bytes((digest[31] & 0x3f,))
+
+
+def _zero_roots():
+    roots = [bytes(NODE_SIZE)]
+    for _ in range(64):
+        roots.append(_hash_node(roots[-1], roots[-1]))
+    return roots
+
+
+ZERO_ROOTS = _zero_roots()
+
+
+def fr32_pad(data: bytes) -> bytes:
+    padded = bytearray()
+    for offset in range(0, len(data), FR32_UNPADDED_CHUNK):
+        value = int.from_bytes(data[offset:offset + FR32_UNPADDED_CHUNK], 'little')
+        for _ in range(4):
+            padded += (value & FR32_MASK).to_bytes(NODE_SIZE, 'little')
+            value >>= 254
+    return bytes(padded)
+
+
+def merkle_root(padded: bytes) -> bytes:
+    level = [padded[i:i + NODE_SIZE] for i in range(0, len(padded), NODE_SIZE)]
+    while len(level) > 1:
+        level = [_hash_node(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0]
+
+
+def segment_root(data: bytes) -> bytes:
+    return merkle_root(fr32_pad(data))
+
+
+def padded_piece_size(size: int) -> int:
+    padded_size = max(1, (size + FR32_UNPADDED_CHUNK - 1) // FR32_UNPADDED_CHUNK) * FR32_PADDED_CHUNK
+    return 1 << (padded_size - 1).bit_length()
+
+
+def unpadded_piece_size(padded_size: int) -> int:
+    return padded_size - padded_size // FR32_PADDED_CHUNK
+
+
+def piece_cid_from_root(root: bytes) -> str:
+    return cid_to_str(make_cid(CODEC_FIL_COMMITMENT_UNSEALED, MULTIHASH_SHA2_256_TRUNC254_PADDED, root))
+
+
+_pool = None
+_pool_slots = None
+_pool_lock = threading.Lock()
+
+
+def commp_pool():
+    # One process pool of cpu_count workers for every CommP of the process, so car files generated in parallel
+    # share the cores instead of each forking a pool of its own. The slots bound the segments waiting in it.
+    # The pool is first used from car worker threads, and forking while another thread holds a lock (logging,
+    # a file buffer) can leave the child stuck on it, so its processes come from a forkserver or are spawned.
+    global _pool, _pool_slots
+    with _pool_lock:
+        if _pool is None:
+            workers = os.cpu_count() or 1
+            start_method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(start_method))
+            _pool_slots = threading.BoundedSemaphore(workers * 2)
+        return _pool, _pool_slots
+
+
+class CommP:
+    """Streaming piece commitment (commP) calculator.
+
+    Data is fed through update() in any chunk size. Full 4 MiB subtrees are
+    hashed on the shared process pool while the caller keeps reading, or
+    inline with workers=1; the tail is zero padded up to the piece size. digest() returns the piece CID and the
+    unpadded piece size, the same values `lotus client commP` reports.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers if workers else os.cpu_count() or 1
+        self.size = 0
+        self._buffer = bytearray()
+        self._roots = []
+        self._pending = deque()
+        self._executor, self._slots = commp_pool() if self.workers > 1 else (None, None)
+
+    def update(self, data):
+        self.size += len(data)
+        self._buffer += data
+        while len(self._buffer) >= SEGMENT_UNPADDED_SIZE:
+            segment = bytes(self._buffer[:SEGMENT_UNPADDED_SIZE])
+            del self._buffer[:SEGMENT_UNPADDED_SIZE]
+            self._submit(segment)
+
+    def _submit(self, segment: bytes):
+        if not self._executor:
+            self._roots.append(segment_root(segment))
+            return
+        # waits while the pool holds as many segments as it has slots, whichever CommP they are from
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(segment_root, segment)
+        except BaseException:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        self._pending.append(future)
+        while self._pending and self._pending[0].done():
+            self._roots.append(self._pending.popleft().result())
+
+    def digest(self):
+        try:
+            padded_size = padded_piece_size(self.size)
+            if not self._roots and not self._pending:
+                data = bytes(self._buffer) + bytes(unpadded_piece_size(padded_size) - len(self._buffer))
+                root = segment_root(data)
+            else:
+                if self._buffer:
+                    self._submit(bytes(self._buffer) + bytes(SEGMENT_UNPADDED_SIZE - len(self._buffer)))
+                    self._buffer = bytearray()
+                while self._pending:
+                    self._roots.append(self._pending.popleft().result())
+                level = self._roots + [ZERO_ROOTS[SEGMENT_LEVEL]] * (
+                        padded_size // SEGMENT_PADDED_SIZE - len(self._roots))
+                while len(level) > 1:
+                    level = [_hash_node(level[i], level[i + 1]) for i in range(0, len(level), 2)]
+                root = level[0]
+        finally:
+            self.close()
+        return piece_cid_from_root(root), unpadded_piece_size(padded_size)
+
+    def close(self):
+        # the pool is shared, only the segments of this CommP are dropped
+        for future in self._pending:
+            future.cancel()
+        self._pending.clear()
+        self._executor = None
+
+
+def calculate_commp(file_path: str, workers=None, consumers=()):
+    commp = CommP(workers)
+    try:
+        read_once(file_path, [commp] + list(consumers))
+        return commp.digest()
+    finally:
+        commp.close()
@@ -2,13 +2,14 @@ import csv
 import logging.config
 import math
 import os
-import re
-import subprocess
 import time
 from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 from common.OfflineDeal import OfflineDeal
+from common.lotus import LotusError, get_lotus
+from task_sender.service.ask_cache import ask_cache
 
 logging.basicConfig(level=logging.INFO)
 
@@ -44,42 +45,25 @@ def get_current_epoch_by_current_time():
 
 
 def get_miner_price(miner_fid: str):
-    price = None
-    verified_price = None
+    # asks are shared through ask_cache, so every deal of a task does not query the same miner again
+    return ask_cache.get(miner_fid, query_miner_price)
 
-    try:
-        proc = subprocess.check_output(['lotus', 'client', 'query-ask', miner_fid], timeout=60,
-                                       stderr=subprocess.PIPE)
 
-    except Exception as e:
-        logging.error(e)
-        logging.warning('lotus query-ask process not success.')
-        return
+def query_miner_price(miner_fid: str):
+    ask = get_lotus().query_ask(miner_fid)
+    if ask is None:
+        return None
+    return {'price': ask['price'],
+            'verified_price': ask['verified_price']}
 
-    if proc is None:
-        return
-    else:
-        lines = proc.rstrip().decode('utf-8').split('\n')
-
-        for line in lines:
-            price_match = re.findall(r'''^Price per GiB: ([0-9]*\.?[0-9]+) FIL''', line)
-            if len(price_match) != 0:
-                price = price_match[0]
 
-            verified_price_match = re.findall(r'''^Verified Price per GiB: ([0-9]*\.?[0-9]+) FIL''', line)
-            if len(verified_price_match) != 0:
-                verified_price = verified_price_match[0]
-        return {'price': price,
-                'verified_price': verified_price}
+def start_deal(_cost, piece_size, data_cid, piece_cid, deal_conf: DealConfig, start_epoch) -> str:
+    return get_lotus().start_deal(deal_conf.sender_wallet, deal_conf.miner_id, data_cid, piece_cid, piece_size, _cost,
+                                  DURATION, start_epoch, deal_conf.fast_retrieval, deal_conf.verified_deal)
 
 
 def propose_offline_deal(_price, _cost, piece_size, data_cid, piece_cid, deal_conf: DealConfig, skip_confirmation: bool):
     start_epoch = get_current_epoch_by_current_time() + (deal_conf.epoch_interval_hours + 1) * EPOCH_PER_HOUR
-    command = ['lotus', 'client', 'deal', '--from', deal_conf.sender_wallet, '--start-epoch', str(start_epoch),
-               '--fast-retrieval=' + str(deal_conf.fast_retrieval).lower(), '--verified-deal=' + str(deal_conf.verified_deal).lower(),
-               '--manual-piece-cid', piece_cid, '--manual-piece-size', piece_size, data_cid, deal_conf.miner_id, _cost,
-               DURATION]
-    logging.info(command)
     logging.info("wallet: %s" % deal_conf.sender_wallet)
     logging.info("miner: %s" % deal_conf.miner_id)
     logging.info("price: %s" % _price)
@@ -89,24 +73,14 @@ def propose_offline_deal(_price, _cost, piece_size, data_cid, piece_cid, deal_co
     logging.info("verified-deal: %s" % str(deal_conf.verified_deal).lower())
     if not skip_confirmation:
         input("Press Enter to continue...")
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
-    resp = proc.stdout.readline().rstrip().decode('utf-8')
-    deal_cid = resp
+    deal_cid = start_deal(_cost, piece_size, data_cid, piece_cid, deal_conf, start_epoch)
     logging.info('Deal sent, deal cid: %s, start epoch: %s' % (deal_cid, start_epoch))
     return deal_cid, start_epoch
 
-def propose_offline_deals(_price, _cost, piece_size, data_cid, piece_cid, deal_conf: DealConfig, skip_confirmation: bool, epoch:int):
+def propose_offline_deals(_price, _cost, piece_size, data_cid, piece_cid, deal_conf: DealConfig, skip_confirmation: bool, start_epoch: int):
     logging.info("Sending task deals ...")
-    start_epoch = deal_conf.start_epoch - epoch
-    command = ['lotus', 'client', 'deal', '--from', deal_conf.sender_wallet, '--start-epoch', str(start_epoch),
-               '--fast-retrieval=' + str(deal_conf.fast_retrieval).lower(), '--verified-deal=' + str(deal_conf.verified_deal).lower(),
-               '--manual-piece-cid', piece_cid, '--manual-piece-size', piece_size, data_cid, deal_conf.miner_id, _cost,
-               DURATION]
-    proc = subprocess.Popen(command, stdout=subprocess.PIPE)
-    resp = proc.stdout.readline().rstrip().decode('utf-8')
-    deal_cid = resp
+    deal_cid = start_deal(_cost, piece_size, data_cid, piece_cid, deal_conf, start_epoch)
     if deal_cid:
-        logging.info(command)
         logging.info("wallet: %s" % deal_conf.sender_wallet)
         logging.info("miner: %s" % deal_conf.miner_id)
         logging.info("price: %s" % _price)
@@ -138,7 +112,199 @@ def calculate_real_cost(sector_size_bytes, price_per_GiB):
     return real_cost
 
 
-def send_deals_to_miner(deal_conf: DealConfig, output_dir, skip_confirmation: bool, task_name=None, csv_file_path=None, deal_list=None, task_uuid=None):
+class DealFailure(Exception):
+    def __init__(self, reason: str, message: str):
+        super().__init__(message)
+        self.reason = reason
+
+
+FAILURE_PRICE = 'price'
+FAILURE_SIZE = 'size'
+FAILURE_ERROR = 'error'
+FAILURE_EPOCH_EARLY = 'epoch too early'
+FAILURE_EPOCH_LATE = 'epoch too late'
+FAILURE_DUPLICATE = 'duplicate'
+FAILURE_OFFLINE = 'miner offline'
+FAILURE_CONNECTION = 'connection'
+
+# matched in order against the lowercased lotus error, the first hit wins
+DEAL_ERROR_PATTERNS = [
+    (FAILURE_EPOCH_EARLY, ['too soon', 'already elapsed', 'already expired', 'before current epoch', 'in the past']),
+    (FAILURE_EPOCH_LATE, ['too far in the future', 'too far in future', 'start delay']),
+    (FAILURE_DUPLICATE, ['already exists', 'already tracking', 'duplicate']),
+    (FAILURE_PRICE, ['asking price', 'price per epoch', 'not enough funds', 'insufficient funds']),
+    (FAILURE_OFFLINE, ['failed to dial', 'no addresses', 'no good addresses', 'failed to open stream',
+                       'failed to connect to peer', 'protocol not supported', 'miner is not']),
+    (FAILURE_CONNECTION, ['connection refused', 'connection reset', 'connection aborted', 'timed out', 'timeout',
+                          'deadline exceeded', 'unexpected eof', ': eof', 'temporarily unavailable',
+                          'response code 5']),
+]
+
+# start epochs closer than this to the current epoch leave the miner no time to seal
+START_EPOCH_MIN_DELAY = 6 * EPOCH_PER_HOUR
+DEAL_MAX_ATTEMPTS = 60
+DEAL_MAX_TRANSIENT_ATTEMPTS = 5
+DEAL_BACKOFF_BASE = 2
+DEAL_BACKOFF_MAX = 120
+
+
+def classify_deal_error(message: str) -> str:
+    message = str(message).lower()
+    for reason, patterns in DEAL_ERROR_PATTERNS:
+        if any(pattern in message for pattern in patterns):
+            return reason
+    return FAILURE_ERROR
+
+
+def propose_with_retry(propose, start_epoch: int, max_attempts=DEAL_MAX_ATTEMPTS):
+    # Calls propose(start_epoch) until a deal cid comes back. Every failure is classified and decides the next
+    # attempt: a rejected start epoch jumps into the valid window, a duplicate proposal moves one epoch back,
+    # connection errors back off exponentially, price and offline miners give up at once.
+    transient = 0
+    for attempt in range(max_attempts):
+        try:
+            # both lotus backends raise instead of returning no deal cid
+            return propose(start_epoch), start_epoch
+        except LotusError as e:
+            reason, message = classify_deal_error(e), str(e)
+        logging.info("Deal proposal at start epoch %s failed (%s): %s" % (start_epoch, reason, message))
+
+        earliest = get_current_epoch_by_current_time() + START_EPOCH_MIN_DELAY
+        if reason == FAILURE_EPOCH_EARLY:
+            start_epoch = max(earliest, start_epoch + EPOCH_PER_HOUR)
+        elif reason == FAILURE_EPOCH_LATE:
+            if start_epoch <= earliest:
+                raise DealFailure(reason, message)
+            # the upper limit is not known, halve the distance to the earliest usable epoch
+            start_epoch = earliest + (start_epoch - earliest) // 2
+        elif reason == FAILURE_DUPLICATE:
+            start_epoch = start_epoch - 1
+        elif reason in (FAILURE_CONNECTION, FAILURE_ERROR):
+            transient += 1
+            if transient >= DEAL_MAX_TRANSIENT_ATTEMPTS:
+                raise DealFailure(reason, "gave up after %s attempts: %s" % (transient, message))
+            time.sleep(min(DEAL_BACKOFF_BASE ** transient, DEAL_BACKOFF_MAX))
+        else:
+            raise DealFailure(reason, message)
+    raise DealFailure(reason, "gave up after %s attempts: %s" % (max_attempts, message))
+
+
+def check_deal(price, max_price, miner_id, file_size):
+    if Decimal(price).compare(Decimal(max_price)) > 0:
+        raise DealFailure(FAILURE_PRICE, "miner %s price %s higher than max price %s" % (miner_id, price, max_price))
+    if not file_size or int(file_size) <= 0:
+        raise DealFailure(FAILURE_SIZE, "file is too small")
+    return calculate_piece_size_from_file_size(file_size)
+
+
+def propose_deals(propose, items: list, jobs=1) -> list:
+    # Runs propose(item) for up to jobs items at a time. Results are returned in the order of items, None where
+    # the proposal failed; one failing deal never stops the others.
+    jobs = max(1, int(jobs or 1))
+    logging.info("Proposing %s deals with %s worker(s)" % (len(items), jobs))
+
+    results = []
+    failures = {}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(propose, item) for item in items]
+        for index, future in enumerate(futures):
+            try:
+                results.append(future.result())
+                continue
+            except DealFailure as e:
+                reason = e.reason
+                logging.warning("Deal %s not sent (%s): %s" % (index, reason, e))
+            except Exception as e:
+                reason = FAILURE_ERROR
+                logging.error("Deal %s not sent: %s" % (index, e))
+            failures[reason] = failures.get(reason, 0) + 1
+            results.append(None)
+
+    logging.info("Sent %s/%s deals" % (len(items) - sum(failures.values()), len(items)))
+    if failures:
+        logging.warning("Failed deals by reason: %s" % ", ".join("%s %s" % item for item in sorted(failures.items())))
+    return results
+
+
+def make_proposer(deal_conf: DealConfig, skip_confirmation: bool):
+    # propose(deal) for propose_deals: sends one deal to deal_conf.miner_id and fills in its deal cid, start
+    # epoch and miner, or raises DealFailure. The miner's ask is fetched once, when the proposer is made.
+    prices = get_miner_price(deal_conf.miner_id)
+
+    def propose(_deal):
+        if not prices:
+            raise DealFailure(FAILURE_PRICE, "no price from miner %s" % deal_conf.miner_id)
+        if deal_conf.verified_deal:
+            price = prices['verified_price']
+        else:
+            price = prices['price']
+        piece_size, sector_size = check_deal(price, deal_conf.max_price, deal_conf.miner_id, _deal.car_file_size)
+
+        cost = f'{calculate_real_cost(sector_size, price):.18f}'
+
+        try:
+            _deal_cid, _start_epoch = propose_offline_deal(price, str(cost), str(piece_size), _deal.data_cid,
+                                                           _deal.piece_cid, deal_conf, skip_confirmation)
+        except LotusError as e:
+            raise DealFailure(classify_deal_error(e), str(e))
+
+        _deal.miner_id = deal_conf.miner_id
+        _deal.start_epoch = _start_epoch
+        _deal.deal_cid = _deal_cid
+        return _deal
+
+    return propose
+
+
+def skip_proposed(deal_list, store, miner_id, task_uuid) -> list:
+    # deals the job store has for miner_id in this task get their deal cid and start epoch back, the others are
+    # returned; a new task proposes its deals again
+    pending = []
+    for _deal in deal_list:
+        sent = store.deal(_deal.car_file_path, miner_id) if _deal.car_file_path else None
+        if sent and sent['task_uuid'] == task_uuid:
+            _deal.miner_id = miner_id
+            _deal.deal_cid = sent['deal_cid']
+            _deal.start_epoch = sent['start_epoch']
+        else:
+            pending.append(_deal)
+    if len(pending) < len(deal_list):
+        logging.info("Skipping %s deals already proposed to %s" % (len(deal_list) - len(pending), miner_id))
+    return pending
+
+
+def recording_proposer(propose, store, miner_id, task_uuid):
+    # propose that writes every deal to the job store as soon as it has a deal cid
+    def propose_and_record(_deal):
+        propose(_deal)
+        if _deal.car_file_path:
+            store.proposed(_deal.car_file_path, miner_id, _deal.deal_cid, _deal.start_epoch, task_uuid)
+        return _deal
+
+    return propose_and_record
+
+
+def write_deals_csv(deal_list, output_csv_path, miner_id, task_uuid):
+    logging.info("Swan deal final CSV Generated: %s" % output_csv_path)
+
+    with open(output_csv_path, "w") as output_csv_file:
+        output_fieldnames = ['uuid', 'miner_id', 'file_source_url', 'md5', 'start_epoch', 'deal_cid']
+        csv_writer = csv.DictWriter(output_csv_file, delimiter=',', fieldnames=output_fieldnames)
+        csv_writer.writeheader()
+
+        for deal in deal_list:
+            csv_data = {
+                'uuid': task_uuid,
+                'miner_id': miner_id,
+                'file_source_url': deal.car_file_url,
+                'md5': deal.car_file_md5,
+                'start_epoch': deal.start_epoch,
+                'deal_cid': deal.deal_cid
+            }
+            csv_writer.writerow(csv_data)
+
+
+def send_deals_to_miner(deal_conf: DealConfig, output_dir, skip_confirmation: bool, task_name=None, csv_file_path=None, deal_list=None, task_uuid=None, jobs=1, store=None):
 
     Path(output_dir).mkdir(parents=True, exist_ok=True)
     attributes = [i for i in OfflineDeal.__dict__.keys() if not i.startswith("__")]
@@ -168,60 +334,14 @@ def send_deals_to_miner(deal_conf: DealConfig, output_dir, skip_confirmation: bo
                 deal_list.append(deal)
 
 
-    for _deal in deal_list:
-
-        data_cid = _deal.data_cid
-        piece_cid = _deal.piece_cid
-        source_file_url = _deal.car_file_url
-        md5 = _deal.car_file_md5
-        file_size = _deal.car_file_size
-        prices = get_miner_price(deal_conf.miner_id)
-
-        if prices:
-            if deal_conf.verified_deal:
-                price = prices['verified_price']
-            else:
-                price = prices['price']
-        else:
-            continue
-
-        if Decimal(price).compare(Decimal(deal_conf.max_price)) > 0:
-            logging.warning(
-                "miner %s price %s higher than max price %s" % (deal_conf.miner_id, price, deal_conf.max_price))
-            continue
-        if int(file_size) > 0:
-            piece_size, sector_size = calculate_piece_size_from_file_size(file_size)
-        else:
-            logging.error("file %s is too small" % _deal.source_file_name)
-            continue
-
-        cost = f'{calculate_real_cost(sector_size, price):.18f}'
-
-        _deal_cid, _start_epoch = propose_offline_deal(price, str(cost), str(piece_size), data_cid, piece_cid,
-                                                       deal_conf, skip_confirmation)
-
-        file_exists = os.path.isfile(output_csv_path)
-
-        _deal.miner_id = deal_conf.miner_id
-        _deal.start_epoch = _start_epoch
-        _deal.deal_cid = _deal_cid
+    pending = deal_list
+    propose = make_proposer(deal_conf, skip_confirmation)
+    if store:
+        pending = skip_proposed(deal_list, store, deal_conf.miner_id, task_uuid)
+        propose = recording_proposer(propose, store, deal_conf.miner_id, task_uuid)
 
-    logging.info("Swan deal final CSV Generated: %s" % output_csv_path)
-
-    with open(output_csv_path, "w") as output_csv_file:
-        output_fieldnames = ['uuid', 'miner_id', 'file_source_url', 'md5', 'start_epoch', 'deal_cid']
-        csv_writer = csv.DictWriter(output_csv_file, delimiter=',', fieldnames=output_fieldnames)
-        csv_writer.writeheader()
-
-        for deal in deal_list:
-            csv_data = {
-                'uuid': task_uuid,
-                'miner_id': deal_conf.miner_id,
-                'file_source_url': deal.car_file_url,
-                'md5': deal.car_file_md5,
-                'start_epoch': deal.start_epoch,
-                'deal_cid': deal.deal_cid
-            }
-            csv_writer.writerow(csv_data)
+    # the confirmation prompt needs the terminal, so deals wait for each other when it is on
+    propose_deals(propose, pending, jobs if skip_confirmation else 1)
 
+    write_deals_csv(deal_list, output_csv_path, deal_conf.miner_id, task_uuid)
     return output_csv_path
@@ -0,0 +1,32 @@
+import hashlib
+
+READ_BUFFER_SIZE = 8 * 1024 * 1024
+
+DIGEST_FACTORIES = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+    'sha256': hashlib.sha256,
+}
+
+
+def new_digests(names) -> dict:
+    return {name: DIGEST_FACTORIES[name]() for name in names}
+
+
+def read_once(file_path: str, consumers, buffer_size=READ_BUFFER_SIZE) -> int:
+    # Every consumer gets each byte of the file exactly once through update(). The same buffer is reused
+    # for the whole file, so a consumer must copy what it keeps (hashlib objects, CommP and CarWriter do).
+    consumers = [consumer for consumer in consumers if consumer is not None]
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    size = 0
+    with open(file_path, 'rb', buffering=0) as f:
+        while True:
+            read_size = f.readinto(buffer)
+            if not read_size:
+                break
+            chunk = view[:read_size]
+            for consumer in consumers:
+                consumer.update(chunk)
+            size += read_size
+    return size
@@ -1,55 +1,42 @@
 import hashlib
 import logging
 import os
-import re
 import shutil
-import subprocess
 import time
 
+from common.lotus import size_str
+from task_sender.service.car import write_bundle_car, write_car
+from task_sender.service.commp import calculate_commp
+from task_sender.service.digest import new_digests
 
-def stage_one(input_path, output_path: str):
-    piece_cid = generate_car(input_path, output_path)[0]
-    data_cid = import_by_lotus(output_path)
-    return [piece_cid, data_cid]
-
-
-def generate_car(input_path, output_path: str):
-    logging.info('Generating car file from: %s' % input_path)
-    try:
-        subprocess.check_output(['lotus', 'client', 'generate-car', input_path, output_path],
-                                stderr=subprocess.PIPE)
-    except Exception as e:
-        print(e)
-    return generate_piece_cid(output_path)
-
-
-def import_by_lotus(file):
-    # 1. import
-    logging.info('Generating data CID....')
-    proc = subprocess.Popen(['lotus', 'client', 'import', '--car', file], stdout=subprocess.PIPE)
-    resp = proc.stdout.readline().rstrip().decode('utf-8')
-    data_cid = resp.split("Root ")[1]
-    logging.info('Data CID: %s' % data_cid)
-
-    return data_cid
-
-
-def generate_piece_cid(file_path: str):
-    piece_cid: str = ''
-    piece_size: str = ''
-    try:
-        proc = subprocess.check_output(['lotus', 'client', 'commP', file_path])
-    except Exception as e:
-        logging.error(e)
-        exit(1)
-    lines = proc.rstrip().decode('utf-8').split('\n')
-    for line in lines:
-        piece_cid_match = re.findall(r'''CID:  ([a-z0-9]+)''', line)
-        if len(piece_cid_match) > 0:
-            piece_cid = piece_cid_match[0]
-        piece_size_match = re.findall(r'''Piece size:  ([0-9]*\.?[0-9]+ [B|KiB|MiB|GiB]+)''', line)
-        if len(piece_size_match) > 0:
-            piece_size = piece_size_match[0]
+
+def stage_one(input_path, output_path: str, generate_md5=False):
+    # the source is read once (car writer + source md5) and the car once (commP + car md5)
+    source_digests = new_digests(['md5'] if generate_md5 else [])
+    car_digests = new_digests(['md5'] if generate_md5 else [])
+
+    data_cid = write_car(input_path, output_path, source_digests.values())
+    piece_cid = generate_piece_cid(output_path, consumers=car_digests.values())[0]
+
+    source_md5 = source_digests['md5'].hexdigest() if generate_md5 else None
+    car_md5 = car_digests['md5'].hexdigest() if generate_md5 else None
+    return [piece_cid, data_cid, source_md5, car_md5]
+
+
+def stage_one_bundle(input_paths, output_path: str, generate_md5=False):
+    # a bundle has no single source file, only the car gets an md5
+    car_digests = new_digests(['md5'] if generate_md5 else [])
+
+    data_cid = write_bundle_car(input_paths, output_path)
+    piece_cid = generate_piece_cid(output_path, consumers=car_digests.values())[0]
+
+    car_md5 = car_digests['md5'].hexdigest() if generate_md5 else None
+    return [piece_cid, data_cid, None, car_md5]
+
+
+def generate_piece_cid(file_path: str, workers=None, consumers=()):
+    piece_cid, piece_size = calculate_commp(file_path, workers, consumers)
+    piece_size = size_str(piece_size)
     logging.info('car file Generated: %s, piece cid: %s, piece size: %s' % (file_path, piece_cid, piece_size))
     return [piece_cid, piece_size]
 
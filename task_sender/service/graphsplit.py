@@ -0,0 +1,201 @@
+import json
+import logging
+import math
+import os
+import re
+import subprocess
+import tempfile
+import time
+
+from common.lotus import size_str
+from task_sender.service.car import UNIXFS_CHUNK_SIZE
+from task_sender.service.planner import piece_capacity, BUNDLE_SECTOR_SIZE, CAR_BUNDLE_OVERHEAD, CAR_LEAF_OVERHEAD
+
+GRAPHSPLIT_PATH = './graphsplit'
+GRAPHSPLIT_SLICE_SIZE = 1000000000
+GRAPHSPLIT_PARALLEL = 2
+
+# graphsplit keeps every block of a slice in an in-memory blockstore until the car is written, so a slice may
+# take at most this share of the available memory
+GRAPHSPLIT_MEMORY_SHARE = 0.5
+# MiB/s one graphsplit goroutine chunks and hashes, until timings of earlier runs on this machine are known
+GRAPHSPLIT_CORE_MIB_S = 150
+DISK_SAMPLE_SIZE = 64 * 1024 * 1024
+# slices smaller than this are not worth a deal
+MIN_SLICE_SECTOR_SIZE = 1024 ** 3
+HISTORY_LIMIT = 50
+# runs shorter than this mostly time process start and commP, not chunking
+HISTORY_MIN_SIZE = 256 * 1024 * 1024
+
+# graphsplit names a graph cut into several slices <graph name>-total-<n>-part-<k>.car, see GenGraphName
+_SLICE_NAME = re.compile(r'^(.*)-total-(\d+)-part-(\d+)\.car$')
+
+
+def run_graphsplit(target_path: str, graph_name: str, car_dir: str, parent_path='.', slice_size=GRAPHSPLIT_SLICE_SIZE,
+                   parallel=GRAPHSPLIT_PARALLEL) -> bool:
+    # target_path may be a file or a directory, every file under a directory goes into the same graph
+    command = [GRAPHSPLIT_PATH, 'chunk', '--car-dir=%s' % car_dir, '--slice-size=%s' % slice_size,
+               '--parallel=%s' % parallel, '--graph-name=%s' % graph_name, '--calc-commp=true',
+               '--parent-path=%s' % parent_path, target_path]
+    result = subprocess.run(command)
+    if result.returncode != 0:
+        logging.error('graphsplit failed for %s with exit code %s' % (target_path, result.returncode))
+        return False
+    return True
+
+
+def slice_graph_name(filename: str):
+    # (graph name, part number) of a manifest filename
+    match = _SLICE_NAME.match(filename)
+    if match:
+        return match.group(1), int(match.group(3))
+    return (filename[:-len('.car')] if filename.endswith('.car') else filename), 1
+
+
+def read_manifest(car_dir: str) -> dict:
+    # Every graphsplit run appends its slices to manifest.csv. It is read once into graph name -> slices in part
+    # order, so looking up a graph no longer scans the whole file and a graph only ever matches its own name.
+    # A graph generated again in a later run replaces the slices of the earlier one.
+    manifest_path = os.path.join(car_dir, 'manifest.csv')
+    index = {}
+    if not os.path.isfile(manifest_path):
+        return index
+    with open(manifest_path, newline='') as manifest_file:
+        next(manifest_file, None)
+        for line in manifest_file:
+            # the detail column is json written without csv quoting, only the first fields are split off
+            fields = line.rstrip('\r\n').split(',', 4)
+            if len(fields) < 4:
+                continue
+            payload_cid, filename, piece_cid, piece_size = fields[:4]
+            graph_name, part = slice_graph_name(filename)
+            if part == 1 or graph_name not in index:
+                index[graph_name] = []
+            index[graph_name].append({'data_cid': payload_cid, 'piece_cid': piece_cid, 'piece_size': piece_size,
+                                      'slice_name': filename[:-len('.car')] if filename.endswith('.car') else filename})
+    return index
+
+
+def available_memory() -> int:
+    try:
+        with open('/proc/meminfo') as meminfo:
+            for line in meminfo:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return 0
+
+
+def sample_read_speed(file_paths, sample_size=DISK_SAMPLE_SIZE) -> float:
+    # MiB/s reading the start of the largest input file, dropped from the page cache first where possible so
+    # a file read just before does not look like a fast disk
+    file_paths = [file_path for file_path in file_paths if os.path.isfile(file_path)]
+    if not file_paths:
+        return 0.0
+    file_path = max(file_paths, key=os.path.getsize)
+    buffer = bytearray(4 * 1024 * 1024)
+    read = 0
+    start = time.time()
+    with open(file_path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, sample_size, os.POSIX_FADV_DONTNEED)
+        while read < sample_size:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            read += n
+    elapsed = time.time() - start
+    return read / 1024 / 1024 / elapsed if elapsed > 0 and read else 0.0
+
+
+def slice_size_for_sector(sector_size: int) -> int:
+    # most source bytes whose car, with graphsplit's dag added, still fits a sector of sector_size
+    capacity = piece_capacity(sector_size) - CAR_BUNDLE_OVERHEAD
+    return int(capacity / (1 + CAR_LEAF_OVERHEAD / UNIXFS_CHUNK_SIZE))
+
+
+class GraphsplitTuning:
+    # Picks --parallel and --slice-size for this machine. The slice size is the largest that fills a whole
+    # sector, from sector_size down, whose blocks fit in memory. Parallelism is the number of goroutines it
+    # takes to keep up with the disk, from the core throughput measured by earlier runs once there are any.
+    # Each run's timing is kept in the history file for the next choice.
+    def __init__(self, history_path=None, sector_size=BUNDLE_SECTOR_SIZE, parallel=None, slice_size=None):
+        self.history_path = os.path.expanduser(history_path) if history_path else None
+        self.sector_size = sector_size
+        self.parallel = parallel
+        self.slice_size = slice_size
+        self.cpus = os.cpu_count() or 1
+        self.disk_mib_s = 0.0
+        self.history = self._read_history()
+
+    def _read_history(self) -> list:
+        if not self.history_path:
+            return []
+        try:
+            with open(self.history_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            logging.warning('Ignoring unreadable graphsplit history %s: %s' % (self.history_path, e))
+            return []
+
+    def core_speed(self) -> float:
+        # median MiB/s per goroutine of earlier runs; a run that kept up with the disk says nothing about the
+        # cores, so only runs clearly slower than their disk sample count
+        speeds = sorted(run['mib_s'] / run['parallel'] for run in self.history
+                        if run['size'] >= HISTORY_MIN_SIZE and run['mib_s'] < 0.8 * run.get('disk_mib_s', 0))
+        if not speeds:
+            return GRAPHSPLIT_CORE_MIB_S
+        return speeds[len(speeds) // 2]
+
+    def tune(self, file_paths):
+        cpus = self.cpus
+        memory = available_memory()
+        disk_mib_s = self.disk_mib_s = sample_read_speed(file_paths)
+
+        slice_size = self.slice_size
+        if not slice_size:
+            sector_size = self.sector_size
+            budget = memory * GRAPHSPLIT_MEMORY_SHARE if memory else None
+            while budget and sector_size > MIN_SLICE_SECTOR_SIZE and slice_size_for_sector(sector_size) > budget:
+                sector_size //= 2
+            slice_size = slice_size_for_sector(sector_size)
+        parallel = self.parallel
+        if not parallel:
+            parallel = math.ceil(disk_mib_s / self.core_speed()) if disk_mib_s else GRAPHSPLIT_PARALLEL
+            parallel = max(1, min(cpus, parallel))
+
+        logging.info('graphsplit: %s cpus, %s available memory, disk %.0f MiB/s -> parallel %s, slice size %s' % (
+            cpus, size_str(memory), disk_mib_s, parallel, size_str(slice_size)))
+        return parallel, slice_size
+
+    def record(self, parallel: int, slice_size: int, data_size: int, seconds: float):
+        if not self.history_path or seconds <= 0:
+            return
+        self.history.append({'time': int(time.time()), 'cpus': self.cpus, 'disk_mib_s': round(self.disk_mib_s, 1),
+                             'parallel': parallel, 'slice_size': slice_size, 'size': data_size,
+                             'seconds': round(seconds, 3), 'mib_s': round(data_size / 1024 / 1024 / seconds, 3)})
+        self.history = self.history[-HISTORY_LIMIT:]
+        try:
+            history_dir = os.path.dirname(os.path.abspath(self.history_path))
+            os.makedirs(history_dir, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=history_dir, prefix='.graphsplit-history-')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.history, f)
+            os.replace(tmp_path, self.history_path)
+        except OSError as e:
+            logging.warning('Failed to write graphsplit history %s: %s' % (self.history_path, e))
+
+
+def load_graphsplit_tuning(config) -> GraphsplitTuning:
+    sender = config['sender']
+    # graphsplit's own 1 GB slices unless gocar_slice_size = 0 asks for the tuned size
+    return GraphsplitTuning(sender.get('gocar_history'),
+                            sender.get('gocar_sector_size') or sender.get('bundle_sector_size', BUNDLE_SECTOR_SIZE),
+                            sender.get('gocar_parallel') or None,
+                            sender.get('gocar_slice_size', GRAPHSPLIT_SLICE_SIZE) or None)
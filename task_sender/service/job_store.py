@@ -0,0 +1,176 @@
+import csv
+import json
+import os
+import sqlite3
+import threading
+import time
+
+FILE_PREPARED = 'prepared'
+FILE_UPLOADED = 'uploaded'
+FILE_REPORTED = 'reported'
+DEAL_PROPOSED = 'proposed'
+DEAL_REPORTED = 'reported'
+
+
+class JobStore:
+    # State of every car file from generation to the Swan task, and of every deal made for it, so each stage
+    # updates one row as it goes instead of rewriting car.csv or a deals csv. Car files are keyed by their
+    # absolute path and grouped by the directory they are in, which is what the csv based commands call a job;
+    # deals are keyed by car file and miner. The csv files are exported from here and stay what other tools read.
+    def __init__(self, path: str):
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS files (car_file_path TEXT PRIMARY KEY, car_dir TEXT NOT NULL, '
+                           'position INTEGER NOT NULL, status TEXT NOT NULL, row TEXT NOT NULL, car_file_url TEXT, '
+                           'task_uuid TEXT, updated_at INTEGER NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS files_car_dir ON files (car_dir, position)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS deals (car_file_path TEXT NOT NULL, miner_id TEXT NOT NULL, '
+                           'deal_cid TEXT NOT NULL, start_epoch INTEGER, task_uuid TEXT, status TEXT NOT NULL, '
+                           'updated_at INTEGER NOT NULL, PRIMARY KEY (car_file_path, miner_id))')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS deals_task_uuid ON deals (task_uuid, miner_id)')
+
+    @staticmethod
+    def _file(row) -> dict:
+        car_file = json.loads(row[0])
+        car_file['car_file_url'] = row[1] or ''
+        car_file['status'] = row[2]
+        car_file['task_uuid'] = row[3]
+        return car_file
+
+    def has_files(self, car_dir: str) -> bool:
+        with self._lock:
+            row = self._conn.execute('SELECT 1 FROM files WHERE car_dir = ? LIMIT 1',
+                                     (os.path.abspath(car_dir),)).fetchone()
+        return row is not None
+
+    def file(self, car_file_path: str):
+        with self._lock:
+            row = self._conn.execute('SELECT row, car_file_url, status, task_uuid FROM files WHERE car_file_path = ?',
+                                     (os.path.abspath(car_file_path),)).fetchone()
+        return self._file(row) if row else None
+
+    def files(self, car_dir: str) -> list:
+        with self._lock:
+            rows = self._conn.execute('SELECT row, car_file_url, status, task_uuid FROM files WHERE car_dir = ? '
+                                      'ORDER BY position', (os.path.abspath(car_dir),)).fetchall()
+        return [self._file(row) for row in rows]
+
+    def prepare(self, car_row: dict, position: int = None):
+        # A car file generated again with the same cids keeps its upload and deals, one with other content
+        # starts over. Without a position it goes after the other car files of its directory.
+        car_file_path = os.path.abspath(car_row['car_file_path'])
+        car_dir = os.path.dirname(car_file_path)
+        car_row = {key: value for key, value in car_row.items() if key != 'car_file_url'}
+        now = int(time.time())
+        with self._lock:
+            old = self._conn.execute('SELECT row FROM files WHERE car_file_path = ?', (car_file_path,)).fetchone()
+            if old:
+                old_row = json.loads(old[0])
+                if old_row['piece_cid'] == car_row['piece_cid'] and old_row['data_cid'] == car_row['data_cid']:
+                    self._conn.execute('UPDATE files SET row = ?, position = COALESCE(?, position), updated_at = ? '
+                                       'WHERE car_file_path = ?', (json.dumps(car_row), position, now, car_file_path))
+                    return
+                self._conn.execute('DELETE FROM deals WHERE car_file_path = ?', (car_file_path,))
+            if position is None:
+                position = self._conn.execute('SELECT COALESCE(MAX(position), -1) + 1 FROM files WHERE car_dir = ?',
+                                              (car_dir,)).fetchone()[0]
+            self._conn.execute('INSERT OR REPLACE INTO files (car_file_path, car_dir, position, status, row, '
+                               'car_file_url, task_uuid, updated_at) VALUES (?, ?, ?, ?, ?, NULL, NULL, ?)',
+                               (car_file_path, car_dir, position, FILE_PREPARED, json.dumps(car_row), now))
+
+    def keep_only(self, car_dir: str, car_file_paths):
+        # drops the car files of car_dir a full regeneration did not write again
+        keep = {os.path.abspath(car_file_path) for car_file_path in car_file_paths}
+        with self._lock:
+            rows = self._conn.execute('SELECT car_file_path FROM files WHERE car_dir = ?',
+                                      (os.path.abspath(car_dir),)).fetchall()
+            for (car_file_path,) in rows:
+                if car_file_path not in keep:
+                    self._conn.execute('DELETE FROM files WHERE car_file_path = ?', (car_file_path,))
+                    self._conn.execute('DELETE FROM deals WHERE car_file_path = ?', (car_file_path,))
+
+    def uploaded(self, car_file_path: str, car_file_url: str):
+        with self._lock:
+            self._conn.execute('UPDATE files SET car_file_url = ?, updated_at = ?, '
+                               'status = CASE WHEN status = ? THEN status ELSE ? END WHERE car_file_path = ?',
+                               (car_file_url, int(time.time()), FILE_REPORTED, FILE_UPLOADED,
+                                os.path.abspath(car_file_path)))
+
+    def deal(self, car_file_path: str, miner_id: str):
+        with self._lock:
+            row = self._conn.execute('SELECT deal_cid, start_epoch, task_uuid, status FROM deals '
+                                     'WHERE car_file_path = ? AND miner_id = ?',
+                                     (os.path.abspath(car_file_path), miner_id)).fetchone()
+        if row is None:
+            return None
+        return {'deal_cid': row[0], 'start_epoch': row[1], 'task_uuid': row[2], 'status': row[3]}
+
+    def proposed(self, car_file_path: str, miner_id: str, deal_cid: str, start_epoch, task_uuid: str = None):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO deals (car_file_path, miner_id, deal_cid, start_epoch, '
+                               'task_uuid, status, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                               (os.path.abspath(car_file_path), miner_id, deal_cid, start_epoch, task_uuid,
+                                DEAL_PROPOSED, int(time.time())))
+
+    def pending_task_uuid(self, car_dir: str, miner_id: str):
+        # task uuid of deals proposed from car_dir whose task never reached Swan, to be resumed under that uuid
+        with self._lock:
+            row = self._conn.execute('SELECT deals.task_uuid FROM deals JOIN files USING (car_file_path) '
+                                     'WHERE files.car_dir = ? AND deals.miner_id = ? AND deals.status = ? '
+                                     'AND deals.task_uuid IS NOT NULL LIMIT 1',
+                                     (os.path.abspath(car_dir), miner_id, DEAL_PROPOSED)).fetchone()
+        return row[0] if row else None
+
+    def reported(self, task_uuid: str, car_file_paths, miner_id: str = None):
+        # the task with these car files, and the deals of miner_id for it, are on Swan or, in offline mode, in the
+        # task csv written for it
+        now = int(time.time())
+        with self._lock:
+            self._conn.execute('BEGIN')
+            try:
+                for car_file_path in car_file_paths:
+                    self._conn.execute('UPDATE files SET status = ?, task_uuid = ?, updated_at = ? '
+                                       'WHERE car_file_path = ?',
+                                       (FILE_REPORTED, task_uuid, now, os.path.abspath(car_file_path)))
+            except BaseException:
+                # an open transaction would make every later BEGIN on the shared connection fail
+                self._conn.execute('ROLLBACK')
+                raise
+            self._conn.execute('COMMIT')
+        if miner_id:
+            self.deals_reported(task_uuid, miner_id)
+
+    def deals_reported(self, task_uuid: str, miner_id: str):
+        with self._lock:
+            self._conn.execute('UPDATE deals SET status = ?, updated_at = ? WHERE task_uuid = ? AND miner_id = ?',
+                               (DEAL_REPORTED, int(time.time()), task_uuid, miner_id))
+
+    def import_car_csv(self, car_dir: str, csv_path: str, fieldnames: list):
+        # takes over a car.csv written without the store, the last column is the car file url or address
+        with open(csv_path, newline='') as csv_file:
+            reader = csv.DictReader(csv_file, delimiter=',', fieldnames=fieldnames)
+            next(reader, None)
+            for position, row in enumerate(reader):
+                row['car_file_path'] = row['car_file_path'] or os.path.join(car_dir, row['car_file_name'])
+                self.prepare(row, position)
+                if row.get(fieldnames[-1]):
+                    self.uploaded(row['car_file_path'], row[fieldnames[-1]])
+
+    def export_car_csv(self, car_dir: str, csv_path: str, fieldnames: list):
+        # car.csv of car_dir in generation order, the url goes into the last column whatever it is named
+        tmp_path = csv_path + '.tmp'
+        with open(tmp_path, 'w') as csv_file:
+            csv_writer = csv.DictWriter(csv_file, delimiter=',', fieldnames=fieldnames, extrasaction='ignore')
+            csv_writer.writeheader()
+            for car_file in self.files(car_dir):
+                car_file[fieldnames[-1]] = car_file['car_file_url']
+                csv_writer.writerow(car_file)
+        os.replace(tmp_path, csv_path)
+
+
+def load_job_store(config):
+    path = config['sender'].get('job_store')
+    return JobStore(path) if path else None
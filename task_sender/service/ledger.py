@@ -0,0 +1,58 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+TASK_PROPOSED = 'proposed'
+TASK_UPDATED = 'updated'
+
+
+class TaskLedger:
+    # Durable record of what the autobid module already did. Every deal is written as soon as it has a deal cid,
+    # and a task is marked proposed once all its deals are out and updated once Swan accepted the deal csv.
+    # A restarted or repeated run reads it back instead of proposing the same deals again.
+    def __init__(self, path: str):
+        path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS tasks (uuid TEXT PRIMARY KEY, status TEXT NOT NULL, '
+                           'info_csv_path TEXT, updated_at INTEGER NOT NULL)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS deals (task_uuid TEXT NOT NULL, deal_id TEXT NOT NULL, '
+                           'deal_cid TEXT NOT NULL, deal TEXT NOT NULL, created_at INTEGER NOT NULL, '
+                           'PRIMARY KEY (task_uuid, deal_id))')
+
+    def task(self, task_uuid: str):
+        with self._lock:
+            row = self._conn.execute('SELECT status, info_csv_path FROM tasks WHERE uuid = ?',
+                                     (task_uuid,)).fetchone()
+        if row is None:
+            return None
+        return {'status': row[0], 'info_csv_path': row[1]}
+
+    def tasks_with_status(self, status: str) -> set:
+        with self._lock:
+            rows = self._conn.execute('SELECT uuid FROM tasks WHERE status = ?', (status,)).fetchall()
+        return {row[0] for row in rows}
+
+    def record_task(self, task_uuid: str, status: str, info_csv_path: str = None):
+        with self._lock:
+            self._conn.execute('INSERT INTO tasks (uuid, status, info_csv_path, updated_at) VALUES (?, ?, ?, ?) '
+                               'ON CONFLICT (uuid) DO UPDATE SET status = excluded.status, '
+                               'info_csv_path = COALESCE(excluded.info_csv_path, tasks.info_csv_path), '
+                               'updated_at = excluded.updated_at',
+                               (task_uuid, status, info_csv_path, int(time.time())))
+
+    def deal(self, task_uuid: str, deal_id):
+        with self._lock:
+            row = self._conn.execute('SELECT deal FROM deals WHERE task_uuid = ? AND deal_id = ?',
+                                     (task_uuid, str(deal_id))).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def record_deal(self, task_uuid: str, deal_id, deal: dict):
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO deals (task_uuid, deal_id, deal_cid, deal, created_at) '
+                               'VALUES (?, ?, ?, ?, ?)',
+                               (task_uuid, str(deal_id), deal['deal_cid'], json.dumps(deal), int(time.time())))
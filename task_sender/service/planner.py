@@ -0,0 +1,102 @@
+import json
+import logging
+import os
+from bisect import bisect_left, insort
+
+from common.lotus import size_str
+from task_sender.service.car import UNIXFS_CHUNK_SIZE
+from task_sender.service.deal import calculate_piece_size_from_file_size
+
+BUNDLE_SECTOR_SIZE = 32 * 1024 ** 3
+# every name becomes a link in one flat directory node, which has to stay well below the 1 MiB block limit
+BUNDLE_MAX_FILES = 2048
+
+# Upper bounds of what a car adds to the data: per 1 MiB leaf its cid, length prefix and parent link, per file
+# its directory link (plus the name) and top node, per car the header and directory node framing. Estimates
+# must never be low, a bundle that ends up a byte over the piece size costs a sector twice as large.
+CAR_LEAF_OVERHEAD = 128
+CAR_FILE_OVERHEAD = 512
+CAR_BUNDLE_OVERHEAD = 4096
+
+
+def estimate_car_size(file_size: int, name: str = '') -> int:
+    leaves = max(1, -(-file_size // UNIXFS_CHUNK_SIZE))
+    return file_size + leaves * CAR_LEAF_OVERHEAD + CAR_FILE_OVERHEAD + len(name.encode('utf-8'))
+
+
+def piece_capacity(sector_size: int) -> int:
+    # largest car that still fits a sector after fr32 padding, see calculate_piece_size_from_file_size
+    return sector_size * 254 // 256
+
+
+class Bundle:
+    def __init__(self, name: str):
+        self.name = name
+        self.files = []
+        self.size = 0
+        self.car_size = CAR_BUNDLE_OVERHEAD
+
+    def add(self, path: str, size: int, car_size: int):
+        self.files.append(path)
+        self.size += size
+        self.car_size += car_size
+
+    def to_dict(self) -> dict:
+        _, sector_size = calculate_piece_size_from_file_size(self.car_size)
+        return {'name': self.name, 'files': self.files, 'size': self.size, 'estimated_car_size': self.car_size,
+                'sector_size': sector_size}
+
+
+def plan_bundles(files, sector_size=BUNDLE_SECTOR_SIZE, max_files=BUNDLE_MAX_FILES) -> list:
+    # Best fit decreasing: largest files first, each into the open bundle with the least room that still fits.
+    # Open bundles are kept sorted by free space, so a file costs one bisect and the plan scales to millions of
+    # files. Files too large for a sector of their own are left alone and get a car each, as without a plan.
+    capacity = piece_capacity(sector_size)
+    items = sorted(((estimate_car_size(size, os.path.basename(path)), size, path) for path, size in files),
+                   reverse=True)
+    bundles = []
+    singles = []
+    open_bundles = []  # (free space, bundle index)
+    for car_size, size, path in items:
+        if car_size + CAR_BUNDLE_OVERHEAD > capacity:
+            singles.append((path, size, car_size))
+            continue
+        i = bisect_left(open_bundles, (car_size, -1))
+        if i < len(open_bundles):
+            _, index = open_bundles.pop(i)
+            bundle = bundles[index]
+        else:
+            index = len(bundles)
+            bundle = Bundle('bundle-%05d' % (index + 1))
+            bundles.append(bundle)
+        bundle.add(path, size, car_size)
+        free = capacity - bundle.car_size
+        if len(bundle.files) < max_files and free > 0:
+            insort(open_bundles, (free, index))
+
+    for path, size, car_size in singles:
+        bundle = Bundle(os.path.basename(path))
+        bundle.add(path, size, car_size - CAR_BUNDLE_OVERHEAD)
+        bundles.append(bundle)
+    return bundles
+
+
+def write_plan(bundles: list, plan_path: str, sector_size=BUNDLE_SECTOR_SIZE):
+    plan = {'sector_size': sector_size, 'bundles': [bundle.to_dict() for bundle in bundles]}
+    tmp_path = plan_path + '.tmp'
+    with open(tmp_path, 'w') as plan_file:
+        json.dump(plan, plan_file, indent=1)
+    os.replace(tmp_path, plan_path)
+
+    data_size = sum(bundle['size'] for bundle in plan['bundles'])
+    sector_total = sum(bundle['sector_size'] for bundle in plan['bundles'])
+    logging.info('Planned %s file(s) into %s car file(s): %s of data in %s of sectors, %.1f%% padding' % (
+        sum(len(bundle['files']) for bundle in plan['bundles']), len(plan['bundles']), size_str(data_size),
+        size_str(sector_total), 100 - data_size * 100 / sector_total if sector_total else 0))
+    logging.info('Plan written to %s' % plan_path)
+    return plan
+
+
+def read_plan(plan_path: str) -> dict:
+    with open(plan_path) as plan_file:
+        return json.load(plan_file)
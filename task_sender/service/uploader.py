@@ -0,0 +1,51 @@
+import logging
+import os
+
+from common.ipfs import ipfs_has, progress_logger, IPFS_CHUNK_SIZE, IPFS_STALL_TIMEOUT
+from common.swan_client import SwanClient
+from common.upload_index import UploadIndex
+
+
+class IpfsUploader:
+    # Uploads single car files to the ipfs server with the [ipfs-server] settings, skipping those the upload
+    # index knows are there already. Safe to share between upload threads.
+    def __init__(self, config):
+        ipfs_conf = config['ipfs-server']
+        self.gateway_address = ipfs_conf['download_stream_url']
+        self.api_address = ipfs_conf['upstream_url']
+        self.add_params = ipfs_conf.get('add_params', {})
+        self.chunk_size = ipfs_conf.get('upload_chunk_size', IPFS_CHUNK_SIZE)
+        self.stall_timeout = ipfs_conf.get('upload_stall_timeout', IPFS_STALL_TIMEOUT)
+        self.nocopy = ipfs_conf.get('upload_mode', 'copy') == 'nocopy'
+        self.upload_index = UploadIndex(ipfs_conf['upload_index']) if ipfs_conf.get('upload_index') else None
+        self.probe = ipfs_conf.get('upload_probe', True)
+
+    def find_uploaded(self, car_file_name, car_file_path, piece_cid):
+        if not self.upload_index:
+            return None
+        car_file_hash = self.upload_index.find(self.api_address, piece_cid, os.path.getsize(car_file_path))
+        if car_file_hash and self.probe and not ipfs_has(self.api_address, car_file_hash):
+            logging.info("Car file %s is no longer on the ipfs server, uploading again" % car_file_name)
+            self.upload_index.forget(self.api_address, car_file_hash)
+            return None
+        return car_file_hash
+
+    def upload(self, car_file_name, car_file_path, piece_cid, data_cid):
+        # (car file address, bytes sent), the address is None if the upload failed
+        car_file_hash = self.find_uploaded(car_file_name, car_file_path, piece_cid)
+        if car_file_hash:
+            car_file_address = self.gateway_address + "/ipfs/" + car_file_hash
+            logging.info("Car file %s already uploaded: %s" % (car_file_name, car_file_address))
+            return car_file_address, 0
+        logging.info("Uploading car file %s" % car_file_name)
+        car_file_hash = SwanClient.upload_car_to_ipfs(car_file_path, self.api_address, self.add_params,
+                                                      progress_logger(car_file_name), self.chunk_size,
+                                                      self.stall_timeout, self.nocopy)
+        if not car_file_hash:
+            return None, 0
+        car_file_address = self.gateway_address + "/ipfs/" + car_file_hash
+        logging.info("Car file %s uploaded: %s" % (car_file_name, car_file_address))
+        car_file_size = os.path.getsize(car_file_path)
+        if self.upload_index:
+            self.upload_index.record(self.api_address, piece_cid, data_cid, car_file_hash, car_file_size)
+        return car_file_address, car_file_size
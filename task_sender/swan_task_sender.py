@@ -2,23 +2,40 @@ import csv
 import logging
 import os
 import uuid
+import shutil
 import subprocess
 import json
-import jwt
 from os import listdir
 from os.path import isfile, join
 from pathlib import Path
 from typing import List
+import threading
 import time
 from common.OfflineDeal import OfflineDeal
 from common.config import read_config
-from common.swan_client import SwanClient, SwanTask
+from common.lotus import configure_lotus
+from common.swan_client import SwanClient, SwanTask, task_updated_on, configure_swan_api, get_token_manager
 from .deal_sender import send_deals
-from .service.file_process import checksum, stage_one
+from .service.file_process import checksum, stage_one, stage_one_bundle
 from common.swan_client import send_http_request
-from task_sender.service.deal import propose_offline_deals, get_miner_price,calculate_piece_size_from_file_size,calculate_real_cost,EPOCH_PER_HOUR,get_current_epoch_by_current_time
+from task_sender.service.deal import propose_offline_deals, get_miner_price,calculate_real_cost,EPOCH_PER_HOUR,get_current_epoch_by_current_time
 from decimal import Decimal
-from task_sender.service.deal import DealConfig
+from concurrent.futures import ThreadPoolExecutor
+from task_sender.service.deal import DealConfig, DealFailure, FAILURE_PRICE, check_deal, propose_deals, propose_with_retry
+from task_sender.service.ask_cache import configure_ask_cache
+from task_sender.service.car_cache import CarCache, load_car_cache
+from task_sender.service.job_store import JobStore, load_job_store
+from task_sender.service.graphsplit import GraphsplitTuning, load_graphsplit_tuning, read_manifest, run_graphsplit, \
+    GRAPHSPLIT_PARALLEL, GRAPHSPLIT_SLICE_SIZE
+from task_sender.service.uploader import IpfsUploader
+from task_sender.service.planner import plan_bundles, piece_capacity, read_plan, write_plan, BUNDLE_MAX_FILES, \
+    BUNDLE_SECTOR_SIZE
+
+CAR_CSV_FIELDNAMES = ['car_file_name', 'car_file_path', 'piece_cid', 'data_cid', 'car_file_size', 'car_file_md5',
+                      'source_file_name', 'source_file_path', 'source_file_size', 'source_file_md5', 'car_file_url']
+# car cache entries of the two generators are kept apart, they name and split car files differently
+CAR_MODE_LOTUS = 'lotus'
+CAR_MODE_GRAPHSPLIT = 'graphsplit'
 
 
 def read_file_path_in_dir(dir_path: str) -> List[str]:
@@ -55,117 +72,180 @@ def generate_csv_and_send(_task: SwanTask, deal_list: List[OfflineDeal], _output
             _client.post_task(_task, csv_file)
 
 
-def generate_car(_deal_list: List[OfflineDeal], target_dir) -> List[OfflineDeal]:
-    csv_path = os.path.join(target_dir, "car.csv")
+def generate_car_row(_deal: OfflineDeal, target_dir, source_paths=None) -> dict:
+    car_file_name = _deal.source_file_name + ".car"
+    car_file_path = os.path.join(target_dir, car_file_name)
 
-    with open(csv_path, "w") as csv_file:
-        fieldnames = ['car_file_name', 'car_file_path', 'piece_cid', 'data_cid', 'car_file_size', 'car_file_md5',
-                      'source_file_name', 'source_file_path', 'source_file_size', 'source_file_md5', 'car_file_url']
-        csv_writer = csv.DictWriter(csv_file, delimiter=',', fieldnames=fieldnames)
-        csv_writer.writeheader()
+    _deal.car_file_name = car_file_name
+    _deal.car_file_path = car_file_path
 
-        for _deal in _deal_list:
-            car_file_name = _deal.source_file_name + ".car"
-            car_file_path = os.path.join(target_dir, car_file_name)
-            if os.path.isfile(car_file_path):
-                # car_file_name = _deal.source_file_name + str(int(time.time())) + ".car"
-                car_file_name = _deal.source_file_name + ".car"
-                car_file_path = os.path.join(target_dir, car_file_name)
+    generate_md5 = bool(_deal.car_file_md5)
+    if source_paths:
+        piece_cid, data_cid, source_md5, car_md5 = stage_one_bundle(source_paths, car_file_path, generate_md5)
+    else:
+        piece_cid, data_cid, source_md5, car_md5 = stage_one(_deal.source_file_path, car_file_path, generate_md5)
+    if generate_md5:
+        _deal.source_file_md5 = source_md5
+        _deal.car_file_md5 = car_md5
+    else:
+        car_md5 = ''
+
+    return {
+        'car_file_name': car_file_name,
+        'car_file_path': car_file_path,
+        'piece_cid': piece_cid,
+        'data_cid': data_cid,
+        'car_file_size': os.path.getsize(car_file_path),
+        'car_file_md5': car_md5,
+        'source_file_name': _deal.source_file_name,
+        'source_file_path': _deal.source_file_path,
+        'source_file_size': _deal.source_file_size,
+        'source_file_md5': _deal.source_file_md5,
+        'car_file_url': ''
+    }
 
-            _deal.car_file_name = car_file_name
-            _deal.car_file_path = car_file_path
-            car_md5 = ''
-            if _deal.car_file_md5:
-                car_md5 = checksum(car_file_path)
-            #    _deal.car_file_md5 = car_md5
 
-            piece_cid, data_cid = stage_one(_deal.source_file_path, car_file_path)
-            # _deal.piece_cid = piece_cid
-            # _deal.data_cid = data_cid
-            # _deal.car_file_size = os.path.getsize(car_file_path)
+def cached_car_row(_deal: OfflineDeal, target_dir, cache: CarCache = None, source_paths=None) -> dict:
+    if source_paths:
+        # bundles come from a plan, the cache only knows single files
+        return generate_car_row(_deal, target_dir, source_paths)
+    if cache:
+        rows = cache.get(CAR_MODE_LOTUS, _deal.source_file_path, target_dir, bool(_deal.car_file_md5))
+        if rows:
+            csv_data = rows[0]
+            logging.info("Car file for %s unchanged, reusing %s" % (_deal.source_file_path, csv_data['car_file_path']))
+            _deal.car_file_name = csv_data['car_file_name']
+            _deal.car_file_path = csv_data['car_file_path']
+            if _deal.car_file_md5:
+                _deal.source_file_md5 = csv_data['source_file_md5']
+                _deal.car_file_md5 = csv_data['car_file_md5']
+            return csv_data
+    csv_data = generate_car_row(_deal, target_dir)
+    if cache:
+        cache.put(CAR_MODE_LOTUS, _deal.source_file_path, [csv_data])
+    return csv_data
+
+
+def generate_car(_deal_list: List[OfflineDeal], target_dir, jobs=1, cache: CarCache = None,
+                 append=False, bundles: dict = None, store: JobStore = None) -> List[OfflineDeal]:
+    # bundles maps the source_file_name of a deal to the files packed into its car
+    csv_path = os.path.join(target_dir, "car.csv")
+    jobs = max(1, int(jobs or 1))
+    logging.info("Generating %s car files with %s worker(s)" % (len(_deal_list), jobs))
+
+    start_time = time.time()
+    done_bytes = 0
+    failed = []
+    written = []
+    with open(csv_path, "a" if append else "w") as csv_file, ThreadPoolExecutor(max_workers=jobs) as executor:
+        csv_writer = csv.DictWriter(csv_file, delimiter=',', fieldnames=CAR_CSV_FIELDNAMES)
+        # with append the rows go after those of earlier runs, the header only starts a new file
+        if csv_file.tell() == 0:
+            csv_writer.writeheader()
 
-            csv_data = {
-                'car_file_name': car_file_name,
-                'car_file_path': car_file_path,
-                'piece_cid': piece_cid,
-                'data_cid': data_cid,
-                'car_file_size': os.path.getsize(car_file_path),
-                'car_file_md5': car_md5,
-                'source_file_name': _deal.source_file_name,
-                'source_file_path': _deal.source_file_path,
-                'source_file_size': _deal.source_file_size,
-                'source_file_md5': _deal.source_file_md5,
-                'car_file_url': ''
-            }
+        futures = [executor.submit(cached_car_row, _deal, target_dir, cache, (bundles or {}).get(_deal.source_file_name))
+                   for _deal in _deal_list]
+        # rows are written in submission order so car.csv keeps the order of the deal list
+        for position, (_deal, future) in enumerate(zip(_deal_list, futures)):
+            try:
+                csv_data = future.result()
+            except Exception as e:
+                logging.error("Failed to generate car file for %s: %s" % (_deal.source_file_path, e))
+                failed.append(_deal.source_file_path)
+                continue
             csv_writer.writerow(csv_data)
+            csv_file.flush()
+            if store:
+                store.prepare(csv_data, None if append else position)
+                written.append(csv_data['car_file_path'])
+            done_bytes += int(_deal.source_file_size or 0)
+
+    elapsed = max(time.time() - start_time, 1e-6)
+    logging.info("Generated %s/%s car files in %.1fs, %.2f MiB/s" % (
+        len(_deal_list) - len(failed), len(_deal_list), elapsed, done_bytes / elapsed / 1024 / 1024))
+    if failed:
+        logging.error("Car generation failed for %s file(s): %s" % (len(failed), ", ".join(failed)))
+    if store and not append:
+        store.keep_only(target_dir, written)
 
     logging.info("Car files output dir: " + target_dir)
     logging.info("Please upload car files to web server or ipfs server.")
     return _deal_list
 
-def go_generate_car(_deal_list: List[OfflineDeal], target_dir) -> List[OfflineDeal]:
+def go_generate_car(_deal_list: List[OfflineDeal], target_dir, cache: CarCache = None, batches: dict = None,
+                    slice_size=GRAPHSPLIT_SLICE_SIZE, parallel=GRAPHSPLIT_PARALLEL,
+                    tuning: GraphsplitTuning = None, store: JobStore = None,
+                    slice_sizes: dict = None) -> List[OfflineDeal]:
+    # batches maps the source_file_name of a deal to the (target path, parent path) graphsplit gets for it, so a
+    # whole directory goes through one graphsplit run; other deals are one source file each. slice_sizes maps
+    # the source_file_name of a deal to a slice size of its own, all others are cut into slices of slice_size.
     csv_path = os.path.join(target_dir, "car.csv")
-
+    batches = batches or {}
+    slice_sizes = slice_sizes or {}
+    deal_rows = {}
+
+    for i, _deal in enumerate(_deal_list):
+        batch = batches.get(_deal.source_file_name)
+        if cache and not batch:
+            rows = cache.get(CAR_MODE_GRAPHSPLIT, _deal.source_file_path, target_dir, bool(_deal.car_file_md5))
+            if rows:
+                logging.info("Car files for %s unchanged, reusing %s" % (_deal.source_file_path, len(rows)))
+                deal_rows[i] = rows
+                continue
+        target_path, parent_path = batch or (_deal.source_file_path, '.')
+        deal_slice_size = slice_sizes.get(_deal.source_file_name, slice_size)
+        start_time = time.time()
+        if run_graphsplit(target_path, _deal.source_file_name, target_dir, parent_path, deal_slice_size, parallel) \
+                and tuning:
+            tuning.record(parallel, deal_slice_size, int(_deal.source_file_size or 0), time.time() - start_time)
+
+    # manifest.csv is read once after all runs, car.csv is then built in one pass over the deals
+    manifest = read_manifest(target_dir)
+    written = []
     with open(csv_path, "w") as csv_file:
-        fieldnames = ['car_file_name', 'car_file_path', 'piece_cid', 'data_cid', 'car_file_size', 'car_file_md5',
-                      'source_file_name', 'source_file_path', 'source_file_size', 'source_file_md5', 'car_file_url']
-        csv_writer = csv.DictWriter(csv_file, delimiter=',', fieldnames=fieldnames)
+        csv_writer = csv.DictWriter(csv_file, delimiter=',', fieldnames=CAR_CSV_FIELDNAMES)
         csv_writer.writeheader()
 
-        for _deal in _deal_list:
-            source_file_name = _deal.source_file_name
-            car_md5 = ''
-            # car_file_name = _deal.source_file_name + ".car"
-            # car_file_path = os.path.join(target_dir, car_file_name)
-            #
-            # if os.path.isfile(car_file_path):
-            #     # car_file_name = _deal.source_file_name + str(int(time.time())) + ".car"
-            #     car_file_name = _deal.source_file_name + ".car"
-            #     car_file_path = os.path.join(target_dir, car_file_name)
-            #
-            # _deal.car_file_name = car_file_name
-            # _deal.car_file_path = car_file_path
-            # car_md5 = ''
-            # if _deal.car_file_md5:
-            #     car_md5 = checksum(car_file_path)
-            #    _deal.car_file_md5 = car_md5
-
-            ###piece_cid, data_cid = stage_one(_deal.source_file_path, car_file_path)
-            command_line = "./graphsplit chunk --car-dir={} --slice-size=1000000000 --parallel=2 --graph-name={} --calc-commp=true --parent-path=. {}".format(target_dir, _deal.source_file_name,  _deal.source_file_path)
-            subprocess.run((command_line), shell=True)
-            
-            with open(os.path.join(target_dir,"manifest.csv"),newline='') as csvfile:
-                   reader = csv.DictReader(csvfile)
-                   for row in reader:
-                        if row["filename"].startswith(source_file_name):
-                            datacid = row["playload_cid"] 
-                            car_file_path = os.path.join(target_dir, row["playload_cid"] +'.car')
-                            piececid = row["piece_cid"]
-                            car_file_name = row["playload_cid"] +'.car'
-
-                            # no piece_cid generated. use data_cid instead
-                            data_cid=datacid
-                            piece_cid = piececid
-                            # _deal.piece_cid = piece_cid
-                            # _deal.data_cid = data_cid
-                            # _deal.car_file_size = os.path.getsize(car_file_path)
-                            if _deal.car_file_md5:
-                                car_md5 = checksum(car_file_path)
-
-                            csv_data = {
-                                'car_file_name': car_file_name,
-                                'car_file_path': car_file_path,
-                                'piece_cid': piece_cid,
-                                'data_cid': data_cid,
-                                'car_file_size': os.path.getsize(car_file_path),
-                                'car_file_md5': car_md5,
-                                'source_file_name': _deal.source_file_name,
-                                'source_file_path': _deal.source_file_path,
-                                'source_file_size': _deal.source_file_size,
-                                'source_file_md5': _deal.source_file_md5,
-                                'car_file_url': ''
-                            }
-                            csv_writer.writerow(csv_data)
+        for i, _deal in enumerate(_deal_list):
+            if i in deal_rows:
+                csv_writer.writerows(deal_rows[i])
+                written.extend(deal_rows[i])
+                continue
+            slices = manifest.get(_deal.source_file_name)
+            if not slices:
+                logging.error("No car file generated for %s" % _deal.source_file_path)
+                continue
+            rows = []
+            for part, graph_slice in enumerate(slices):
+                car_file_name = graph_slice['data_cid'] + '.car'
+                car_file_path = os.path.join(target_dir, car_file_name)
+                source_file_size = _deal.source_file_size
+                if len(slices) > 1:
+                    # graphsplit cuts the data into slices of exactly slice_size, the last one takes the rest
+                    deal_slice_size = slice_sizes.get(_deal.source_file_name, slice_size)
+                    source_file_size = min(deal_slice_size, int(_deal.source_file_size) - part * deal_slice_size)
+                rows.append({
+                    'car_file_name': car_file_name,
+                    'car_file_path': car_file_path,
+                    'piece_cid': graph_slice['piece_cid'],
+                    'data_cid': graph_slice['data_cid'],
+                    'car_file_size': os.path.getsize(car_file_path),
+                    'car_file_md5': checksum(car_file_path) if _deal.car_file_md5 else '',
+                    'source_file_name': graph_slice['slice_name'] if len(slices) > 1 else _deal.source_file_name,
+                    'source_file_path': _deal.source_file_path,
+                    'source_file_size': source_file_size,
+                    'source_file_md5': _deal.source_file_md5,
+                    'car_file_url': ''
+                })
+            csv_writer.writerows(rows)
+            if cache and _deal.source_file_name not in batches:
+                cache.put(CAR_MODE_GRAPHSPLIT, _deal.source_file_path, rows)
+            written.extend(rows)
+
+    if store:
+        for position, row in enumerate(written):
+            store.prepare(row, position)
+        store.keep_only(target_dir, [row['car_file_path'] for row in written])
 
     logging.info("Car files output dir: " + target_dir)
     logging.info("Please upload car files to web server or ipfs server.")
@@ -192,14 +272,33 @@ def update_task_by_uuid(config_path, task_uuid, miner_fid, csv):
     api_url = config['main']['api_url']
     api_key = config['main']['api_key']
     access_token = config['main']['access_token']
+    configure_swan_api(config)
     client = SwanClient(api_url, api_key, access_token)
     client.update_task_by_uuid(task_uuid, miner_fid, csv)
+    store = load_job_store(config)
+    if store:
+        store.deals_reported(task_uuid, miner_fid)
 
 
-def generate_car_files(input_dir, config_path, out_dir):
+def plan_car_files(input_dir, config_path, out_dir):
+    config = read_config(config_path)
+    sector_size = config['sender'].get('bundle_sector_size', BUNDLE_SECTOR_SIZE)
+    max_files = config['sender'].get('bundle_max_files', BUNDLE_MAX_FILES)
+    output_dir = out_dir or config['sender']['output_dir']
+    Path(output_dir).mkdir(parents=True, exist_ok=True)
+
+    files = [(file_path, os.path.getsize(file_path)) for file_path in read_file_path_in_dir(input_dir)]
+    bundles = plan_bundles(files, sector_size, max_files)
+    plan_path = os.path.join(output_dir, "plan.json")
+    write_plan(bundles, plan_path, sector_size)
+    return plan_path
+
+
+def generate_car_files(input_dir, config_path, out_dir, jobs=None, plan_path=None):
     config = read_config(config_path)
     generate_md5 = config['sender']['generate_md5']
-    file_paths = read_file_path_in_dir(input_dir)
+    if not jobs:
+        jobs = config['sender'].get('car_jobs', 1)
     output_dir = out_dir
     if not output_dir:
         output_dir = config['sender']['output_dir'] + '/' + str(uuid.uuid4())
@@ -207,25 +306,41 @@ def generate_car_files(input_dir, config_path, out_dir):
     Path(output_dir).mkdir(parents=True, exist_ok=True)
 
     deal_list: List[OfflineDeal] = []
+    bundles = {}
+
+    if plan_path:
+        # one car per planned bundle, a bundle of one file is converted on its own as without a plan
+        for bundle in read_plan(plan_path)['bundles']:
+            offline_deal = OfflineDeal()
+            if len(bundle['files']) == 1:
+                offline_deal.source_file_name = os.path.basename(bundle['files'][0])
+                offline_deal.source_file_path = bundle['files'][0]
+            else:
+                offline_deal.source_file_name = bundle['name']
+                offline_deal.source_file_path = os.path.commonpath(bundle['files'])
+                bundles[bundle['name']] = bundle['files']
+            offline_deal.source_file_size = bundle['size']
+            if generate_md5:
+                offline_deal.car_file_md5 = True
+            deal_list.append(offline_deal)
+    else:
+        for file_path in read_file_path_in_dir(input_dir):
+            source_file_name = os.path.basename(file_path)
 
-    for file_path in file_paths:
-        source_file_name = os.path.basename(file_path)
+            offline_deal = OfflineDeal()
+            offline_deal.source_file_name = source_file_name
+            offline_deal.source_file_path = file_path
+            offline_deal.source_file_size = os.path.getsize(file_path)
 
-        offline_deal = OfflineDeal()
-        offline_deal.source_file_name = source_file_name
-        offline_deal.source_file_path = file_path
-        offline_deal.source_file_size = os.path.getsize(file_path)
-        
-        if generate_md5:
-            offline_deal.car_file_md5 = True
-        deal_list.append(offline_deal)
+            if generate_md5:
+                offline_deal.car_file_md5 = True
+            deal_list.append(offline_deal)
 
-    generate_car(deal_list, output_dir)
+    generate_car(deal_list, output_dir, jobs, load_car_cache(config), bundles=bundles, store=load_job_store(config))
 
-def go_generate_car_files(input_dir, config_path, out_dir):
+def go_generate_car_files(input_dir, config_path, out_dir, batch=False, plan_path=None):
     config = read_config(config_path)
     generate_md5 = config['sender']['generate_md5']
-    file_paths = read_file_path_in_dir(input_dir)
     output_dir = out_dir
     if not output_dir:
         output_dir = config['sender']['output_dir'] + '/' + str(uuid.uuid4())
@@ -233,22 +348,68 @@ def go_generate_car_files(input_dir, config_path, out_dir):
     Path(output_dir).mkdir(parents=True, exist_ok=True)
 
     deal_list: List[OfflineDeal] = []
-
-    for file_path in file_paths:
-        source_file_name = os.path.basename(file_path)
-
+    batches = {}
+    slice_sizes = {}
+    staging_dirs = []
+    plan = read_plan(plan_path) if plan_path else None
+    tuning = load_graphsplit_tuning(config)
+    parallel, slice_size = tuning.tune([file_path for bundle in plan['bundles'] for file_path in bundle['files']]
+                                       if plan else read_file_path_in_dir(input_dir))
+
+    if plan:
+        # every bundle of several files is staged as a directory of links and goes through graphsplit at once,
+        # with a slice size that keeps it in one car
+        for bundle in plan['bundles']:
+            offline_deal = OfflineDeal()
+            if len(bundle['files']) == 1:
+                offline_deal.source_file_name = os.path.basename(bundle['files'][0])
+                offline_deal.source_file_path = bundle['files'][0]
+            else:
+                staging_dir = os.path.join(output_dir, bundle['name'])
+                Path(staging_dir).mkdir(exist_ok=True)
+                for file_path in bundle['files']:
+                    link_path = os.path.join(staging_dir, os.path.basename(file_path))
+                    if not os.path.lexists(link_path):
+                        os.symlink(os.path.abspath(file_path), link_path)
+                staging_dirs.append(staging_dir)
+                offline_deal.source_file_name = bundle['name']
+                offline_deal.source_file_path = os.path.commonpath(bundle['files'])
+                batches[bundle['name']] = (staging_dir, staging_dir)
+                # a planned bundle fits a sector, its slice is the whole bundle; files too large for a sector
+                # keep the tuned slice size so each slice still fits one
+                slice_sizes[bundle['name']] = max(slice_size, piece_capacity(plan['sector_size']))
+            offline_deal.source_file_size = bundle['size']
+            deal_list.append(offline_deal)
+    elif batch:
+        # the whole input dir in one graphsplit run, cut into slices of slice_size
+        input_dir = os.path.abspath(input_dir)
         offline_deal = OfflineDeal()
-        offline_deal.source_file_name = source_file_name
-        offline_deal.source_file_path = file_path
-        offline_deal.source_file_size = os.path.getsize(file_path)
-        
-        if generate_md5:
-            offline_deal.car_file_md5 = True
+        offline_deal.source_file_name = os.path.basename(input_dir)
+        offline_deal.source_file_path = input_dir
+        offline_deal.source_file_size = sum(os.path.getsize(file_path) for file_path in read_file_path_in_dir(input_dir))
         deal_list.append(offline_deal)
+        batches[offline_deal.source_file_name] = (input_dir, input_dir)
+    else:
+        for file_path in read_file_path_in_dir(input_dir):
+            offline_deal = OfflineDeal()
+            offline_deal.source_file_name = os.path.basename(file_path)
+            offline_deal.source_file_path = file_path
+            offline_deal.source_file_size = os.path.getsize(file_path)
+            deal_list.append(offline_deal)
+
+    if generate_md5:
+        for offline_deal in deal_list:
+            offline_deal.car_file_md5 = True
+
+    try:
+        go_generate_car(deal_list, output_dir, load_car_cache(config), batches, slice_size, parallel, tuning,
+                        load_job_store(config), slice_sizes)
+    finally:
+        for staging_dir in staging_dirs:
+            shutil.rmtree(staging_dir, ignore_errors=True)
 
-    go_generate_car(deal_list, output_dir)
 
-def upload_car_files(input_dir, config_path):
+def upload_car_files(input_dir, config_path, jobs=None):
 
     class CarFile:
         car_file_name = None
@@ -270,30 +431,96 @@ def upload_car_files(input_dir, config_path):
     if storage_server_type == "web server":
         logging.info("Please upload car files to web server manually.")
     else:
-        gateway_address = config['ipfs-server']['download_stream_url']
-        api_address = config['ipfs-server']['upstream_url']
+        if not jobs:
+            jobs = config['sender'].get('upload_jobs', 1)
+        jobs = max(1, int(jobs))
+        uploader = IpfsUploader(config)
+        store = load_job_store(config)
         car_files_list: List[CarFile] = []
         car_csv_path = input_dir + "/car.csv"
-        with open(car_csv_path, "r") as csv_file:
-            reader = csv.DictReader(csv_file, delimiter=',', fieldnames=attributes)
-            next(reader, None)
-            for row in reader:
+        if store:
+            if not store.has_files(input_dir):
+                store.import_car_csv(input_dir, car_csv_path, attributes)
+            for row in store.files(input_dir):
                 car_file = CarFile()
-                for attr in row.keys():
+                for attr in attributes:
                     car_file.__setattr__(attr, row.get(attr))
+                car_file.car_file_address = row['car_file_url']
                 car_files_list.append(car_file)
-        for car_file in car_files_list:
-            logging.info("Uploading car file %s" % car_file.car_file_name)
-            car_file_hash = SwanClient.upload_car_to_ipfs(car_file.car_file_path,api_address)
-            if car_file_hash:
-                car_file.car_file_address = gateway_address + "/ipfs/" + car_file_hash
-                logging.info("Car file %s uploaded: %s" % (car_file.car_file_name ,car_file.car_file_address))
-
-        with open(car_csv_path, "w") as csv_file:
-            csv_writer = csv.DictWriter(csv_file, delimiter=',', fieldnames=attributes)
-            csv_writer.writeheader()
-            for car_file in car_files_list:
-                csv_writer.writerow(car_file.__dict__)
+        else:
+            with open(car_csv_path, "r") as csv_file:
+                reader = csv.DictReader(csv_file, delimiter=',', fieldnames=attributes)
+                next(reader, None)
+                for row in reader:
+                    car_file = CarFile()
+                    for attr in row.keys():
+                        car_file.__setattr__(attr, row.get(attr))
+                    car_files_list.append(car_file)
+
+        csv_lock = threading.Lock()
+
+        def write_car_csv():
+            if store:
+                store.export_car_csv(input_dir, car_csv_path, attributes)
+                return
+            # written to a temp file and renamed, so an interrupted run always leaves a complete car.csv
+            with csv_lock:
+                tmp_csv_path = car_csv_path + ".tmp"
+                with open(tmp_csv_path, "w") as csv_file:
+                    csv_writer = csv.DictWriter(csv_file, delimiter=',', fieldnames=attributes)
+                    csv_writer.writeheader()
+                    for car_file in car_files_list:
+                        csv_writer.writerow(car_file.__dict__)
+                os.replace(tmp_csv_path, car_csv_path)
+
+        def upload(car_file):
+            car_file_address, size = uploader.upload(car_file.car_file_name, car_file.car_file_path,
+                                                     car_file.piece_cid, car_file.data_cid)
+            if not car_file_address:
+                return None
+            car_file.car_file_address = car_file_address
+            # with the store only the one row is updated, car.csv is exported once at the end
+            if store:
+                store.uploaded(car_file.car_file_path, car_file_address)
+            else:
+                write_car_csv()
+            return size
+
+        # files that got an address in an earlier run are not uploaded again
+        pending = [car_file for car_file in car_files_list if not car_file.car_file_address]
+        if len(pending) < len(car_files_list):
+            logging.info("Skipping %s car files already uploaded" % (len(car_files_list) - len(pending)))
+        logging.info("Uploading %s car files with %s worker(s)" % (len(pending), jobs))
+
+        start_time = time.time()
+        uploaded_bytes = 0
+        failed = []
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            for car_file, size in zip(pending, executor.map(upload, pending)):
+                if size is None:
+                    failed.append(car_file.car_file_name)
+                else:
+                    uploaded_bytes += size
+
+        elapsed = max(time.time() - start_time, 1e-6)
+        logging.info("Uploaded %s/%s car files, %.1f MiB in %.1fs, %.2f MiB/s" % (
+            len(pending) - len(failed), len(pending), uploaded_bytes / 1024 / 1024, elapsed,
+            uploaded_bytes / elapsed / 1024 / 1024))
+        if failed:
+            logging.error("Upload failed for %s car file(s), run upload again to retry: %s" % (
+                len(failed), ", ".join(failed)))
+        write_car_csv()
+
+
+def web_server_url_prefix(config) -> str:
+    host = config['web-server']['host']
+    port = config['web-server']['port']
+    path = str(config['web-server']['path']).strip("/")
+
+    download_url_prefix = str(host).rstrip("/") + ":" + str(port)
+    if path:
+        download_url_prefix = os.path.join(download_url_prefix, path)
+    return download_url_prefix
 
 
 def create_new_task(input_dir, out_dir, config_path, task_name, curated_dataset, description, miner_id=None):
@@ -306,37 +533,17 @@ def create_new_task(input_dir, out_dir, config_path, task_name, curated_dataset,
     verified_deal = config['sender']['verified_deal']
     generate_md5 = config['sender']['generate_md5']
     offline_mode = config['sender']['offline_mode']
-    fast_retrieval = config['sender']['fast_retrieval']
-    max_price = config['sender']['max_price']
-    bid_mode = config['sender']['bid_mode']
     start_epoch = config['sender']['start_epoch_hours']
-    expire_days = config['sender']['expire_days']
-
-    if not expire_days:
-        expire_days = 4
-
-    api_url = config['main']['api_url']
-    api_key = config['main']['api_key']
-    access_token = config['main']['access_token']
 
     storage_server_type = config['main']['storage_server_type']
-
-    host = config['web-server']['host']
-    port = config['web-server']['port']
-    path = config['web-server']['path']
-
-    download_url_prefix = str(host).rstrip("/")
-    download_url_prefix = download_url_prefix + ":" + str(port)
+    download_url_prefix = web_server_url_prefix(config)
 
     task_uuid = str(uuid.uuid4())
     final_csv_path = ""
 
-    path = str(path).strip("/")
     logging.info(
         "Swan Client Settings: Public Task: %s,  Verified Deals: %s,  Connected to Swan: %s, CSV/car File output dir: %s"
         % (str(public_deal).lower(), str(verified_deal).lower(), str(not offline_mode).lower(), output_dir))
-    if path:
-        download_url_prefix = os.path.join(download_url_prefix, path)
     # TODO: Need to support 2 stage
     if not public_deal:
         if not miner_id:
@@ -361,17 +568,25 @@ def create_new_task(input_dir, out_dir, config_path, task_name, curated_dataset,
 
     deal_list: List[OfflineDeal] = []
     csv_file_path = input_dir + "/car.csv"
-    with open(csv_file_path, "r") as csv_file:
-        fieldnames = ['car_file_name', 'car_file_path', 'piece_cid', 'data_cid', 'car_file_size', 'car_file_md5',
-                      'source_file_name', 'source_file_path', 'source_file_size', 'source_file_md5', 'car_file_url']
-        reader = csv.DictReader(csv_file, delimiter=',', fieldnames=fieldnames)
-        next(reader, None)
-        for row in reader:
-            deal = OfflineDeal()
-            for attr in row.keys():
-                deal.__setattr__(attr, row.get(attr))
-                deal.start_epoch = get_current_epoch_by_current_time() + (start_epoch + 1) * EPOCH_PER_HOUR
-            deal_list.append(deal)
+    store = load_job_store(config)
+    if store:
+        if not store.has_files(input_dir):
+            store.import_car_csv(input_dir, csv_file_path, CAR_CSV_FIELDNAMES)
+        rows = store.files(input_dir)
+        # deals proposed by an earlier run that stopped before the task was created are kept under its uuid
+        if not public_deal:
+            task_uuid = store.pending_task_uuid(input_dir, miner_id) or task_uuid
+    else:
+        with open(csv_file_path, "r") as csv_file:
+            reader = csv.DictReader(csv_file, delimiter=',', fieldnames=CAR_CSV_FIELDNAMES)
+            next(reader, None)
+            rows = list(reader)
+    for row in rows:
+        deal = OfflineDeal()
+        for attr in CAR_CSV_FIELDNAMES:
+            deal.__setattr__(attr, row.get(attr))
+        deal.start_epoch = get_current_epoch_by_current_time() + (start_epoch + 1) * EPOCH_PER_HOUR
+        deal_list.append(deal)
 
     # generate_car(deal_list, output_dir)
 
@@ -382,23 +597,31 @@ def create_new_task(input_dir, out_dir, config_path, task_name, curated_dataset,
     if not public_deal:
         final_csv_path = send_deals(config_path, miner_id, task_name, deal_list=deal_list, task_uuid=task_uuid, out_dir=output_dir)
 
-    if offline_mode:
+    submit_task(config, task_name, curated_dataset, description, miner_id, deal_list, output_dir, task_uuid, store)
+
+
+def submit_task(config, task_name, curated_dataset, description, miner_id, deal_list: List[OfflineDeal], output_dir,
+                task_uuid, store: JobStore = None):
+    # writes the metadata and task csvs of deal_list and creates the task on Swan unless in offline mode
+    sender = config['sender']
+    if sender['offline_mode']:
         client = None
         logging.info("Working in Offline Mode. You need to manually send out task on filwan.com. ")
     else:
-        client = SwanClient(api_url, api_key, access_token)
+        configure_swan_api(config)
+        client = SwanClient(config['main']['api_url'], config['main']['api_key'], config['main']['access_token'])
         logging.info("Working in Online Mode. A swan task will be created on the filwan.com after process done. ")
 
     task = SwanTask(
         task_name=task_name,
         curated_dataset=curated_dataset,
         description=description,
-        is_public=public_deal,
-        is_verified=verified_deal,
-        fast_retrieval = fast_retrieval,
-        max_price = max_price,
-        bid_mode = bid_mode,
-        expire_days = expire_days
+        is_public=sender['public_deal'],
+        is_verified=sender['verified_deal'],
+        fast_retrieval = sender['fast_retrieval'],
+        max_price = sender['max_price'],
+        bid_mode = sender['bid_mode'],
+        expire_days = sender['expire_days'] or 4
     )
 
     if miner_id:
@@ -406,6 +629,10 @@ def create_new_task(input_dir, out_dir, config_path, task_name, curated_dataset,
 
     generate_metadata_csv(deal_list, task, output_dir, task_uuid)
     generate_csv_and_send(task, deal_list, output_dir, client, task_uuid)
+    # in offline mode the task csv is what goes to Swan, a later run must not take its deals for a new task
+    if store:
+        store.reported(task_uuid, [deal.car_file_path for deal in deal_list if deal.car_file_path], miner_id)
+
 
 def get_task_info(task_uuid,config_path):
     config = read_config(config_path)
@@ -425,57 +652,48 @@ def get_task_info(task_uuid,config_path):
     logging.info('Swan task status is: %s'% json.dumps(task_bid_dict))
     return task_bid_dict
 
-def get_assigned_tasks(config_path):
+def get_assigned_tasks(config_path, updated_after=None):
+    # Assigned tasks updated after updated_after. high_water_mark is the newest updated_on listed; complete is
+    # False when paging may have skipped a task, the caller should then scan from the same mark again.
     config = read_config(config_path)
     api_url = config['main']['api_url']
     api_key = config['main']['api_key']
     access_token = config['main']['access_token']
 
-    refresh_api_token_suffix = "/user/api_keys/jwt"
-    refresh_api_token_method = 'POST'
-
-    refresh_token_url = api_url + refresh_api_token_suffix
-    data = {
-        "apikey": api_key,
-        "access_token": access_token
-    }
-    jwt_token=""
-    try:
-        resp_data = send_http_request(refresh_token_url, refresh_api_token_method, None, json.dumps(data))
-        jwt_token = resp_data['jwt']
-        payload = jwt.decode(jwt=jwt_token, verify=False, algorithm='HS256')
-        jwt_token_expiration = payload['exp']
-    except Exception as e:
-        logging.info(str(e))
+    configure_swan_api(config)
+    client = SwanClient(api_url, api_key, access_token)
     logging.info('Getting My swan tasks info')
-    get_task_url_suffix = '/tasks'
-    get_task_method = 'GET'
-
-    get_task_url = api_url + get_task_url_suffix
-    payload_data = ""
-    resp=send_http_request(get_task_url, get_task_method,jwt_token, payload_data)
-    limit=resp['total_task_count']
-    logging.info('Swan task count %s'%str(limit))
-    get_task_url = api_url + get_task_url_suffix+"?limit="+str(limit)
-    payload_data = ""
-    resp=send_http_request(get_task_url, get_task_method,jwt_token, payload_data)
-    tasks = resp['task']
     assigned_task_list=[]
-    for task in tasks:
-        if task["status"] == 'Assigned' and task["miner_id"]:
+    high_water_mark = updated_after
+    scan = {}
+    for task in client.iter_tasks(status='Assigned', updated_after=updated_after, scan=scan):
+        updated_on = task_updated_on(task)
+        if updated_on is not None and (high_water_mark is None or updated_on > high_water_mark):
+            high_water_mark = updated_on
+        if task["miner_id"]:
             assigned_task_list.append(task)
     logging.info('Assigned autobid Swan task count %s'%str(len(assigned_task_list)))
-    assigned_task_dict={'Assigned tasks': assigned_task_list}
+    if not scan['complete']:
+        logging.warning('Assigned tasks changed while paging, some may have been missed')
+    assigned_task_dict={'Assigned tasks': assigned_task_list, 'high_water_mark': high_water_mark,
+                        'complete': scan['complete']}
     return assigned_task_dict
 
-def send_autobid_deal(deals,miner_id,task_info,config_path,out_dir):
+def send_autobid_deal(deals,miner_id,task_info,config_path,out_dir,ledger=None):
     config = read_config(config_path)
-    deals_list=[]
-    for _deal in deals:
+    configure_lotus(config)
+    configure_ask_cache(config)
+    prices = get_miner_price(miner_id)
+
+    def propose(_deal):
+        if ledger:
+            sent = ledger.deal(task_info['uuid'], _deal["id"])
+            if sent:
+                logging.info('Deal %s of task %s already sent, deal cid: %s' % (_deal["id"], task_info['uuid'], sent["deal_cid"]))
+                return sent
         data_cid = _deal["payload_cid"]
         piece_cid = _deal["piece_cid"]
         file_size = _deal["file_size"]
-        prices = get_miner_price(miner_id)
         real_price = None
         if prices:
             if task_info["type"]:
@@ -486,9 +704,7 @@ def send_autobid_deal(deals,miner_id,task_info,config_path,out_dir):
             else:
                 real_price = prices['price']
         else:
-            logging.warning(
-                "Did not find price for miner %s" % miner_id)
-            continue
+            raise DealFailure(FAILURE_PRICE, "Did not find price for miner %s" % miner_id)
         from_wallet = config['sender']['wallet']
         max_price = task_info["max_price"]
         fast_retrieval = task_info['fast_retrieval']
@@ -509,31 +725,23 @@ def send_autobid_deal(deals,miner_id,task_info,config_path,out_dir):
         skip_confirmation = True
         deal_config = DealConfig(miner_id, from_wallet, max_price, task_type, fast_retrieval,"", start_epoch)
 
-        if Decimal(real_price).compare(Decimal(max_price)) > 0:
-            logging.warning(
-                "miner %s price %s higher than max price %s" % (miner_id, real_price, max_price))
-            continue
-        sector_size = None
-        if file_size:
-            if int(file_size) > 0:
-                piece_size, sector_size = calculate_piece_size_from_file_size(file_size)
-            else:
-                logging.error("file is too small")
-                continue
-        cost = None
-        if sector_size:
-            cost = f'{calculate_real_cost(sector_size, real_price):.18f}'
-        i=0
-        while i < 60:
-            _deal_cid, _start_epoch = propose_offline_deals(real_price,str(cost), str(piece_size), data_cid, piece_cid,
-                                                           deal_config, skip_confirmation,i)
-            if _deal_cid:
-                deals_list.append({"deal_cid":_deal_cid,"start_epoch":_start_epoch,"uuid":task_info['uuid'],'miner_id': miner_id,'md5': _deal["md5_origin"],'file_source_url': _deal["file_source_url"],'payload_cid': _deal["payload_cid"],"file_size":_deal["file_size"],'piece_cid':_deal["piece_cid"]})
-                break
-            else:
-                i = i+1
-        if not _deal_cid:
-            logging.info('Sending deal failure: deal id %s'%(_deal["id"]))
+        piece_size, sector_size = check_deal(real_price, max_price, miner_id, file_size)
+        cost = f'{calculate_real_cost(sector_size, real_price):.18f}'
+        _deal_cid, _start_epoch = propose_with_retry(
+            lambda epoch: propose_offline_deals(real_price, str(cost), str(piece_size), data_cid, piece_cid,
+                                                deal_config, skip_confirmation, epoch)[0],
+            int(start_epoch))
+        sent = {"deal_cid":_deal_cid,"start_epoch":_start_epoch,"uuid":task_info['uuid'],'miner_id': miner_id,'md5': _deal["md5_origin"],'file_source_url': _deal["file_source_url"],'payload_cid': _deal["payload_cid"],"file_size":_deal["file_size"],'piece_cid':_deal["piece_cid"]}
+        if ledger:
+            ledger.record_deal(task_info['uuid'], _deal["id"], sent)
+        return sent
+
+    results = propose_deals(propose, deals, config['sender'].get('deal_jobs', 1))
+    deals_list = [deal for deal in results if deal]
+    if not deals_list:
+        # nothing for Swan yet, the task stays assigned and is tried again
+        logging.warning('No deal of task %s sent to miner %s' % (task_info['uuid'], miner_id))
+        return None
 
     ## save assigned metadata csv
     output_dir = out_dir
@@ -590,23 +798,8 @@ def update_assigned_task(config_path, task_uuid, info_output_csv_path):
     api_key = config['main']['api_key']
     access_token = config['main']['access_token']
 
-    logging.info('Refreshing token')
-    refresh_api_token_suffix = "/user/api_keys/jwt"
-    refresh_api_token_method = 'POST'
-
-    refresh_token_url = api_url + refresh_api_token_suffix
-    data = {
-        "apikey": api_key,
-        "access_token": access_token
-    }
-    jwt_token=""
-    try:
-        resp_data = send_http_request(refresh_token_url, refresh_api_token_method, None, json.dumps(data))
-        jwt_token = resp_data['jwt']
-        payload = jwt.decode(jwt=jwt_token, verify=False, algorithm='HS256')
-        jwt_token_expiration = payload['exp']
-    except Exception as e:
-        logging.info(str(e))
+    configure_swan_api(config)
+    jwt_token = get_token_manager(api_url, api_key, access_token).get()
     logging.info('Updating Swan task.')
 
     get_task_url_suffix = '/tasks/'
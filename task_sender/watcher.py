@@ -0,0 +1,167 @@
+import csv
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import time
+from os.path import isfile, join
+from pathlib import Path
+from typing import List
+
+from common.OfflineDeal import OfflineDeal
+from common.config import read_config
+from task_sender.service.car_cache import CarCache, load_car_cache
+from task_sender.service.job_store import JobStore, load_job_store
+from task_sender.swan_task_sender import generate_car, upload_car_files
+
+WATCH_SETTLE = 30
+WATCH_POLL = 10
+
+# inotify(7) events that mean a file in the directory may have changed or appeared
+IN_MODIFY = 0x002
+IN_ATTRIB = 0x004
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+WATCH_EVENTS = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+
+
+class Inotify:
+    # Bare inotify watch on one directory through libc. Events are only used to wake the watcher early, which
+    # files are ready is always decided from a fresh scan, so they are drained without being parsed.
+    def __init__(self, path: str):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_EVENTS) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, 'inotify_add_watch failed for %s' % path)
+
+    def wait(self, timeout) -> bool:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return False
+        try:
+            while os.read(self.fd, 64 * 1024):
+                pass
+        except BlockingIOError:
+            pass
+        return True
+
+    def close(self):
+        os.close(self.fd)
+
+
+class DirectoryWatcher:
+    # Converts files arriving in input_dir into car files in out_dir as they come, appending to one rolling
+    # car.csv there. A file is taken once its size and mtime have not changed for settle seconds; hidden files,
+    # which is how rsync and most uploaders name partial files, are left alone. Files already in car.csv are
+    # not converted again, so the watcher can be restarted at any time.
+    def __init__(self, input_dir, out_dir, config_path, jobs=1, settle=WATCH_SETTLE, poll=WATCH_POLL, upload=False,
+                 generate_md5=False, cache: CarCache = None, store: JobStore = None):
+        self.input_dir = input_dir
+        self.out_dir = out_dir
+        self.config_path = config_path
+        self.jobs = max(1, int(jobs))
+        self.settle = settle
+        self.poll = poll
+        self.upload = upload
+        self.generate_md5 = generate_md5
+        self.cache = cache
+        self.store = store
+        self._seen = {}
+        self._done = self._read_done()
+        try:
+            self._notify = Inotify(input_dir)
+        except (OSError, AttributeError) as e:
+            logging.info('inotify not available (%s), polling %s every %ss' % (e, input_dir, poll))
+            self._notify = None
+
+    def _read_done(self) -> set:
+        csv_path = os.path.join(self.out_dir, 'car.csv')
+        if not os.path.isfile(csv_path):
+            return set()
+        with open(csv_path, newline='') as csv_file:
+            return {row['source_file_path'] for row in csv.DictReader(csv_file)}
+
+    def ready_files(self) -> List[str]:
+        now = time.time()
+        present = {}
+        for name in sorted(os.listdir(self.input_dir)):
+            path = join(self.input_dir, name)
+            if name.startswith('.') or path in self._done or not isfile(path):
+                continue
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                continue
+            identity = (st.st_size, st.st_mtime_ns)
+            seen = self._seen.get(path)
+            # the settle time starts again whenever the file is still being written
+            present[path] = seen if seen and seen[0] == identity else (identity, now)
+        self._seen = present
+        return [path for path, (identity, since) in present.items() if now - since >= self.settle]
+
+    def process(self, file_paths: List[str]):
+        deal_list: List[OfflineDeal] = []
+        for file_path in file_paths:
+            offline_deal = OfflineDeal()
+            offline_deal.source_file_name = os.path.basename(file_path)
+            offline_deal.source_file_path = file_path
+            offline_deal.source_file_size = os.path.getsize(file_path)
+            if self.generate_md5:
+                offline_deal.car_file_md5 = True
+            deal_list.append(offline_deal)
+
+        generate_car(deal_list, self.out_dir, self.jobs, self.cache, append=True, store=self.store)
+        # a file that failed is only tried again after a restart, it is not picked up on every scan
+        for file_path in file_paths:
+            self._done.add(file_path)
+            self._seen.pop(file_path, None)
+        if self.upload:
+            upload_car_files(self.out_dir, self.config_path)
+
+    def run_once(self) -> int:
+        file_paths = self.ready_files()
+        if file_paths:
+            logging.info('%s new file(s) ready in %s' % (len(file_paths), self.input_dir))
+            self.process(file_paths)
+        return len(file_paths)
+
+    def wait(self):
+        # files still settling are checked again as soon as they may be ready
+        timeout = min(self.poll, self.settle) if self._seen else self.poll
+        if self._notify:
+            self._notify.wait(timeout)
+            # a burst of events is one change, let it finish before scanning
+            time.sleep(min(1, timeout))
+        else:
+            time.sleep(timeout)
+
+    def run_forever(self):
+        logging.info('Watching %s, car files go to %s' % (self.input_dir, self.out_dir))
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                logging.error('Watch scan of %s failed: %s' % (self.input_dir, e))
+            self.wait()
+
+
+def watch_input_dir(input_dir, config_path, out_dir=None, jobs=None, upload=None):
+    config = read_config(config_path)
+    sender = config['sender']
+    out_dir = out_dir or os.path.join(sender['output_dir'], 'watch')
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    watcher = DirectoryWatcher(input_dir, out_dir, config_path,
+                               jobs=jobs or sender.get('car_jobs', 1),
+                               settle=sender.get('watch_settle', WATCH_SETTLE),
+                               poll=sender.get('watch_poll', WATCH_POLL),
+                               upload=sender.get('watch_upload', False) if upload is None else upload,
+                               generate_md5=sender['generate_md5'],
+                               cache=load_car_cache(config),
+                               store=load_job_store(config))
+    watcher.run_forever()
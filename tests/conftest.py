@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+import toml
+
+# modules import each other as common.* and task_sender.*, from the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+REPO_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'config.toml')
+
+
+@pytest.fixture
+def make_config(tmp_path):
+    # config.toml of the repository with every path under tmp_path and the given [section] overrides
+    def make(**sections):
+        config = toml.load(REPO_CONFIG)
+        sender = config['sender']
+        sender['output_dir'] = str(tmp_path / 'tasks')
+        for key in ('car_cache', 'gocar_history', 'autobid_ledger', 'ask_cache_path', 'job_store'):
+            sender[key] = ''
+        config['ipfs-server']['upload_index'] = ''
+        for section, values in sections.items():
+            config[section.replace('_', '-')].update(values)
+        path = tmp_path / 'config.toml'
+        path.write_text(toml.dumps(config))
+        return str(path), config
+    return make
@@ -0,0 +1,80 @@
+import asyncio
+import io
+import time
+
+from aiohttp import web
+
+from common.async_swan_client import AsyncSwanClient
+from common.swan_client import SwanTask
+
+
+async def _serve(handler):
+    app = web.Application()
+    app.router.add_route('*', '/{tail:.*}', handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, 'http://127.0.0.1:%s' % port
+
+
+def _client(api_url):
+    client = AsyncSwanClient(api_url, 'key', 'token')
+    client.token_manager.jwt_token = 'jwt'
+    client.token_manager.jwt_token_expiration = time.time() + 3600
+    return client
+
+
+def test_post_task_sends_form_fields_as_strings():
+    received = {}
+
+    async def handler(request):
+        received['path'] = request.path
+        received['auth'] = request.headers.get('Authorization')
+        form = await request.post()
+        received['file'] = form['file'].file.read()
+        received['fields'] = {key: value for key, value in form.items() if key != 'file'}
+        return web.json_response({'status': 'success', 'data': {}})
+
+    async def run():
+        runner, api_url = await _serve(handler)
+        try:
+            task = SwanTask('demo', None, 'a task', is_public=True, is_verified=True, fast_retrieval=True,
+                            bid_mode=1, max_price='0.1', expire_days=4)
+            async with _client(api_url) as client:
+                await client.post_task(task, io.BytesIO(b'uuid,miner_id\n'))
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+    assert received['path'] == '/tasks'
+    assert received['auth'] == 'Bearer jwt'
+    assert received['file'] == b'uuid,miner_id\n'
+    fields = received['fields']
+    assert fields['task_name'] == 'demo'
+    assert fields['is_public'] == '1'
+    assert fields['fast_retrieval'] == 'True'
+    assert fields['bid_mode'] == '1'
+    assert fields['expire_days'] == '4'
+    # None values are left out as requests does
+    assert 'curated_dataset' not in fields
+
+
+def test_update_offline_deal_details_skips_none():
+    received = {}
+
+    async def handler(request):
+        received['fields'] = dict(await request.post())
+        return web.json_response({'status': 'success', 'data': {}})
+
+    async def run():
+        runner, api_url = await _serve(handler)
+        try:
+            async with _client(api_url) as client:
+                await client.update_offline_deal_details('Completed', 'done', 42, file_size=1024)
+        finally:
+            await runner.cleanup()
+
+    asyncio.run(run())
+    assert received['fields'] == {'status': 'Completed', 'note': 'done', 'file_size': '1024'}
@@ -0,0 +1,150 @@
+import time
+from urllib.parse import parse_qs, urlparse
+
+import common.swan_client as swan_client
+import task_sender.autobid as autobid
+import task_sender.swan_task_sender as swan_task_sender
+from common.swan_client import SwanClient
+from task_sender.service.ledger import TaskLedger
+
+
+def paged_api(pages, requests):
+    # serves the given (tasks, total_task_count) pages in order and records every query
+    def send_http_request(url, method, token, payload, file=None):
+        requests.append(parse_qs(urlparse(url).query))
+        tasks, total = pages[len(requests) - 1]
+        return {'task': tasks, 'total_task_count': total}
+    return send_http_request
+
+
+def client(monkeypatch):
+    monkeypatch.setattr(SwanClient, 'get_jwt_token', lambda self: None)
+    return SwanClient('http://swan', 'key', 'token')
+
+
+def task(uuid, updated_on, status='Assigned'):
+    return {'uuid': uuid, 'updated_on': updated_on, 'status': status, 'miner_id': 't01000'}
+
+
+def test_iter_tasks_sends_the_mark_to_the_api(monkeypatch):
+    requests = []
+    monkeypatch.setattr(swan_client, 'send_http_request',
+                        paged_api([([task('a', 5), task('b', 20)], 2)], requests))
+    scan = {}
+    tasks = list(client(monkeypatch).iter_tasks(status='Assigned', page_size=10, updated_after=10, scan=scan))
+    assert requests[0]['updated_after'] == ['10']
+    assert requests[0]['status'] == ['Assigned']
+    # an api that ignores the mark is still filtered here
+    assert [t['uuid'] for t in tasks] == ['b']
+    assert scan['complete']
+
+
+def test_iter_tasks_flags_a_list_that_changed_while_paging(monkeypatch):
+    requests = []
+    # 'a' leaves the list after the first page, so 'c' moves onto it and the second page starts at 'd'
+    pages = [([task('a', 1), task('b', 2)], 4), ([task('d', 4)], 3)]
+    monkeypatch.setattr(swan_client, 'send_http_request', paged_api(pages, requests))
+    scan = {}
+    list(client(monkeypatch).iter_tasks(status='Assigned', page_size=2, scan=scan))
+    assert [r['offset'] for r in requests] == [['0'], ['2']]
+    assert scan['complete'] is False
+
+
+def run_scan(scheduler):
+    queued = scheduler.scan()
+    deadline = time.time() + 5
+    while (scheduler._pending or sum(scheduler._running.values())) and time.time() < deadline:
+        time.sleep(0.01)
+    return queued
+
+
+def test_mark_stays_below_tasks_not_handled(monkeypatch):
+    listings = []
+    scans = [
+        {'Assigned tasks': [task('a', 10), task('b', 20), task('c', 30)], 'high_water_mark': 30, 'complete': True},
+        {'Assigned tasks': [task('b', 20)], 'high_water_mark': 20, 'complete': True},
+    ]
+
+    def get_assigned_tasks(config_path, updated_after=None):
+        listings.append(updated_after)
+        return scans[len(listings) - 1]
+
+    handled = []
+    # b returns early the first time, as when Swan has no task info yet
+    attempts = {}
+
+    def process_assigned_task(task_uuid, config_path, out_dir, ledger=None):
+        attempts[task_uuid] = attempts.get(task_uuid, 0) + 1
+        if task_uuid == 'b' and attempts[task_uuid] == 1:
+            return False
+        handled.append(task_uuid)
+        return True
+
+    monkeypatch.setattr(autobid, 'get_assigned_tasks', get_assigned_tasks)
+    monkeypatch.setattr(autobid, 'process_assigned_task', process_assigned_task)
+    scheduler = autobid.AutobidScheduler('config.toml', None, jobs=1, poll_min=0.01, poll_max=0.04)
+
+    assert run_scan(scheduler) == 3
+    assert sorted(handled) == ['a', 'c']
+    assert scheduler.high_water_mark == 19
+
+    # after its delay b is tried again, it is no new task, and the scan still asks for everything after 19
+    time.sleep(0.02)
+    assert run_scan(scheduler) == 0
+    assert listings[1] == 19
+    assert sorted(handled) == ['a', 'b', 'c']
+    assert scheduler.high_water_mark == 30
+
+
+def test_mark_does_not_move_after_an_incomplete_scan(monkeypatch):
+    scans = [{'Assigned tasks': [task('a', 10)], 'high_water_mark': 10, 'complete': False}]
+    monkeypatch.setattr(autobid, 'get_assigned_tasks', lambda config_path, updated_after=None: scans[0])
+    monkeypatch.setattr(autobid, 'process_assigned_task', lambda *args, **kwargs: True)
+    scheduler = autobid.AutobidScheduler('config.toml', None, jobs=1)
+    run_scan(scheduler)
+    assert scheduler.high_water_mark is None
+
+
+def test_task_without_any_deal_sent_stays_assigned(tmp_path, make_config, monkeypatch):
+    config_path, _ = make_config()
+    task_info = {'uuid': 'task-1', 'miner_id': 't01000', 'type': 'regular', 'max_price': '0.0000001',
+                 'fast_retrieval': 1}
+    deals = [{'id': i, 'payload_cid': 'bafy-%s' % i, 'piece_cid': 'baga-%s' % i, 'file_size': 1000,
+              'start_epoch': 100, 'md5_origin': '', 'file_source_url': 'http://car/%s' % i} for i in range(3)]
+    monkeypatch.setattr(swan_task_sender, 'get_task_info',
+                        lambda task_uuid, config_path: {'task': task_info, 'deals': deals})
+    # the miner has no ask, every proposal raises DealFailure
+    monkeypatch.setattr(swan_task_sender, 'get_miner_price', lambda miner_id: None)
+    updates = []
+    monkeypatch.setattr(autobid, 'update_assigned_task', lambda *args: updates.append(args))
+    monkeypatch.setattr(autobid, 'get_task_info', swan_task_sender.get_task_info)
+    ledger = TaskLedger(str(tmp_path / 'ledger.db'))
+
+    out_dir = tmp_path / 'out'
+    assert autobid.process_assigned_task('task-1', config_path, str(out_dir), ledger) is False
+    assert updates == []
+    assert ledger.task('task-1') is None
+    assert not (out_dir / 'task-1-info.csv').exists()
+
+
+def test_failing_task_backs_off(monkeypatch):
+    monkeypatch.setattr(autobid, 'get_assigned_tasks', lambda config_path, updated_after=None: {
+        'Assigned tasks': [task('a', 10)], 'high_water_mark': 10, 'complete': True})
+    attempts = []
+    monkeypatch.setattr(autobid, 'process_assigned_task', lambda task_uuid, *args: attempts.append(task_uuid))
+    scheduler = autobid.AutobidScheduler('config.toml', None, jobs=1, poll_min=10, poll_max=40)
+
+    assert run_scan(scheduler) == 1
+    delays = []
+    for _ in range(4):
+        task_uuid, (_, retry_at, failures) = next(iter(scheduler._failed.items()))
+        delays.append(round(retry_at - time.time()))
+        # listed again before its delay is over, it neither runs nor counts as new
+        assert run_scan(scheduler) == 0
+        assert len(attempts) == failures
+        scheduler._failed[task_uuid] = (task('a', 10), 0, failures)
+        assert run_scan(scheduler) == 0
+    assert delays == [10, 20, 40, 40]
+    assert attempts == ['a'] * 5
+    # failures are not work done, the poll interval backs off
+    assert scheduler._done == 0
@@ -0,0 +1,194 @@
+import base64
+import csv
+import hashlib
+import os
+
+import pytest
+
+import task_sender.swan_task_sender as swan_task_sender
+from common.OfflineDeal import OfflineDeal
+from task_sender.service.car import CarWriter, UNIXFS_CHUNK_SIZE, UNIXFS_LINKS_PER_LEVEL, write_bundle_car, write_car
+from task_sender.service.cid import CODEC_DAG_PB, CODEC_RAW, encode_varint
+from task_sender.swan_task_sender import generate_car
+
+
+def deals(paths):
+    deal_list = []
+    for path in paths:
+        offline_deal = OfflineDeal()
+        offline_deal.source_file_name = os.path.basename(path)
+        offline_deal.source_file_path = path
+        offline_deal.source_file_size = os.path.getsize(path) if os.path.exists(path) else 0
+        deal_list.append(offline_deal)
+    return deal_list
+
+
+def test_failed_file_does_not_stop_the_others(tmp_path):
+    source = tmp_path / 'source'
+    source.mkdir()
+    for name in ('a', 'c'):
+        (source / name).write_bytes(os.urandom(1000))
+    out = tmp_path / 'out'
+    out.mkdir()
+    generate_car(deals([str(source / 'a'), str(source / 'b'), str(source / 'c')]), str(out), jobs=2)
+    with open(out / 'car.csv') as csv_file:
+        rows = list(csv.DictReader(csv_file))
+    assert [row['source_file_name'] for row in rows] == ['a', 'c']
+    assert all(row['piece_cid'].startswith('baga') for row in rows)
+
+
+def test_exit_is_not_taken_for_a_failed_file(tmp_path, monkeypatch):
+    # only errors are logged per file, an exit still ends the run
+    def stage_one(input_path, output_path, generate_md5=False):
+        raise SystemExit(1)
+
+    monkeypatch.setattr(swan_task_sender, 'stage_one', stage_one)
+    source = tmp_path / 'a'
+    source.write_bytes(b'data')
+    with pytest.raises(SystemExit):
+        generate_car(deals([str(source)]), str(tmp_path))
+
+
+# data cids lotus client import and ipfs add --cid-version=1 --raw-leaves report for these files
+EMPTY_FILE_CID = 'bafkreihdwdcefgh4dqkjv67uzcmw7ojee6xedzdetojuzjevtenxquvyku'
+HELLO_WORLD_CID = 'bafkreifzjut3te2nhyekklss27nh3k72ysco7y32koao5eei66wof36n5e'
+
+
+def varint(data: bytes, pos: int):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            return value, pos
+
+
+def cid_str(cid: bytes) -> str:
+    return 'b' + base64.b32encode(cid).decode('ascii').lower().rstrip('=')
+
+
+def read_car(path):
+    # (root cid, {cid: (codec, block)}), checking that every block hashes to its cid
+    data = open(path, 'rb').read()
+    header_length, pos = varint(data, 0)
+    header = data[pos:pos + header_length]
+    pos += header_length
+    # the root is the one tag 42 cid of the header, behind its multibase identity prefix
+    start = header.index(b'\xd8\x2a') + 2
+    cid_length, start = header[start + 1] - 1, start + 3
+    root = header[start:start + cid_length]
+    blocks = {}
+    while pos < len(data):
+        length, pos = varint(data, pos)
+        block = data[pos:pos + length]
+        pos += length
+        cid_pos = 0
+        for _ in range(3):
+            _, cid_pos = varint(block, cid_pos)
+        digest_length, cid_pos = varint(block, cid_pos)
+        cid, body = block[:cid_pos + digest_length], block[cid_pos + digest_length:]
+        assert cid[:1] == b'\x01' and cid[2:4] == b'\x12\x20' and cid[4:] == hashlib.sha256(body).digest()
+        blocks[cid] = (cid[1], body)
+    return root, blocks
+
+
+def fields(data: bytes):
+    # protobuf (field, value) pairs, enough for dag-pb and unixfs
+    pos = 0
+    while pos < len(data):
+        key, pos = varint(data, pos)
+        if key & 7 == 0:
+            value, pos = varint(data, pos)
+        else:
+            length, pos = varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        yield key >> 3, value
+
+
+def dag_pb(body: bytes):
+    links, unixfs = [], {}
+    for field, value in fields(body):
+        if field == 2:
+            links.append({{1: 'cid', 2: 'name', 3: 'tsize'}[f]: v for f, v in fields(value)})
+        else:
+            for unixfs_field, unixfs_value in fields(value):
+                if unixfs_field == 4:
+                    unixfs.setdefault('blocksizes', []).append(unixfs_value)
+                else:
+                    unixfs[{1: 'type', 2: 'data', 3: 'filesize'}[unixfs_field]] = unixfs_value
+    return links, unixfs
+
+
+def write(tmp_path, data: bytes, chunk_size=None):
+    source, car = tmp_path / 'source', tmp_path / 'source.car'
+    source.write_bytes(data)
+    if chunk_size is None:
+        return write_car(str(source), str(car)), read_car(car)
+    writer = CarWriter(str(car), chunk_size=chunk_size)
+    writer.update(data)
+    return writer.close(writer.finish_file()), read_car(car)
+
+
+def test_empty_file(tmp_path):
+    data_cid, (root, blocks) = write(tmp_path, b'')
+    assert data_cid == cid_str(root) == EMPTY_FILE_CID
+    assert blocks == {root: (CODEC_RAW, b'')}
+
+
+def test_one_chunk_is_a_raw_leaf(tmp_path):
+    data_cid, (root, blocks) = write(tmp_path, b'hello world')
+    assert data_cid == HELLO_WORLD_CID
+    assert blocks == {root: (CODEC_RAW, b'hello world')}
+
+    chunk = os.urandom(UNIXFS_CHUNK_SIZE)
+    data_cid, (root, blocks) = write(tmp_path, chunk)
+    assert data_cid == cid_str(b'\x01\x55\x12\x20' + hashlib.sha256(chunk).digest())
+    assert len(blocks) == 1
+
+
+# the tree shape below does not depend on the chunk size, 4 byte chunks keep 1025 leaves small
+def test_full_level_is_the_root(tmp_path):
+    data = os.urandom(4 * UNIXFS_LINKS_PER_LEVEL)
+    data_cid, (root, blocks) = write(tmp_path, data, chunk_size=4)
+    codec, body = blocks[root]
+    links, unixfs = dag_pb(body)
+    assert codec == CODEC_DAG_PB and cid_str(root) == data_cid
+    assert unixfs == {'type': 2, 'filesize': len(data), 'blocksizes': [4] * UNIXFS_LINKS_PER_LEVEL}
+    assert [blocks[link['cid']] for link in links] == [(CODEC_RAW, data[i:i + 4]) for i in range(0, len(data), 4)]
+    assert {link['name'] for link in links} == {b''} and {link['tsize'] for link in links} == {4}
+
+
+def test_one_leaf_more_adds_a_level(tmp_path):
+    # as go-unixfs' balanced layout builds it: the full node and a node holding the last leaf under a new root
+    data = os.urandom(4 * UNIXFS_LINKS_PER_LEVEL + 1)
+    data_cid, (root, blocks) = write(tmp_path, data, chunk_size=4)
+    links, unixfs = dag_pb(blocks[root][1])
+    assert unixfs == {'type': 2, 'filesize': len(data), 'blocksizes': [len(data) - 1, 1]}
+    full, rest = (blocks[link['cid']] for link in links)
+    assert dag_pb(full[1])[1]['blocksizes'] == [4] * UNIXFS_LINKS_PER_LEVEL
+    rest_links, rest_unixfs = dag_pb(rest[1])
+    assert rest_unixfs == {'type': 2, 'filesize': 1, 'blocksizes': [1]}
+    assert blocks[rest_links[0]['cid']] == (CODEC_RAW, data[-1:])
+    assert [link['tsize'] for link in links] == [len(full[1]) + len(data) - 1, len(rest[1]) + 1]
+
+    # the root bytes exactly as go-merkledag encodes them: links (with an empty name) before the data
+    link_bytes = b''.join(b'\x12' + bytes((len(link),)) + link for link in (
+        b'\x0a\x24' + link['cid'] + b'\x12\x00\x18' + encode_varint(link['tsize']) for link in links))
+    unixfs_bytes = b'\x08\x02\x18' + encode_varint(len(data)) + b'\x20' + encode_varint(len(data) - 1) + b'\x20\x01'
+    assert blocks[root][1] == link_bytes + b'\x0a' + bytes((len(unixfs_bytes),)) + unixfs_bytes
+
+
+def test_bundle_directory(tmp_path):
+    (tmp_path / 'b.txt').write_bytes(b'hello world')
+    (tmp_path / 'a.txt').write_bytes(b'')
+    car = tmp_path / 'bundle.car'
+    data_cid = write_bundle_car([str(tmp_path / 'b.txt'), str(tmp_path / 'a.txt')], str(car))
+    root, blocks = read_car(car)
+    assert data_cid == cid_str(root)
+    links, unixfs = dag_pb(blocks[root][1])
+    assert unixfs == {'type': 1}
+    # sorted by name, each file with the cid it gets on its own
+    assert [(link['name'], cid_str(link['cid']), link['tsize']) for link in links] == [
+        (b'a.txt', EMPTY_FILE_CID, 0), (b'b.txt', HELLO_WORLD_CID, 11)]
@@ -0,0 +1,119 @@
+import hashlib
+import os
+import threading
+
+import pytest
+
+from task_sender.service import commp
+from task_sender.service.commp import CommP, SEGMENT_UNPADDED_SIZE, ZERO_ROOTS, calculate_commp, \
+    piece_cid_from_root
+
+# unsealed CIDs (CommD) of sectors of zeros, as lotus and the proofs report them
+ZERO_PIECES = [
+    (6, 'baga6ea4seaqpy7usqklokfx2vxuynmupslkeutzexe2uqurdg5vhtebhxqmpqmy'),    # 2 KiB
+    (30, 'baga6ea4seaqao7s73y24kcutaosvacpdjgfe5pw76ooefnyqw4ynr3d2y6x2mpq'),   # 32 GiB
+    (31, 'baga6ea4seaqomqafu276g53zko4k23xzh4h4uecjwicbmvhsuqi7o4bhthhm4aq'),   # 64 GiB
+]
+
+
+def _hash_node(left: bytes, right: bytes) -> bytes:
+    digest = hashlib.sha256(left + right).digest()
+    return digest[:31] + bytes((digest[31] & 0x3f,))
+
+
+def _fr32_reference(chunk: bytes) -> bytes:
+    # 127 bytes as 1016 bits, least significant bit first, get two zero bits after every 254
+    bits = ''.join(format(byte, '08b')[::-1] for byte in chunk)
+    padded = ''.join(bits[i:i + 254] + '00' for i in range(0, len(bits), 254))
+    return bytes(int(padded[i:i + 8][::-1], 2) for i in range(0, len(padded), 8))
+
+
+def reference_commp(data: bytes):
+    # commP as the spec describes it, bit by bit, with the zero padding spelled out
+    size = 1 << (max(1, -(-len(data) // 127)) * 128 - 1).bit_length()
+    data = data + bytes(size // 128 * 127 - len(data))
+    padded = {}
+    leaves = []
+    for i in range(0, len(data), 127):
+        chunk = data[i:i + 127]
+        if chunk not in padded:
+            padded[chunk] = _fr32_reference(chunk)
+        leaves.extend(padded[chunk][j:j + 32] for j in range(0, 128, 32))
+    while len(leaves) > 1:
+        leaves = [_hash_node(leaves[i], leaves[i + 1]) for i in range(0, len(leaves), 2)]
+    return piece_cid_from_root(leaves[0]), size // 128 * 127
+
+
+def patterned(size: int) -> bytes:
+    # 127 byte chunks cycling through 7 random ones, so no two 4 MiB segments are alike
+    chunks = [os.urandom(127) for _ in range(7)]
+    return b''.join(chunks[i % 7] for i in range(size // 127 + 1))[:size]
+
+
+def digest(data: bytes, workers: int):
+    piece = CommP(workers=workers)
+    piece.update(data)
+    return piece.digest()
+
+
+@pytest.mark.parametrize('level, piece_cid', ZERO_PIECES)
+def test_zero_piece_commitments(level, piece_cid):
+    assert piece_cid_from_root(ZERO_ROOTS[level]) == piece_cid
+
+
+def test_zero_sector_inline():
+    assert digest(bytes(2032), 1) == (ZERO_PIECES[0][1], 2032)
+
+
+@pytest.mark.parametrize('size', [1, 126, 127, 128, 2032, 2033, 5000])
+def test_inline_matches_reference(size):
+    data = hashlib.sha256(str(size).encode()).digest() * (size // 32 + 1)
+    assert digest(data[:size], 1) == reference_commp(data[:size])
+
+
+def test_pool_matches_reference_with_padded_tail():
+    # two full segments on the pool and a tail padded with zeros up to a 16 MiB piece
+    data = patterned(SEGMENT_UNPADDED_SIZE * 2 + 1000)
+    expected = reference_commp(data)
+    assert expected[1] == 16 * 1024 * 1024 // 128 * 127
+    assert digest(data, 2) == expected
+    assert digest(data, 1) == expected
+
+
+def test_pool_zero_piece():
+    # zero data over several segments gives the zero piece of its size
+    assert digest(bytes(SEGMENT_UNPADDED_SIZE * 3), 2) == (piece_cid_from_root(ZERO_ROOTS[19]),
+                                                           SEGMENT_UNPADDED_SIZE * 4)
+
+
+def test_car_files_share_one_pool(tmp_path):
+    # three segments and a tail, hashed on the pool and inline
+    data = os.urandom(SEGMENT_UNPADDED_SIZE * 3 + 1000)
+    path = tmp_path / 'data.car'
+    path.write_bytes(data)
+    expected = calculate_commp(str(path), workers=1)
+
+    results = []
+    executors = set()
+
+    def run():
+        piece = CommP(workers=2)
+        executors.add(id(piece._executor))
+        piece.update(data)
+        results.append(piece.digest())
+
+    threads = [threading.Thread(target=run) for _ in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert results == [expected] * 3
+    pool, slots = commp.commp_pool()
+    assert executors == {id(pool)}
+    # the pool processes do not inherit the locks of the car worker threads
+    assert pool._mp_context.get_start_method() in ('forkserver', 'spawn')
+    # every slot is free again once the digests are done
+    for _ in range((os.cpu_count() or 1) * 2):
+        assert slots.acquire(blocking=False)
+    for _ in range((os.cpu_count() or 1) * 2):
+        slots.release()
@@ -0,0 +1,47 @@
+import pytest
+
+from common.lotus import LotusError
+from task_sender.service import deal
+from task_sender.service.deal import DealFailure, FAILURE_CONNECTION, FAILURE_DUPLICATE, FAILURE_ERROR, \
+    classify_deal_error, propose_with_retry
+
+
+@pytest.mark.parametrize('message, reason', [
+    ('ClientStartDeal: Post "http://127.0.0.1:1234/rpc/v0": unexpected EOF', FAILURE_CONNECTION),
+    ('failed to read response: read tcp 10.0.0.1:4321->10.0.0.2:1234: EOF', FAILURE_CONNECTION),
+    ('deal proposal already exists', FAILURE_DUPLICATE),
+    # eof inside a word is no connection error
+    ('piece cid mismatch, see geofence policy', FAILURE_ERROR),
+    ('storage deal rejected: whereof unknown', FAILURE_ERROR),
+])
+def test_classify_deal_error(message, reason):
+    assert classify_deal_error(message) == reason
+
+
+def test_duplicate_moves_one_epoch_back(monkeypatch):
+    monkeypatch.setattr(deal, 'get_current_epoch_by_current_time', lambda: 0)
+    epochs = []
+
+    def propose(start_epoch):
+        epochs.append(start_epoch)
+        if len(epochs) < 3:
+            raise LotusError('deal proposal already exists')
+        return 'bafy-deal'
+
+    assert propose_with_retry(propose, 10000) == ('bafy-deal', 9998)
+    assert epochs == [10000, 9999, 9998]
+
+
+def test_unclassified_errors_give_up(monkeypatch):
+    monkeypatch.setattr(deal, 'get_current_epoch_by_current_time', lambda: 0)
+    monkeypatch.setattr(deal.time, 'sleep', lambda seconds: None)
+    calls = []
+
+    def propose(start_epoch):
+        calls.append(start_epoch)
+        raise LotusError('geofence says no')
+
+    with pytest.raises(DealFailure) as failure:
+        propose_with_retry(propose, 10000)
+    assert failure.value.reason == FAILURE_ERROR
+    assert len(calls) == deal.DEAL_MAX_TRANSIENT_ATTEMPTS
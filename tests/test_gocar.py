@@ -0,0 +1,45 @@
+import json
+
+import task_sender.swan_task_sender as swan_task_sender
+from task_sender.service import graphsplit
+from task_sender.service.graphsplit import GRAPHSPLIT_SLICE_SIZE, load_graphsplit_tuning, slice_size_for_sector
+from task_sender.service.planner import piece_capacity
+
+
+def test_plan_uses_bundle_slice_only_for_bundles(tmp_path, make_config, monkeypatch):
+    config_path, _ = make_config(sender={'gocar_parallel': 2, 'gocar_slice_size': 1000})
+    sources = tmp_path / 'in'
+    sources.mkdir()
+    for name, size in (('a', 10), ('b', 20), ('big', 3000)):
+        (sources / name).write_bytes(b'x' * size)
+    sector_size = 32 * 1024 ** 3
+    plan_path = tmp_path / 'plan.json'
+    plan_path.write_text(json.dumps({'sector_size': sector_size, 'bundles': [
+        {'name': 'bundle-00001', 'files': [str(sources / 'a'), str(sources / 'b')], 'size': 30},
+        {'name': 'big', 'files': [str(sources / 'big')], 'size': 3000},
+    ]}))
+
+    runs = {}
+
+    def run_graphsplit(target_path, graph_name, car_dir, parent_path='.', slice_size=None, parallel=None):
+        runs[graph_name] = slice_size
+        return True
+
+    monkeypatch.setattr(swan_task_sender, 'run_graphsplit', run_graphsplit)
+    monkeypatch.setattr(swan_task_sender, 'read_manifest', lambda car_dir: {})
+    swan_task_sender.go_generate_car_files(None, config_path, str(tmp_path / 'out'), plan_path=str(plan_path))
+
+    # the bundle goes into one car, the file too large for a sector keeps slices that fit one
+    assert runs == {'bundle-00001': piece_capacity(sector_size), 'big': 1000}
+
+
+def test_slice_size_is_tuned_only_when_asked(make_config, monkeypatch):
+    # plenty of memory, the tuned slice then fills the whole sector
+    monkeypatch.setattr(graphsplit, 'available_memory', lambda: 64 * 1024 ** 3)
+    _, config = make_config()
+    assert load_graphsplit_tuning(config).tune([])[1] == GRAPHSPLIT_SLICE_SIZE
+    del config['sender']['gocar_slice_size']
+    assert load_graphsplit_tuning(config).tune([])[1] == GRAPHSPLIT_SLICE_SIZE
+
+    _, config = make_config(sender={'gocar_slice_size': 0, 'gocar_sector_size': 32 * 1024 ** 3})
+    assert load_graphsplit_tuning(config).tune([])[1] == slice_size_for_sector(32 * 1024 ** 3)
@@ -0,0 +1,138 @@
+import csv
+import os
+
+import pytest
+
+from common.OfflineDeal import OfflineDeal
+from task_sender.service.job_store import JobStore, DEAL_PROPOSED, DEAL_REPORTED, FILE_PREPARED, FILE_REPORTED, \
+    FILE_UPLOADED
+from task_sender.swan_task_sender import CAR_CSV_FIELDNAMES, submit_task
+
+
+def car_row(car_dir, name, piece_cid='baga-', data_cid='bafy-'):
+    return {
+        'car_file_name': name + '.car',
+        'car_file_path': os.path.join(str(car_dir), name + '.car'),
+        'piece_cid': piece_cid + name,
+        'data_cid': data_cid + name,
+        'car_file_size': '100',
+        'car_file_md5': '',
+        'source_file_name': name,
+        'source_file_path': '/data/' + name,
+        'source_file_size': '80',
+        'source_file_md5': '',
+        'car_file_url': '',
+    }
+
+
+def test_prepare_same_cids_keeps_upload_and_deals(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.db'))
+    row = car_row(tmp_path, 'a')
+    store.prepare(row, 0)
+    store.uploaded(row['car_file_path'], 'http://ipfs/a')
+    store.proposed(row['car_file_path'], 't01000', 'deal-a', 100, 'task-1')
+
+    store.prepare(car_row(tmp_path, 'a'), 0)
+    car_file = store.file(row['car_file_path'])
+    assert car_file['status'] == FILE_UPLOADED and car_file['car_file_url'] == 'http://ipfs/a'
+    assert store.deal(row['car_file_path'], 't01000')['deal_cid'] == 'deal-a'
+
+
+def test_prepare_changed_cids_starts_over(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.db'))
+    row = car_row(tmp_path, 'a')
+    store.prepare(row, 0)
+    store.uploaded(row['car_file_path'], 'http://ipfs/a')
+    store.proposed(row['car_file_path'], 't01000', 'deal-a', 100, 'task-1')
+
+    store.prepare(car_row(tmp_path, 'a', piece_cid='baga-other-'), 0)
+    car_file = store.file(row['car_file_path'])
+    assert car_file['status'] == FILE_PREPARED and car_file['car_file_url'] == ''
+    assert car_file['piece_cid'] == 'baga-other-a'
+    assert store.deal(row['car_file_path'], 't01000') is None
+
+
+def test_keep_only_drops_files_and_their_deals(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.db'))
+    rows = [car_row(tmp_path, name) for name in ('a', 'b', 'c')]
+    for position, row in enumerate(rows):
+        store.prepare(row, position)
+        store.proposed(row['car_file_path'], 't01000', 'deal-' + row['source_file_name'], 100, 'task-1')
+
+    store.keep_only(str(tmp_path), [rows[0]['car_file_path'], rows[2]['car_file_path']])
+    assert [car_file['source_file_name'] for car_file in store.files(str(tmp_path))] == ['a', 'c']
+    assert store.deal(rows[1]['car_file_path'], 't01000') is None
+    assert store.deal(rows[2]['car_file_path'], 't01000')['deal_cid'] == 'deal-c'
+
+
+def test_car_csv_round_trip(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.db'))
+    rows = [car_row(tmp_path, name) for name in ('b', 'a')]
+    rows[0]['car_file_url'] = 'http://ipfs/b'
+    csv_path = str(tmp_path / 'car.csv')
+    with open(csv_path, 'w') as csv_file:
+        csv_writer = csv.DictWriter(csv_file, fieldnames=CAR_CSV_FIELDNAMES)
+        csv_writer.writeheader()
+        csv_writer.writerows(rows)
+
+    store.import_car_csv(str(tmp_path), csv_path, CAR_CSV_FIELDNAMES)
+    assert store.file(rows[0]['car_file_path'])['status'] == FILE_UPLOADED
+    assert store.file(rows[1]['car_file_path'])['status'] == FILE_PREPARED
+
+    exported = str(tmp_path / 'exported.csv')
+    store.export_car_csv(str(tmp_path), exported, CAR_CSV_FIELDNAMES)
+    with open(csv_path) as before, open(exported) as after:
+        assert after.read() == before.read()
+
+
+def test_resume_under_the_pending_task_uuid(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.db'))
+    row = car_row(tmp_path, 'a')
+    store.prepare(row, 0)
+    assert store.pending_task_uuid(str(tmp_path), 't01000') is None
+    store.proposed(row['car_file_path'], 't01000', 'deal-a', 100, 'task-1')
+    assert store.pending_task_uuid(str(tmp_path), 't01000') == 'task-1'
+    assert store.pending_task_uuid(str(tmp_path), 't02000') is None
+
+    store.reported('task-1', [row['car_file_path']], 't01000')
+    assert store.file(row['car_file_path'])['status'] == FILE_REPORTED
+    assert store.deal(row['car_file_path'], 't01000')['status'] == DEAL_REPORTED
+    assert store.pending_task_uuid(str(tmp_path), 't01000') is None
+
+
+def test_offline_task_reports_its_deals(tmp_path, make_config):
+    _, config = make_config(sender={'offline_mode': True, 'public_deal': False})
+    store = JobStore(str(tmp_path / 'jobs.db'))
+    row = car_row(tmp_path, 'a')
+    store.prepare(row, 0)
+    store.proposed(row['car_file_path'], 't01000', 'deal-a', 100, 'task-1')
+    assert store.deal(row['car_file_path'], 't01000')['status'] == DEAL_PROPOSED
+
+    offline_deal = OfflineDeal()
+    for key, value in row.items():
+        setattr(offline_deal, key, value)
+    offline_deal.deal_cid = 'deal-a'
+    submit_task(config, 'offline', None, None, 't01000', [offline_deal], str(tmp_path), 'task-1', store)
+
+    assert os.path.isfile(tmp_path / 'offline.csv')
+    assert store.deal(row['car_file_path'], 't01000')['status'] == DEAL_REPORTED
+    # the next task run gets a uuid of its own instead of the deals of this one
+    assert store.pending_task_uuid(str(tmp_path), 't01000') is None
+
+
+def test_reported_rolls_back_on_error(tmp_path):
+    store = JobStore(str(tmp_path / 'jobs.db'))
+    rows = [car_row(tmp_path, name) for name in ('a', 'b')]
+    for row in rows:
+        store.prepare(row, 0)
+
+    def paths():
+        yield rows[0]['car_file_path']
+        raise OSError('gone')
+
+    with pytest.raises(OSError):
+        store.reported('task-1', paths())
+    assert store.file(rows[0]['car_file_path'])['status'] == FILE_PREPARED
+
+    store.reported('task-1', [row['car_file_path'] for row in rows])
+    assert [store.file(row['car_file_path'])['status'] for row in rows] == [FILE_REPORTED, FILE_REPORTED]
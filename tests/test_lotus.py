@@ -0,0 +1,83 @@
+import threading
+import pytest
+
+from common.fake_lotus import FakeLotus, make_server
+from common.lotus import LotusCli, LotusError, LotusRpc, configure_lotus, fil_to_atto
+from common.OfflineDeal import OfflineDeal
+from task_sender.service.ask_cache import ask_cache, configure_ask_cache
+from task_sender.service.deal import DealConfig, calculate_real_cost, make_proposer
+
+GIB = 1024 ** 3
+# 0.0000000005 FIL per GiB per epoch
+PRICE_ATTO = '500000000'
+
+
+@pytest.fixture(params=['v0', 'v1'])
+def fake_lotus(request):
+    fake = FakeLotus(price=PRICE_ATTO, verified_price='0', min_piece_size=256, max_piece_size=32 * GIB,
+                     token='secret', api_version=request.param)
+    server = make_server(fake)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    fake.api_url = 'http://127.0.0.1:%s/rpc/%s' % (server.server_address[1], request.param)
+    yield fake
+    server.shutdown()
+    server.server_close()
+
+
+def test_query_ask_converts_attofil(fake_lotus):
+    ask = LotusRpc(fake_lotus.api_url, 'secret').query_ask('t01000')
+    assert ask == {'price': '0.0000000005', 'verified_price': '0', 'min_piece_size': '256 B',
+                   'max_piece_size': '32 GiB'}
+
+
+@pytest.mark.parametrize('ask', [None, {}, {'Response': None}, {'Response': {'Price': 'x', 'VerifiedPrice': '0',
+                                                                          'MinPieceSize': 256, 'MaxPieceSize': 1024}}])
+def test_malformed_ask_is_no_ask(fake_lotus, monkeypatch, ask):
+    monkeypatch.setattr(fake_lotus, 'ClientQueryAsk', lambda peer_id, miner_id: ask)
+    assert LotusRpc(fake_lotus.api_url, 'secret').query_ask('t01000') is None
+
+
+def test_query_ask_without_token_is_no_ask(fake_lotus):
+    assert LotusRpc(fake_lotus.api_url).query_ask('t01000') is None
+    with pytest.raises(LotusError):
+        LotusRpc(fake_lotus.api_url).call('ClientQueryAsk', 'peer', 't01000')
+
+
+def test_start_deal_sends_attofil_and_unpadded_piece_size(fake_lotus):
+    deal_cid = LotusRpc(fake_lotus.api_url, 'secret').start_deal(
+        'f1wallet', 't01000', 'bafy-data', 'baga-piece', '1040384', '0.000000001', 1512000, 100, 'true', False)
+    assert deal_cid.startswith('bafyrei')
+    params = fake_lotus.deals[0]
+    assert params['Data'] == {'TransferType': 'manual', 'Root': {'/': 'bafy-data'}, 'PieceCid': {'/': 'baga-piece'},
+                              'PieceSize': 1040384}
+    assert params['EpochPrice'] == '1000000000'
+    assert params['FastRetrieval'] is True and params['VerifiedDeal'] is False
+
+
+def test_proposer_deal_through_rpc(fake_lotus, make_config):
+    # the price comes back from the ask in FIL and goes out per epoch in attoFIL, the piece size goes out
+    # unpadded, i.e. the padded sector size less 1/128 for Fr32 padding
+    _, config = make_config()
+    config['lotus'] = {'api_url': fake_lotus.api_url, 'api_token': 'secret'}
+    try:
+        assert isinstance(configure_lotus(config), LotusRpc)
+        configure_ask_cache(config)
+        ask_cache.invalidate('t01000')
+        deal_conf = DealConfig('t01000', 'f1wallet', '0.000000001', False, True, 1, None)
+        offline_deal = OfflineDeal()
+        offline_deal.car_file_size = 1000
+        offline_deal.data_cid = 'bafy-data'
+        offline_deal.piece_cid = 'baga-piece'
+        make_proposer(deal_conf, True)(offline_deal)
+    finally:
+        configure_lotus({})
+
+    params = fake_lotus.deals[0]
+    assert params['Data']['PieceSize'] == 1024 * 127 // 128
+    cost = calculate_real_cost(1024, '0.0000000005')
+    assert params['EpochPrice'] == fil_to_atto(f'{cost:.18f}')
+    # 1 KiB sector at 500000000 attoFIL per GiB, rounded at 18 FIL decimals
+    assert params['EpochPrice'] == '477'
+    assert offline_deal.deal_cid.startswith('bafyrei') and offline_deal.miner_id == 't01000'
+    assert isinstance(configure_lotus({}), LotusCli)
@@ -0,0 +1,186 @@
+import csv
+import os
+import threading
+import time
+from collections import namedtuple
+
+import pytest
+
+import task_sender.pipeline as pipeline
+from common.config import read_config
+from task_sender.service.deal import DealFailure
+
+FILES = 6
+
+
+@pytest.fixture
+def pipeline_env(tmp_path, make_config, monkeypatch):
+    source_dir = tmp_path / 'in'
+    source_dir.mkdir()
+    for i in range(FILES):
+        (source_dir / ('f%s' % i)).write_bytes(b'x' * (1000 * (i + 1)))
+    out_dir = tmp_path / 'out'
+    out_dir.mkdir()
+
+    calls = {'cars': [], 'uploads': [], 'proposals': [], 'submitted': None}
+
+    def cached_car_row(_deal, target_dir, cache=None):
+        calls['cars'].append(_deal.source_file_name)
+        car_file_name = _deal.source_file_name + '.car'
+        return {'car_file_name': car_file_name, 'car_file_path': os.path.join(target_dir, car_file_name),
+                'piece_cid': 'piece-' + _deal.source_file_name, 'data_cid': 'data-' + _deal.source_file_name,
+                'car_file_size': 100, 'car_file_md5': '', 'source_file_name': _deal.source_file_name,
+                'source_file_path': _deal.source_file_path, 'source_file_size': _deal.source_file_size,
+                'source_file_md5': '', 'car_file_url': ''}
+
+    class Uploader:
+        def __init__(self, config):
+            pass
+
+        def upload(self, car_file_name, car_file_path, piece_cid, data_cid):
+            calls['uploads'].append(car_file_name)
+            return 'http://gateway/ipfs/' + car_file_name, 100
+
+    def make_proposer(deal_conf, skip_confirmation):
+        def propose(_deal):
+            calls['proposals'].append(_deal.car_file_name)
+            _deal.deal_cid = 'deal-' + _deal.car_file_name
+            _deal.start_epoch = 1000
+            _deal.miner_id = 't01000'
+            return _deal
+        return propose
+
+    def submit_task(config, task_name, curated_dataset, description, miner_id, deal_list, output_dir, task_uuid,
+                    store=None):
+        calls['submitted'] = list(deal_list)
+
+    monkeypatch.setattr(pipeline, 'cached_car_row', cached_car_row)
+    monkeypatch.setattr(pipeline, 'IpfsUploader', Uploader)
+    monkeypatch.setattr(pipeline, 'make_proposer', make_proposer)
+    monkeypatch.setattr(pipeline, 'configure_lotus', lambda config: None)
+    monkeypatch.setattr(pipeline, 'configure_ask_cache', lambda config: None)
+    monkeypatch.setattr(pipeline, 'load_deal_config', lambda config, miner_id: None)
+    monkeypatch.setattr(pipeline, 'submit_task', submit_task)
+
+    def make(queue_size=1, min_free=0, **sender):
+        sender = dict({'public_deal': False, 'skip_confirmation': True, 'car_jobs': 2, 'upload_jobs': 2,
+                       'deal_jobs': 2}, **sender)
+        config_path, _ = make_config(main={'storage_server_type': 'ipfs server'}, sender=sender)
+        return pipeline.Pipeline(read_config(config_path), str(source_dir), str(out_dir), 'demo',
+                                 miner_id='t01000', queue_size=queue_size, min_free=min_free)
+
+    Env = namedtuple('Env', 'make calls out_dir uploader')
+    return Env(make, calls, str(out_dir), Uploader)
+
+
+def run_with_timeout(p, timeout=10):
+    result = {}
+    thread = threading.Thread(target=lambda: result.setdefault('ok', p.run()), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), 'pipeline did not finish'
+    return result['ok']
+
+
+def car_csv_rows(out_dir):
+    with open(os.path.join(out_dir, 'car.csv')) as csv_file:
+        return list(csv.DictReader(csv_file))
+
+
+def test_all_files_go_through(pipeline_env):
+    assert run_with_timeout(pipeline_env.make())
+    calls = pipeline_env.calls
+    assert sorted(calls['proposals']) == sorted('f%s.car' % i for i in range(FILES))
+    assert len(calls['submitted']) == FILES
+    assert all(row['car_file_url'] for row in car_csv_rows(pipeline_env.out_dir))
+
+
+def test_failing_uploader_sends_no_deals(pipeline_env, monkeypatch):
+    def upload(self, car_file_name, car_file_path, piece_cid, data_cid):
+        if car_file_name == 'f3.car':
+            raise RuntimeError('connection reset')
+        return 'http://gateway/ipfs/' + car_file_name, 100
+
+    monkeypatch.setattr(pipeline_env.uploader, 'upload', upload)
+    assert run_with_timeout(pipeline_env.make(upload_jobs=1)) is False
+    assert pipeline_env.calls['proposals'] == []
+    assert pipeline_env.calls['submitted'] is None
+    rows = car_csv_rows(pipeline_env.out_dir)
+    assert len(rows) == FILES
+    assert [row['car_file_name'] for row in rows if not row['car_file_url']] == ['f3.car']
+
+
+def test_error_outside_the_uploader_does_not_stop_the_workers(pipeline_env):
+    p = pipeline_env.make(upload_jobs=1)
+    # every url join fails, the single upload worker must keep draining the queue
+    p.web_server = True
+    p.download_url_prefix = None
+    assert run_with_timeout(p) is False
+    assert len(pipeline_env.calls['cars']) == FILES
+    assert pipeline_env.calls['proposals'] == []
+
+
+def test_failing_proposer_still_creates_the_task(pipeline_env, monkeypatch):
+    def make_proposer(deal_conf, skip_confirmation):
+        def propose(_deal):
+            if _deal.car_file_name == 'f2.car':
+                raise DealFailure('rejected', 'deal rejected')
+            _deal.deal_cid = 'deal-' + _deal.car_file_name
+            return _deal
+        return propose
+
+    monkeypatch.setattr(pipeline, 'make_proposer', make_proposer)
+    assert run_with_timeout(pipeline_env.make())
+    submitted = pipeline_env.calls['submitted']
+    assert len(submitted) == FILES
+    assert [d.car_file_name for d in submitted if not d.deal_cid] == ['f2.car']
+    assert os.path.isfile(os.path.join(pipeline_env.out_dir, 'demo-deals.csv'))
+
+
+def test_car_workers_reserve_disk_space(pipeline_env, monkeypatch):
+    needed = 1000
+    min_free = 10 ** 9
+    # room for one car above min_free, and the free space never changes while cars are written
+    usage = namedtuple('usage', 'total used free')
+    monkeypatch.setattr(pipeline, 'estimate_car_size', lambda size: needed)
+    monkeypatch.setattr(pipeline.shutil, 'disk_usage',
+                        lambda path: usage(10 ** 12, 0, min_free + needed + needed // 2))
+    monkeypatch.setattr(pipeline, 'DISK_WAIT', 0.01)
+
+    active = []
+    peak = []
+    car_row = pipeline.cached_car_row
+
+    def slow_car_row(_deal, target_dir, cache=None):
+        active.append(1)
+        peak.append(len(active))
+        time.sleep(0.05)
+        active.pop()
+        return car_row(_deal, target_dir, cache)
+
+    monkeypatch.setattr(pipeline, 'cached_car_row', slow_car_row)
+    assert run_with_timeout(pipeline_env.make(min_free=min_free, car_jobs=4, queue_size=FILES))
+    assert max(peak) == 1
+
+
+def test_car_that_never_fits_fails(pipeline_env, monkeypatch):
+    usage = namedtuple('usage', 'total used free')
+    monkeypatch.setattr(pipeline, 'estimate_car_size', lambda size: 1000 if size < 6000 else 10 ** 6)
+    monkeypatch.setattr(pipeline.shutil, 'disk_usage', lambda path: usage(10 ** 6, 0, 10 ** 6))
+    p = pipeline_env.make(min_free=1000)
+    assert run_with_timeout(p) is False
+    assert p._failed == {pipeline.STAGE_CAR: ['f5']}
+    assert pipeline_env.calls['proposals'] == []
+
+
+def test_space_that_never_frees_fails_after_the_wait(pipeline_env, monkeypatch):
+    usage = namedtuple('usage', 'total used free')
+    monkeypatch.setattr(pipeline, 'estimate_car_size', lambda size: 1000)
+    # enough disk in total, but it stays full whatever the pipeline waits for
+    monkeypatch.setattr(pipeline.shutil, 'disk_usage', lambda path: usage(10 ** 6, 10 ** 6, 500))
+    monkeypatch.setattr(pipeline, 'DISK_WAIT', 0.01)
+    monkeypatch.setattr(pipeline, 'DISK_WAIT_MAX', 0.05)
+    p = pipeline_env.make(min_free=0)
+    assert run_with_timeout(p) is False
+    assert sorted(p._failed[pipeline.STAGE_CAR]) == ['f%s' % i for i in range(FILES)]
+    assert pipeline_env.calls['cars'] == []
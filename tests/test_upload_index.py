@@ -0,0 +1,36 @@
+from common.upload_index import UploadIndex
+from task_sender.service.uploader import IpfsUploader
+
+API = 'http://ipfs:5001'
+
+
+def test_find_by_piece_cid_and_size(tmp_path):
+    index = UploadIndex(str(tmp_path / 'index.db'))
+    index.record(API, 'baga-piece', 'bafy-data', 'Qm-car', 1000)
+    assert index.find(API, 'baga-piece', 1000) == 'Qm-car'
+    assert index.find(API, 'baga-piece', 999) is None
+    assert index.find('http://other:5001', 'baga-piece', 1000) is None
+    assert index.find(API, None, 1000) is None
+
+
+def test_same_data_cid_in_another_car_is_uploaded(tmp_path, make_config, monkeypatch):
+    # the same dag written by another tool has the data cid, but other bytes and so another piece cid
+    _, config = make_config()
+    config['ipfs-server']['upload_index'] = str(tmp_path / 'index.db')
+    config['ipfs-server']['upload_probe'] = False
+    uploader = IpfsUploader(config)
+    uploader.upload_index.record(uploader.api_address, 'baga-old', 'bafy-data', 'Qm-old', 1000)
+
+    car_file = tmp_path / 'data.car'
+    car_file.write_bytes(b'x' * 1200)
+    uploads = []
+    monkeypatch.setattr('task_sender.service.uploader.SwanClient.upload_car_to_ipfs',
+                        lambda path, *args: uploads.append(path) or 'Qm-new')
+    address, sent = uploader.upload('data.car', str(car_file), 'baga-new', 'bafy-data')
+    assert address.endswith('/ipfs/Qm-new') and sent == 1200
+    assert uploads == [str(car_file)]
+
+    # a second upload of the same car is found by its piece cid and size
+    address, sent = uploader.upload('data.car', str(car_file), 'baga-new', 'bafy-data')
+    assert address.endswith('/ipfs/Qm-new') and sent == 0
+    assert len(uploads) == 1